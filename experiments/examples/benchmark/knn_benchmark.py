@@ -0,0 +1,382 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+r"""Recall and latency benchmark for the local nearest neighbor backends.
+
+Builds each backend over the same deterministic catalog, runs unfiltered and
+category filtered query workloads one query at a time and reports recall@k
+against exact search, latency percentiles, QPS, build time and resident
+memory as JSON. Each backend is built and measured in a fresh process, so
+its memory figures do not depend on the backends before it. Runs offline,
+no cloud credentials are needed. Usage:
+
+    APPLIED_AI_CONF=conf/app.toml python -m examples.benchmark.knn_benchmark \
+        --datapoints 100000 --dimension 256 --backends exact,ivf,int8,pq
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import backends, base, loaders, local, store
+
+BACKENDS = {
+    "exact": {},
+    "ivf": {"approximate": True},
+    "int8": {"quantization_kind": "int8"},
+    "pq": {"quantization_kind": "pq"},
+}
+FLIPKART_SAMPLE = "third_party/flipkart/ecommerce-sample_small.csv"
+
+
+class Catalog(NamedTuple):
+    ids: list[str]
+    vectors: np.ndarray
+    categories: list[tuple[str, ...]]  # category path of each datapoint
+
+    @property
+    def restricts(self) -> list[local.Restricts]:
+        return [
+            local.parse_restricts(base.category_restricts(list(cat)))
+            for cat in self.categories
+        ]
+
+
+class Workload(NamedTuple):
+    name: str
+    queries: np.ndarray
+    filters: list[list[tuple[str, list[str]]]]  # per query
+
+
+def _direction(name: str, dimension: int, seed: int) -> np.ndarray:
+    """Deterministic random unit vector for a category path."""
+    digest = hashlib.sha256(f"{seed}:{name}".encode()).digest()
+    rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+    v = rng.standard_normal(dimension)
+    return v / np.linalg.norm(v)
+
+
+def _embed(
+    paths: list[tuple[str, ...]], dimension: int, noise: float, seed: int
+) -> np.ndarray:
+    """Clustered vectors, each the sum of its category levels' directions plus noise.
+
+    Deeper levels get smaller weights, so products sharing a prefix are close
+    and the filtered workloads have meaningful neighbors.
+    """
+    directions = {}
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((len(paths), dimension)).astype(np.float32)
+    vectors *= noise / np.sqrt(dimension)
+    for row, path in enumerate(paths):
+        for level in range(len(path)):
+            prefix = " >> ".join(path[: level + 1])
+            if prefix not in directions:
+                directions[prefix] = _direction(prefix, dimension, seed)
+            vectors[row] += directions[prefix] / (level + 1)
+    return vectors
+
+
+def synthetic_catalog(
+    datapoints: int,
+    dimension: int,
+    branching: tuple[int, ...] = (8, 6, 4, 3),
+    noise: float = 1.0,
+    seed: int = 0,
+) -> Catalog:
+    """Catalog with a random category tree, the same for the same arguments."""
+    rng = np.random.default_rng(seed)
+    levels = np.stack([rng.integers(0, b, datapoints) for b in branching], axis=1)
+    categories = [
+        tuple(f"L{level}-{c}" for level, c in enumerate(row)) for row in levels
+    ]
+    ids = [f"{i}_{'T' if i % 2 == 0 else 'I'}" for i in range(datapoints)]
+    return Catalog(ids, _embed(categories, dimension, noise, seed + 1), categories)
+
+
+def flipkart_catalog(
+    path: str, datapoints: int, dimension: int, noise: float = 1.0, seed: int = 0
+) -> Catalog:
+    """Catalog with the category trees of a Flipkart product CSV.
+
+    The sample has no embeddings, so vectors are synthesized around each
+    product's category path. Products are repeated to reach datapoints, each
+    with a text and an image datapoint.
+    """
+    products = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            tree = json.loads(row["product_category_tree"])[0]
+            levels = [c.strip() for c in tree.split(">>")][: base.category_depth]
+            products.append((row["uniq_id"], tuple(levels)))
+    if not products:
+        raise ValueError(f"No products in {path}")
+    ids, categories = [], []
+    for i in range(datapoints):
+        product, cat = products[(i // 2) % len(products)]
+        copy = i // (2 * len(products))
+        ids.append(f"{product}-{copy}_{'T' if i % 2 == 0 else 'I'}")
+        categories.append(cat)
+    return Catalog(ids, _embed(categories, dimension, noise, seed + 1), categories)
+
+
+def workloads(
+    catalog: Catalog, queries: int, depths: list[int], noise: float, seed: int
+) -> list[Workload]:
+    """Queries near random catalog datapoints, filtered to their category prefix."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(catalog.ids), queries, replace=len(catalog.ids) < queries)
+    dimension = catalog.vectors.shape[1]
+    vectors = local.normalize(catalog.vectors[rows])
+    vectors += rng.standard_normal(vectors.shape) * noise / np.sqrt(dimension)
+    out = []
+    for depth in depths:
+        filters = [
+            base.filter_namespaces(list(catalog.categories[row][:depth]))
+            for row in rows
+        ]
+        out.append(
+            Workload("unfiltered" if depth == 0 else f"L{depth - 1}", vectors, filters)
+        )
+    return out
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def rss_bytes() -> int:
+    """Current resident set size, the peak if /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def mapped_bytes(directory: str) -> int:
+    """Bytes of files under directory mapped into this process, 0 without /proc."""
+    directory = os.path.realpath(directory) + os.sep
+    total = 0
+    try:
+        with open("/proc/self/maps") as f:
+            for line in f:
+                fields = line.split(maxsplit=5)
+                if len(fields) == 6 and fields[5].strip().startswith(directory):
+                    start, end = (int(a, 16) for a in fields[0].split("-"))
+                    total += end - start
+    except OSError:
+        return 0
+    return total
+
+
+def recall(exact: list[list[str]], approx: list[list[str]]) -> float:
+    """Mean fraction of the exact neighbors found, over queries with any."""
+    hits = [len(set(e) & set(a)) / len(e) for e, a in zip(exact, approx) if e]
+    return float(np.mean(hits)) if hits else 1.0
+
+
+def run_workload(
+    query_fn: Callable, workload: Workload, k: int, warmup: int = 10
+) -> tuple[list[list[str]], np.ndarray, float]:
+    """Neighbor ids, per query latencies in seconds and elapsed seconds."""
+    for q, f in list(zip(workload.queries, workload.filters))[:warmup]:
+        query_fn(q, f, k)
+    results, latencies = [], []
+    start = time.perf_counter()
+    for q, f in zip(workload.queries, workload.filters):
+        t = time.perf_counter()
+        neighbors = query_fn(q, f, k)
+        latencies.append(time.perf_counter() - t)
+        results.append([n.id for n in neighbors])
+    return results, np.array(latencies), time.perf_counter() - start
+
+
+def benchmark(
+    catalog: Catalog,
+    names: list[str],
+    tests: list[Workload],
+    k: int,
+    workdir: str,
+    nlist: int = 0,
+    nprobe: int = 8,
+    rerank: int = 10,
+) -> list[dict]:
+    """Build each backend over catalog and measure it on each workload."""
+    path = os.path.join(workdir, "catalog" + store.SUFFIX)
+    store.VectorStore.write(path, catalog.ids, catalog.vectors, catalog.restricts)
+
+    exact = local.BruteForceIndex.from_store(store.VectorStore.open(path))
+    truth = {
+        w.name: [
+            [n.id for n in exact.search(q, k, f)[0]]
+            for q, f in zip(w.queries, w.filters)
+        ]
+        for w in tests
+    }
+    del exact
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        # every backend builds its posting lists, IVF lists or codes afresh
+        for sidecar in os.listdir(workdir):
+            if sidecar != os.path.basename(path):
+                os.remove(os.path.join(workdir, sidecar))
+        with context.Pool(1) as pool:
+            results.extend(
+                pool.apply(
+                    measure,
+                    (path, name, tests, truth, k, dict(nlist=nlist, nprobe=nprobe)),
+                    {"rerank": rerank},
+                )
+            )
+    return results
+
+
+def measure(
+    path: str,
+    name: str,
+    tests: list[Workload],
+    truth: dict[str, list[list[str]]],
+    k: int,
+    options: dict,
+    rerank: int = 10,
+) -> list[dict]:
+    """Build one backend over the store at path and run every workload on it.
+
+    Runs in a process of its own, rss_mb is its resident memory after the
+    last workload, index_rss_mb the growth from before the build, and
+    mapped_mb the size of the memory mapped store and index files (resident
+    or not).
+    """
+    logging.basicConfig(level=logging.INFO)
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    index = loaders.load_local_index(path, rerank=rerank, **options, **BACKENDS[name])
+    build_seconds = time.perf_counter() - start
+    backend = backends.LocalBackend(name, lambda: index)
+    rows = []
+    for w in tests:
+        ids, latencies, elapsed = run_workload(backend.query, w, k)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        rows.append(
+            {
+                "backend": name,
+                "workload": w.name,
+                "k": k,
+                "queries": len(w.queries),
+                "recall": recall(truth[w.name], ids),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "qps": len(w.queries) / elapsed,
+                "build_seconds": build_seconds,
+            }
+        )
+        logging.info(
+            f"{name} {w.name}: recall@{k} {rows[-1]['recall']:.4f} "
+            f"p50 {p50:.3f}ms p99 {p99:.3f}ms {rows[-1]['qps']:.0f} QPS"
+        )
+    # after the queries, so pages of memory mapped files they touched count
+    rss = rss_bytes()
+    memory = {
+        "rss_mb": rss / 2**20,
+        "index_rss_mb": (rss - rss_before) / 2**20,
+        "mapped_mb": mapped_bytes(os.path.dirname(path)) / 2**20,
+    }
+    return [{**row, **memory} for row in rows]
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--dataset", choices=["synthetic", "flipkart"], default="synthetic"
+    )
+    parser.add_argument("--flipkart-csv", default=FLIPKART_SAMPLE)
+    parser.add_argument("--datapoints", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument(
+        "--filter-depths",
+        default="0,1,2",
+        help="category prefix depth of each workload, 0 is unfiltered",
+    )
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--rerank", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON report path, stdout if not set")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    names = args.backends.split(",")
+    unknown = set(names) - set(BACKENDS)
+    if unknown:
+        parser.error(
+            f"unknown backends {sorted(unknown)}, choose from {list(BACKENDS)}"
+        )
+    if args.dataset == "flipkart":
+        catalog = flipkart_catalog(
+            args.flipkart_csv, args.datapoints, args.dimension, args.noise, args.seed
+        )
+    else:
+        catalog = synthetic_catalog(
+            args.datapoints, args.dimension, noise=args.noise, seed=args.seed
+        )
+    tests = workloads(
+        catalog,
+        args.queries,
+        [int(d) for d in args.filter_depths.split(",")],
+        args.noise,
+        args.seed + 2,
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        results = benchmark(
+            catalog, names, tests, args.k, workdir, args.nlist, args.nprobe, args.rerank
+        )
+    report = {
+        "dataset": args.dataset,
+        "datapoints": len(catalog.ids),
+        "dimension": args.dimension,
+        "seed": args.seed,
+        "peak_rss_mb": peak_rss_bytes() / 2**20,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
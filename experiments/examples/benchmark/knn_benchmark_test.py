@@ -0,0 +1,85 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""KNN Benchmark Unit Test."""
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from examples.benchmark import knn_benchmark
+
+
+class CatalogTest(unittest.TestCase):
+    def test_synthetic_deterministic(self):
+        a = knn_benchmark.synthetic_catalog(100, 16, seed=3)
+        b = knn_benchmark.synthetic_catalog(100, 16, seed=3)
+        np.testing.assert_array_equal(a.vectors, b.vectors)
+        self.assertEqual(a.categories, b.categories)
+        self.assertEqual(len(a.categories[0]), 4)
+        self.assertEqual(a.restricts[0]["L0"], frozenset([a.categories[0][0]]))
+
+    def test_flipkart(self):
+        catalog = knn_benchmark.flipkart_catalog(knn_benchmark.FLIPKART_SAMPLE, 40, 16)
+        self.assertEqual(len(catalog.ids), 40)
+        self.assertEqual(len(set(catalog.ids)), 40)
+        self.assertEqual(catalog.categories[0][0], "Clothing")
+
+    def test_workloads(self):
+        catalog = knn_benchmark.synthetic_catalog(100, 16)
+        tests = knn_benchmark.workloads(catalog, 20, [0, 2], 1.0, 0)
+        self.assertEqual([w.name for w in tests], ["unfiltered", "L1"])
+        self.assertEqual(tests[0].filters[0], [])
+        self.assertEqual([ns for ns, _ in tests[1].filters[0]], ["L0", "L1"])
+
+    def test_recall(self):
+        self.assertEqual(knn_benchmark.recall([["a", "b"], []], [["b", "c"], []]), 0.5)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as d:
+            output = os.path.join(d, "report.json")
+            knn_benchmark.main(
+                [
+                    "--datapoints=500",
+                    "--dimension=16",
+                    "--queries=20",
+                    "--k=5",
+                    "--backends=exact,ivf,int8",
+                    f"--output={output}",
+                ]
+            )
+            with open(output) as f:
+                report = json.load(f)
+        self.assertEqual(report["datapoints"], 500)
+        self.assertEqual(len(report["results"]), 9)
+        for r in report["results"]:
+            self.assertLessEqual(r["p50_ms"], r["p99_ms"])
+            self.assertGreater(r["qps"], 0)
+            self.assertGreaterEqual(r["rss_mb"], r["index_rss_mb"])
+            if os.path.exists("/proc/self/maps"):
+                # at least the memory mapped store
+                self.assertGreater(r["mapped_mb"], 0)
+            if r["backend"] == "exact":
+                self.assertEqual(r["recall"], 1.0)
+            self.assertGreater(r["recall"], 0.8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,9 +24,6 @@ from google.cloud.ml.applied.utils import utils
 from google.cloud.ml.applied.knn import nearest_neighbors
 from google.cloud.ml.applied.config import Config
 
-bq_client = utils.get_bq_client()
-llm = utils.get_llm()
-
 
 def join_attributes_desc(ids: list[str]) -> dict[str:dict]:
     """
@@ -57,7 +54,7 @@ def join_attributes_desc(ids: list[str]) -> dict[str:dict]:
     WHERE
         {column_id} IN {str(ids).replace('[', '(').replace(']', ')')}
     """
-    query_job = bq_client.query(query)
+    query_job = utils.get_bq_client().query(query)
     rows = query_job.result()
     attributes = {}
     for row in rows:
@@ -98,34 +95,37 @@ def retrieve(
         filters: category prefix to restrict results to
 
     Returns:
-        List of candidates sorted by embedding distance. Each candidate is a
-        dict with the following keys:
+        List of candidates, one per product, best first after fusing text and
+        image neighbors (see nearest_neighbors.get_product_nn). Each candidate
+        is a dict with the following keys:
             id: product ID
             attributes: attributes in dict form e.g. {'color':'green', 'pattern': 'striped'}
             description: string describing product
             distance: embedding distance in range [0,1], 0 being the closest match
+            text_distance: distance of the product text embedding, or None
+            image_distance: distance of the product image embedding, or None
     """
     res = embeddings.embed(desc, image, base64)
     embeds = (
         [res.text_embedding, res.image_embedding]
-        if res.image_embedding
+        if res.image_embedding is not None
         else [res.text_embedding]
     )
-    neighbors = nearest_neighbors.get_nn(embeds, filters)
+    neighbors = nearest_neighbors.get_product_nn(embeds, filters)
     if not neighbors:
         return []
-    ids = [n.id[:-2] for n in neighbors]  # last 3 chars are not part of product ID
-    attributes_desc = join_attributes_desc(ids)
-    candidates = [
+    attributes_desc = join_attributes_desc([n.id for n in neighbors])
+    return [
         {
-            "attributes": attributes_desc[n.id[:-2]]["attributes"],
-            "description": attributes_desc[n.id[:-2]]["description"],
+            "attributes": attributes_desc[n.id]["attributes"],
+            "description": attributes_desc[n.id]["description"],
             "id": n.id,
             "distance": n.distance,
+            "text_distance": n.text_distance,
+            "image_distance": n.image_distance,
         }
         for n in neighbors
     ]
-    return sorted(candidates, key=lambda d: d["distance"])
 
 
 def generate_prompt(desc: str, candidates: list[dict]) -> str:
@@ -197,7 +197,7 @@ def generate_attributes(desc: str, candidates: list[dict]) -> m.AttributeValue:
         "max_output_tokens": 256,
         "temperature": 0.0,
     }
-    response = llm.predict(prompt, **llm_parameters)
+    response = utils.llm_predict(utils.get_llm(), prompt, **llm_parameters)
     res = response.text
     if not res:
         raise ValueError(
@@ -69,9 +69,19 @@ class AttributesTest(unittest.TestCase):
         )
         logging.info(res)
         self.assertIsInstance(res, list)
-        self.assertEqual(len(res), self.numberOfNeighbors * 2)
+        self.assertGreater(len(res), 0)
+        self.assertLessEqual(len(res), self.numberOfNeighbors * 2)
+        self.assertEqual(len({c["id"] for c in res}), len(res))
         self.assertEqual(
-            set(res[0].keys()), {"id", "attributes", "description", "distance"}
+            set(res[0].keys()),
+            {
+                "id",
+                "attributes",
+                "description",
+                "distance",
+                "text_distance",
+                "image_distance",
+            },
         )
 
     def test_generate_attributes_no_category(self):
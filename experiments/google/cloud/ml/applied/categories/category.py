@@ -24,9 +24,6 @@ from google.cloud.ml.applied.knn import nearest_neighbors
 from google.cloud.ml.applied.utils import utils
 from google.cloud.ml.applied.config import Config
 
-bq_client = utils.get_bq_client()
-llm = utils.get_llm()
-
 category_depth = Config.value(Config.SECTION_CATEGORY, "depth")
 allow_trailing_nulls = Config.value(key="allow_trailing_spaces")
 number_of_neighbors = Config.value(Config.SECTION_VECTORS, "number_of_neighbors")
@@ -56,7 +53,7 @@ def join_categories(ids: list[str]) -> dict[str : list[str]]:
     WHERE
         {column_id} IN {str(ids).replace('[', '(').replace(']', ')')}
     """
-    query_job = bq_client.query(query)
+    query_job = utils.get_bq_client().query(query)
     rows = query_job.result()
     categories = defaultdict(list)
     for row in rows:
@@ -98,28 +95,35 @@ def retrieve(
         filters: category prefix to restrict results to
 
     Returns:
-        List of candidates sorted by embedding distance. Each candidate is a
-        dict with the following keys:
+        List of candidates, one per product, best first after fusing text and
+        image neighbors (see nearest_neighbors.get_product_nn). Each candidate
+        is a dict with the following keys:
             id: product ID
             category: category in list form e.g. ['level 1 category', 'level 2 category']
             distance: embedding distance in range [0,1], 0 being the closest match
+            text_distance: distance of the product text embedding, or None
+            image_distance: distance of the product image embedding, or None
     """
     res = embeddings.embed(desc, image, base64)
     embeds = (
         [res.text_embedding, res.image_embedding]
-        if res.image_embedding
+        if res.image_embedding is not None
         else [res.text_embedding]
     )
-    neighbors = nearest_neighbors.get_nn(embeds, filters)
+    neighbors = nearest_neighbors.get_product_nn(embeds, filters)
     if not neighbors:
         return []
-    ids = [n.id[:-2] for n in neighbors]  # last 3 chars are not part of product ID
-    categories = join_categories(ids)
-    candidates = [
-        {"category": categories[n.id[:-2]], "id": n.id, "distance": n.distance}
+    categories = join_categories([n.id for n in neighbors])
+    return [
+        {
+            "category": categories[n.id],
+            "id": n.id,
+            "distance": n.distance,
+            "text_distance": n.text_distance,
+            "image_distance": n.image_distance,
+        }
         for n in neighbors
     ]
-    return sorted(candidates, key=lambda d: d["distance"])
 
 
 def _rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
@@ -143,7 +147,7 @@ def _rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
         "max_output_tokens": 256,
         "temperature": 0.0,
     }
-    response = llm.predict(query, **llm_parameters)
+    response = utils.llm_predict(utils.get_llm(), query, **llm_parameters)
     res = response.text.splitlines()
     if not res:
         raise ValueError(
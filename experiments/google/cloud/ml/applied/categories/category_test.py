@@ -49,8 +49,13 @@ class CategoryTest(unittest.TestCase):
         res = category.retrieve("This is a test description", self.testImage)
         logging.info(res)
         self.assertIsInstance(res, list)
-        self.assertEqual(len(res), self.numberOfNeighbors * 2)
-        self.assertEqual(set(res[0].keys()), {"id", "category", "distance"})
+        self.assertGreater(len(res), 0)
+        self.assertLessEqual(len(res), self.numberOfNeighbors * 2)
+        self.assertEqual(len({c["id"] for c in res}), len(res))
+        self.assertEqual(
+            set(res[0].keys()),
+            {"id", "category", "distance", "text_distance", "image_distance"},
+        )
 
     def test_rank(self):
         candidates = [("cat1_a", "cat2_a"), ("cat1_b", "cat2_b")]
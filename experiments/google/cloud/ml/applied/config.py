@@ -27,9 +27,11 @@ class Config:
     SECTION_PROJECT = "project"
     SECTION_GCS = "gcs"
     SECTION_MODELS = "models"
+    SECTION_EMBEDDINGS = "embeddings"
     SECTION_VECTORS = "vectors"
     SECTION_BIG_QUERY = "big_query"
     SECTION_CATEGORY = "category"
+    SECTION_RATE_LIMITS = "rate_limits"
     SECTION_TEST = "test"
 
     @staticmethod
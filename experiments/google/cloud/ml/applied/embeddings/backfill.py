@@ -0,0 +1,360 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Parallel, checkpointed bulk embedding backfill of the product table.
+
+Rows are streamed from the product table in id order, embedded in chunks by
+a bounded pool of workers using batched predict calls, and spooled to a
+local newline delimited JSON file. Every stage_rows rows the spool is
+appended to a staging table with a single load job, keeping a full catalog
+backfill well within the per table load job quota. Once every row has been
+embedded the staging table is merged into the product table in a single
+statement.
+
+Progress is checkpointed to a local file after each chunk is spooled, so a
+crashed run resumes after the last spooled id and loads what is left in the
+spool. Chunks spooled past the checkpoint before a crash, or a spool loaded
+but not yet removed, are staged again on resume, the merge keeps one record
+per id. Usage:
+
+    python -m google.cloud.ml.applied.embeddings.backfill [--all] [--restart]
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
+
+from google.cloud import bigquery
+
+from google.cloud.ml.applied.config import Config
+from google.cloud.ml.applied.embeddings import embeddings, projection
+from google.cloud.ml.applied.utils import utils
+
+bq = Config.SECTION_BIG_QUERY
+table_product = Config.value(bq, "product_table")
+column_id = Config.value(bq, "product_id_column")
+column_description = Config.value(bq, "product_description_column")
+column_image = Config.value(bq, "product_image_column")
+column_text_embedding = Config.value(bq, "product_text_embedding_column")
+column_image_embedding = Config.value(bq, "product_image_embedding_column")
+
+
+class ProductRow(NamedTuple):
+    id: str
+    description: Optional[str]
+    image: Optional[str]
+
+
+class Checkpoint:
+    """Last product id whose embedding has been durably staged."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_id = None
+        self.rows = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.last_id = state["last_id"]
+            self.rows = state["rows"]
+
+    def save(self, last_id: str, rows: int):
+        self.last_id, self.rows = last_id, self.rows + rows
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"last_id": self.last_id, "rows": self.rows}, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        self.last_id, self.rows = None, 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def chunked(rows: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    it = iter(rows)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+def embed_chunk(rows: list[ProductRow], dimension: int) -> list[dict]:
+    """Embed a chunk of rows, returning staging table records."""
+    rows = [r for r in rows if r.description or r.image]
+    results = embeddings.embed_many(
+        [embeddings.EmbeddingRequest(r.description, r.image) for r in rows],
+        dimension=dimension,
+    )
+    return [
+        {
+            column_id: row.id,
+            column_text_embedding: (
+                [] if res.text_embedding is None else res.text_embedding_list
+            ),
+            column_image_embedding: (
+                [] if res.image_embedding is None else res.image_embedding_list
+            ),
+        }
+        for row, res in zip(rows, results)
+    ]
+
+
+def run(
+    rows: Iterable[ProductRow],
+    embed_fn: Callable[[list[ProductRow]], list[dict]],
+    write_fn: Callable[[list[dict]], None],
+    checkpoint: Checkpoint,
+    workers: int = 8,
+    chunk_size: int = 250,
+) -> int:
+    """Embed rows with a bounded worker pool and write results in chunks.
+
+    Chunks may finish out of order, the checkpoint only advances past a
+    chunk once it and every chunk before it have been written.
+
+    Args:
+        rows: rows to embed, sorted by id
+        embed_fn: embeds a chunk of rows, e.g. embed_chunk
+        write_fn: durably writes the records of one chunk
+        checkpoint: progress tracker, saved after each contiguous chunk
+        workers: number of chunks embedded concurrently
+        chunk_size: rows per chunk
+
+    Returns:
+        number of rows written
+    """
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+    failed = threading.Event()
+    done = {}  # chunk index -> (last id, rows) for chunks past the watermark
+    state = {"next": 0, "rows": 0}
+
+    def process(index: int, chunk: list[ProductRow]):
+        try:
+            records = embed_fn(chunk)
+            write_fn(records)
+            with lock:
+                done[index] = (chunk[-1].id, len(records))
+                while state["next"] in done:
+                    last_id, n = done.pop(state["next"])
+                    checkpoint.save(last_id, n)
+                    state["next"] += 1
+                    state["rows"] += n
+                logging.info(f"Backfill checkpoint {checkpoint.last_id}")
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for index, chunk in enumerate(chunked(rows, chunk_size)):
+            slots.acquire()
+            if failed.is_set():
+                break
+            futures.append(pool.submit(process, index, chunk))
+        for future in futures:
+            future.result()
+    return state["rows"]
+
+
+def stream_rows(
+    client: bigquery.Client, after_id: Optional[str] = None, only_missing=True
+) -> Iterator[ProductRow]:
+    """Stream products in id order, optionally only those without embeddings."""
+    conditions = []
+    params = []
+    if after_id is not None:
+        conditions.append(f"{column_id} > @after_id")
+        params.append(bigquery.ScalarQueryParameter("after_id", "STRING", after_id))
+    if only_missing:
+        conditions.append(f"ARRAY_LENGTH({column_text_embedding}) = 0")
+    query = f"""
+    SELECT
+        {column_id},
+        {column_description},
+        {column_image}
+    FROM
+        `{table_product}`
+    {"WHERE " + " AND ".join(conditions) if conditions else ""}
+    ORDER BY {column_id}
+    """
+    job = client.query(query, bigquery.QueryJobConfig(query_parameters=params))
+    for row in job.result(page_size=10000):
+        yield ProductRow(row[column_id], row[column_description], row[column_image])
+
+
+class StagingWriter:
+    """Spools embedding records locally, stages them in batches, then merges them.
+
+    Args:
+        client: BigQuery client
+        staging_table: table the spool is appended to
+        spool_path: local newline delimited JSON file, kept across restarts
+        stage_rows: spooled rows that trigger a load job
+    """
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        staging_table: str,
+        spool_path: str,
+        stage_rows: int = 100000,
+    ):
+        self.client = client
+        self.staging_table = staging_table
+        self.spool_path = spool_path
+        self.stage_rows = stage_rows
+        self._lock = threading.Lock()
+        self.spooled = 0
+        if os.path.exists(spool_path):
+            with open(spool_path, "rb") as f:
+                self.spooled = sum(1 for _ in f)
+        self.job_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField(column_id, "STRING"),
+                bigquery.SchemaField(column_text_embedding, "FLOAT64", "REPEATED"),
+                bigquery.SchemaField(column_image_embedding, "FLOAT64", "REPEATED"),
+            ],
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+
+    def write(self, records: list[dict]):
+        """Durably spool records, loading the spool once it holds stage_rows."""
+        if not records:
+            return
+        lines = "".join(json.dumps(r) + "\n" for r in records)
+        with self._lock:
+            with open(self.spool_path, "a") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.spooled += len(records)
+            if self.spooled >= self.stage_rows:
+                self._load()
+
+    def flush(self):
+        """Load whatever is spooled into the staging table."""
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        if self.spooled:
+            with open(self.spool_path, "rb") as f:
+                self.client.load_table_from_file(
+                    f, self.staging_table, job_config=self.job_config
+                ).result()
+            logging.info(f"Staged {self.spooled} rows into {self.staging_table}")
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+        self.spooled = 0
+
+    def clear(self):
+        """Drop the spool and the staging table."""
+        with self._lock:
+            if os.path.exists(self.spool_path):
+                os.remove(self.spool_path)
+            self.spooled = 0
+        self.client.delete_table(self.staging_table, not_found_ok=True)
+
+    def merge_query(self) -> str:
+        # resumed runs stage some chunks twice, MERGE allows one source row per id
+        return f"""
+        MERGE `{table_product}` p
+        USING (
+            SELECT * FROM `{self.staging_table}`
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {column_id}) = 1
+        ) s
+        ON p.{column_id} = s.{column_id}
+        WHEN MATCHED THEN UPDATE SET
+            {column_text_embedding} = s.{column_text_embedding},
+            {column_image_embedding} = s.{column_image_embedding}
+        """
+
+    def merge(self):
+        """Copy staged embeddings into the product table and drop the staging table."""
+        self.flush()
+        self.client.query(self.merge_query()).result()
+        self.client.delete_table(self.staging_table, not_found_ok=True)
+
+
+def main(argv: Optional[list[str]] = None):
+    conf = Config.SECTION_EMBEDDINGS
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--all", action="store_true", help="re-embed rows that already have embeddings"
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore any existing checkpoint"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=Config.value(conf, "backfill_workers")
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=Config.value(conf, "backfill_chunk_size")
+    )
+    parser.add_argument(
+        "--checkpoint", default=Config.value(conf, "backfill_checkpoint")
+    )
+    parser.add_argument(
+        "--staging-table", default=f"{table_product}_embeddings_staging"
+    )
+    parser.add_argument(
+        "--stage-rows", type=int, default=Config.value(conf, "backfill_stage_rows")
+    )
+    # stored embeddings are raw model output, projected only when indexed
+    parser.add_argument(
+        "--dimension",
+        type=int,
+        default=projection.embedding_dimension(
+            Config.value(Config.SECTION_VECTORS, "dimension")
+        ),
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    client = utils.get_bq_client()
+    checkpoint = Checkpoint(args.checkpoint)
+    writer = StagingWriter(
+        client, args.staging_table, args.checkpoint + ".spool.jsonl", args.stage_rows
+    )
+    if args.restart:
+        checkpoint.clear()
+        writer.clear()
+    if checkpoint.last_id is not None:
+        logging.info(f"Resuming backfill after {checkpoint.last_id}")
+
+    written = run(
+        stream_rows(client, checkpoint.last_id, only_missing=not args.all),
+        lambda chunk: embed_chunk(chunk, args.dimension),
+        writer.write,
+        checkpoint,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+    )
+    logging.info(f"Embedded {written} rows, merging into {table_product}")
+    writer.merge()
+    checkpoint.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Embedding Backfill Unit Test."""
+
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from google.cloud.ml.applied.embeddings import backfill
+
+
+def rows(n: int, start: int = 0) -> list[backfill.ProductRow]:
+    return [backfill.ProductRow(f"{i:05d}", f"desc {i}", None) for i in range(start, n)]
+
+
+def embed_fn(chunk):
+    time.sleep(random.uniform(0, 0.01))  # finish out of order
+    return [{"id": r.id} for r in chunk]
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "checkpoint.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_run_writes_all_rows(self):
+        written = []
+        checkpoint = backfill.Checkpoint(self.path)
+        n = backfill.run(
+            rows(103), embed_fn, written.extend, checkpoint, workers=4, chunk_size=10
+        )
+        self.assertEqual(n, 103)
+        self.assertEqual(sorted(r["id"] for r in written), [r.id for r in rows(103)])
+        self.assertEqual(checkpoint.last_id, "00102")
+        self.assertEqual(backfill.Checkpoint(self.path).rows, 103)
+
+    def test_checkpoint_stops_at_first_failure(self):
+        def flaky(chunk):
+            if chunk[0].id == "00030":
+                raise RuntimeError("embedding failed")
+            return embed_fn(chunk)
+
+        checkpoint = backfill.Checkpoint(self.path)
+        with self.assertRaises(RuntimeError):
+            backfill.run(
+                rows(100), flaky, lambda _: None, checkpoint, workers=1, chunk_size=10
+            )
+        resumed = backfill.Checkpoint(self.path)
+        self.assertEqual(resumed.last_id, "00029")
+        self.assertEqual(resumed.rows, 30)
+
+    def test_resume_restages_chunks_past_checkpoint(self):
+        staged = []
+        written = threading.Event()
+
+        def write(records):
+            staged.extend(records)
+            if records[0]["id"] == "00040":
+                written.set()
+
+        def flaky(chunk):
+            if chunk[0].id == "00030":
+                # a later chunk is staged before this one fails
+                written.wait(5)
+                raise RuntimeError("embedding failed")
+            return embed_fn(chunk)
+
+        with self.assertRaises(RuntimeError):
+            backfill.run(
+                rows(100), flaky, write, backfill.Checkpoint(self.path), chunk_size=10
+            )
+        checkpoint = backfill.Checkpoint(self.path)
+        self.assertEqual(checkpoint.last_id, "00029")
+        backfill.run(
+            [r for r in rows(100) if r.id > checkpoint.last_id],
+            embed_fn,
+            write,
+            checkpoint,
+            chunk_size=10,
+        )
+        ids = [r["id"] for r in staged]
+        self.assertGreater(len(ids), 100)
+        self.assertEqual(sorted(set(ids)), [r.id for r in rows(100)])
+
+        # the merge keeps one staged record per id
+        client = mock.Mock()
+        spool = os.path.join(self.dir.name, "spool.jsonl")
+        backfill.StagingWriter(client, "staging", spool).merge()
+        query = client.query.call_args[0][0]
+        self.assertIn(
+            f"QUALIFY ROW_NUMBER() OVER (PARTITION BY {backfill.column_id}) = 1",
+            query,
+        )
+        client.delete_table.assert_called_once_with("staging", not_found_ok=True)
+
+    def test_staging_spool(self):
+        client = mock.Mock()
+        loaded = []
+
+        def load(f, *args, **kwargs):
+            loaded.append(f.read().decode("utf-8").splitlines())
+            return mock.Mock()
+
+        client.load_table_from_file.side_effect = load
+        spool = os.path.join(self.dir.name, "spool.jsonl")
+        writer = backfill.StagingWriter(client, "staging", spool, stage_rows=5)
+        writer.write([{"id": str(i)} for i in range(3)])
+        self.assertEqual(loaded, [])
+        writer.write([{"id": str(i)} for i in range(3, 6)])
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(len(loaded[0]), 6)
+        self.assertFalse(os.path.exists(spool))
+
+        # a restarted writer loads what an earlier run spooled
+        writer.write([{"id": "6"}])
+        resumed = backfill.StagingWriter(client, "staging", spool, stage_rows=5)
+        self.assertEqual(resumed.spooled, 1)
+        resumed.merge()
+        self.assertEqual(loaded[-1], ['{"id": "6"}'])
+        self.assertEqual(client.load_table_from_file.call_count, 2)
+        client.query.assert_called_once()
+
+    def test_chunked(self):
+        self.assertEqual(list(backfill.chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+
+if __name__ == "__main__":
+    unittest.main()
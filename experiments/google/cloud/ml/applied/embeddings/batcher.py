@@ -0,0 +1,136 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Micro-batching of concurrent embedding requests."""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+
+from google.cloud.ml.applied.utils import rate_limit
+
+_STOP = object()
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent requests into multi-instance predict calls.
+
+    Requests submitted from any thread are collected until either max_items
+    are waiting or max_wait_ms has passed since the first of them arrived.
+    The batch is then sent with a single call to embed_fn and each caller's
+    future is resolved with its own result. If the call fails with an error
+    that is not retryable, such as a bad instance rejected by the server,
+    the requests are sent again one at a time so only the bad ones fail.
+
+    Args:
+        embed_fn: embeds a list of requests, returning results in input order
+            e.g. EmbeddingPredictionClient.get_embeddings
+        max_items: maximum number of requests per batch
+        max_wait_ms: maximum time the first request of a batch waits for others
+        max_inflight: maximum number of batches being embedded concurrently
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[list[Any]], Sequence[Any]],
+        max_items: int = 25,
+        max_wait_ms: float = 5,
+        max_inflight: int = 8,
+    ):
+        self.embed_fn = embed_fn
+        self.max_items = max_items
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_inflight, thread_name_prefix="embedding-batch"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="embedding-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, request: Any) -> Future:
+        """Queue a request, the returned future resolves to its result."""
+        future = Future()
+        self._queue.put((request, future))
+        return future
+
+    def embed_many(self, requests: Sequence[Any]) -> list[Any]:
+        """Blocking helper with the same signature as embed_fn."""
+        futures = [self.submit(r) for r in requests]
+        return [f.result() for f in futures]
+
+    def close(self):
+        """Flush pending requests and stop the background thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while len(batch) < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._executor.submit(self._dispatch, batch)
+            if stop:
+                return
+
+    def _dispatch(self, batch: list[tuple[Any, Future]]):
+        batch = [(r, f) for r, f in batch if f.set_running_or_notify_cancel()]
+        if batch:
+            self._embed(batch)
+
+    def _embed(self, batch: list[tuple[Any, Future]]):
+        requests = [r for r, _ in batch]
+        futures = [f for _, f in batch]
+        logging.debug(f"Embedding batch of {len(requests)} coalesced requests")
+        try:
+            results = self.embed_fn(requests)
+        except Exception as e:
+            if len(batch) > 1 and not isinstance(e, rate_limit.RETRYABLE_ERRORS):
+                logging.debug(f"Batch failed with {e!r}, embedding one at a time")
+                for item in batch:
+                    self._embed([item])
+                return
+            for f in futures:
+                f.set_exception(e)
+            return
+        if len(results) != len(futures):
+            e = RuntimeError(
+                f"Expected {len(futures)} embeddings in batch, got {len(results)}"
+            )
+            for f in futures:
+                f.set_exception(e)
+            return
+        for f, res in zip(futures, results):
+            f.set_result(res)
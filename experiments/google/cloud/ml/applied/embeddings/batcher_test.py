@@ -0,0 +1,97 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Embedding Batcher Unit Test."""
+
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+from google.cloud.ml.applied.embeddings import batcher
+
+
+class EmbeddingBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def embed_fn(requests):
+            self.calls.append(list(requests))
+            return [r.upper() for r in requests]
+
+        self.embed_fn = embed_fn
+
+    def test_concurrent_requests_share_a_call(self):
+        b = batcher.EmbeddingBatcher(self.embed_fn, max_items=100, max_wait_ms=50)
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            res = list(pool.map(lambda r: b.submit(r).result(), ["a", "b", "c"] * 3))
+        b.close()
+        self.assertEqual(res, ["A", "B", "C"] * 3)
+        self.assertLess(len(self.calls), 9)
+
+    def test_max_items(self):
+        b = batcher.EmbeddingBatcher(self.embed_fn, max_items=2, max_wait_ms=50)
+        self.assertEqual(b.embed_many(["a", "b", "c", "d", "e"]), list("ABCDE"))
+        b.close()
+        self.assertTrue(all(len(c) <= 2 for c in self.calls))
+
+    def test_max_wait(self):
+        b = batcher.EmbeddingBatcher(self.embed_fn, max_items=100, max_wait_ms=5)
+        start = time.monotonic()
+        self.assertEqual(b.submit("a").result(), "A")
+        b.close()
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_errors_propagate(self):
+        def fail(requests):
+            raise ValueError("boom")
+
+        b = batcher.EmbeddingBatcher(fail, max_wait_ms=1)
+        with self.assertRaises(ValueError):
+            b.submit("a").result()
+        b.close()
+
+    def test_bad_request_fails_alone(self):
+        def embed_fn(requests):
+            self.calls.append(list(requests))
+            if "bad" in requests:
+                raise ValueError("invalid instance")
+            return [r.upper() for r in requests]
+
+        b = batcher.EmbeddingBatcher(embed_fn, max_items=100, max_wait_ms=50)
+        futures = [b.submit(r) for r in ["a", "bad", "c", "d"]]
+        b.close()
+        self.assertEqual([futures[i].result() for i in (0, 2, 3)], ["A", "C", "D"])
+        with self.assertRaisesRegex(ValueError, "invalid instance"):
+            futures[1].result()
+        self.assertEqual(self.calls[0], ["a", "bad", "c", "d"])
+
+    def test_retryable_errors_fail_the_batch(self):
+        def throttled(requests):
+            self.calls.append(list(requests))
+            raise exceptions.TooManyRequests("quota")
+
+        b = batcher.EmbeddingBatcher(throttled, max_items=100, max_wait_ms=50)
+        futures = [b.submit(r) for r in ["a", "b"]]
+        b.close()
+        for f in futures:
+            with self.assertRaises(exceptions.TooManyRequests):
+                f.result()
+        self.assertEqual(len(self.calls), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
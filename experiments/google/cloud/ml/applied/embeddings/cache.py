@@ -0,0 +1,173 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Content addressed two tier (memory LRU + SQLite) embedding cache."""
+
+import hashlib
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Sequence
+
+import numpy as np
+
+_HEADER = struct.Struct("<ii")
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """Collapse whitespace and apply the same truncation as the embedding API."""
+    if not text:
+        return ""
+    return " ".join(text.split())[:1023]
+
+
+def image_identity(image: Optional[str], base64: bool = False) -> str:
+    """Identify an image by GCS URI or by a digest of its content."""
+    if not image:
+        return ""
+    if base64:
+        return "sha256:" + hashlib.sha256(image.encode("utf-8")).hexdigest()
+    if image.lower().startswith("gs://"):
+        return image
+    with open(image, "rb") as f:
+        return "sha256:" + hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def cache_key(
+    model: str,
+    text: Optional[str],
+    image: Optional[str],
+    base64: bool = False,
+    dimension: Optional[int] = None,
+    preprocess: str = "",
+) -> str:
+    """Hash of model, output dimension, normalized text and image identity.
+
+    preprocess identifies the image preprocessing settings, see
+    preprocess.ImagePreprocessor.version, and only applies to keys with an
+    image.
+    """
+    h = hashlib.sha256()
+    for part in (
+        model,
+        str(dimension or ""),
+        normalize_text(text),
+        image_identity(image, base64),
+        preprocess if image else "",
+    ):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _encode(embeddings: Sequence[Optional[np.ndarray]]) -> bytes:
+    header = [-1 if e is None else len(e) for e in embeddings]
+    body = b"".join(
+        np.asarray(e, dtype=np.float32).tobytes() for e in embeddings if e is not None
+    )
+    return _HEADER.pack(*header) + body
+
+
+def _decode(value: bytes) -> tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    offset = _HEADER.size
+    out = []
+    for n in _HEADER.unpack_from(value):
+        if n < 0:
+            out.append(None)
+            continue
+        out.append(np.frombuffer(value, dtype=np.float32, count=n, offset=offset))
+        offset += 4 * n
+    return tuple(out)
+
+
+class EmbeddingCache:
+    """Bounded in-memory LRU in front of an optional persistent SQLite store.
+
+    Values are (text_embedding, image_embedding) pairs of float32 arrays,
+    either of which may be None. Keys are produced by cache_key().
+    """
+
+    def __init__(self, max_entries: int = 4096, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._disk_hits = self._misses = self._evictions = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, value BLOB)"
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self._hits += 1
+                return self._lru[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._disk_hits += 1
+                    value = _decode(row[0])
+                    self._remember(key, value)
+                    return value
+            self._misses += 1
+            return None
+
+    def put(self, key: str, value: tuple):
+        with self._lock:
+            self._remember(key, tuple(value))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, value) VALUES (?, ?)",
+                    (key, _encode(value)),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, value: tuple):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+            self._evictions += 1
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                disk_hits=self._disk_hits,
+                misses=self._misses,
+                evictions=self._evictions,
+            )
+
+    def clear(self):
+        """Drop every entry from both tiers. Counters are preserved."""
+        with self._lock:
+            self._lru.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
@@ -0,0 +1,84 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Embedding Cache Unit Test."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.embeddings import cache
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def test_key_normalizes_text(self):
+        a = cache.cache_key("model", "  a test\n description ", None)
+        b = cache.cache_key("model", "a test description", None)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, cache.cache_key("other", "a test description", None))
+        self.assertNotEqual(
+            a, cache.cache_key("model", "a test description", None, dimension=256)
+        )
+
+    def test_key_image_identity(self):
+        a = cache.cache_key("model", "desc", "gs://bucket/a.jpg")
+        b = cache.cache_key("model", "desc", "gs://bucket/b.jpg")
+        c = cache.cache_key("model", "desc", "aGVsbG8=", base64=True)
+        self.assertEqual(len({a, b, c}), 3)
+
+    def test_key_preprocess(self):
+        image = "gs://bucket/a.jpg"
+        a = cache.cache_key("model", "desc", image, preprocess="512:JPEG:85")
+        b = cache.cache_key("model", "desc", image, preprocess="256:JPEG:85")
+        self.assertNotEqual(a, b)
+        self.assertNotEqual(a, cache.cache_key("model", "desc", image))
+        # text only keys are unaffected
+        self.assertEqual(
+            cache.cache_key("model", "desc", None, preprocess="512:JPEG:85"),
+            cache.cache_key("model", "desc", None),
+        )
+
+    def test_lru_eviction(self):
+        store = cache.EmbeddingCache(max_entries=2)
+        store.put("a", ([1.0], None))
+        store.put("b", ([2.0], None))
+        store.get("a")
+        store.put("c", ([3.0], None))
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.get("a"), ([1.0], None))
+        self.assertEqual(store.stats(), cache.CacheStats(2, 0, 1, 1))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "cache.db")
+            store = cache.EmbeddingCache(max_entries=1, path=path)
+            store.put("a", (np.array([0.5, 0.25], np.float32), np.ones(1)))
+            store.put("b", (np.array([2.0], np.float32), None))
+            text, image = store.get("a")
+            self.assertEqual(text.dtype, np.float32)
+            self.assertEqual(text.tolist(), [0.5, 0.25])
+            self.assertEqual(image.tolist(), [1.0])
+            self.assertEqual(store.stats().disk_hits, 1)
+
+            reopened = cache.EmbeddingCache(max_entries=1, path=path)
+            text, image = reopened.get("b")
+            self.assertEqual(text.tolist(), [2.0])
+            self.assertIsNone(image)
+
+
+if __name__ == "__main__":
+    unittest.main()
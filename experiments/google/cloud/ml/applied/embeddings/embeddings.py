@@ -15,24 +15,83 @@
 
 """Invoke Vertex Embedding API."""
 
+import asyncio
 import logging
-from functools import cache
-from typing import NamedTuple, Optional, Sequence
+import threading
+import weakref
+from base64 import b64encode
+from functools import cache, partial
+from typing import Callable, NamedTuple, Optional, Sequence
 
+import numpy as np
 from google.cloud import aiplatform
 from google.protobuf import struct_pb2
 
 from google.cloud.ml.applied.config import Config
+from google.cloud.ml.applied.embeddings import batcher
+from google.cloud.ml.applied.embeddings import cache as embedding_cache
+from google.cloud.ml.applied.embeddings import preprocess
+from google.cloud.ml.applied.utils import rate_limit, singleflight
+
+embeddings_conf = Config.SECTION_EMBEDDINGS
+embedding_model = Config.value(Config.SECTION_MODELS, "embedding")
+embedding_dimension = Config.value(Config.SECTION_MODELS, "embedding_dimension")
+supported_dimensions = (128, 256, 512, 1408)
+max_instances_per_request = Config.value(embeddings_conf, "max_instances_per_request")
+max_concurrency = Config.value(embeddings_conf, "max_concurrency")
+coalesce_window_ms = Config.value(embeddings_conf, "coalesce_window_ms")
+flights = singleflight.SingleFlight()
 
 
 class EmbeddingResponse(NamedTuple):
-    text_embedding: Sequence[float]
-    image_embedding: Sequence[float]
+    """Embeddings as contiguous float32 numpy arrays, None if not requested."""
+
+    text_embedding: Optional[np.ndarray]
+    image_embedding: Optional[np.ndarray]
+
+    @property
+    def text_embedding_list(self) -> Optional[list[float]]:
+        return None if self.text_embedding is None else self.text_embedding.tolist()
+
+    @property
+    def image_embedding_list(self) -> Optional[list[float]]:
+        return None if self.image_embedding is None else self.image_embedding.tolist()
+
+
+def as_vector(values: Sequence[float]) -> np.ndarray:
+    """Read-only contiguous float32 view of an embedding."""
+    vector = np.ascontiguousarray(values, dtype=np.float32)
+    vector.flags.writeable = False
+    return vector
+
+
+class EmbeddingRequest(NamedTuple):
+    """A single text and/or image to embed, see embed() for field semantics."""
+
+    text: Optional[str] = None
+    image: Optional[str] = None
+    base64: bool = False
+
+
+@cache
+def get_preprocessor() -> Optional[preprocess.ImagePreprocessor]:
+    """Shared image preprocessor, None when disabled in app.toml."""
+    max_edge = Config.value(embeddings_conf, "image_max_edge")
+    if not max_edge:
+        return None
+    return preprocess.ImagePreprocessor(
+        max_edge=max_edge,
+        image_format=Config.value(embeddings_conf, "image_format"),
+        quality=Config.value(embeddings_conf, "image_quality"),
+        cache_entries=Config.value(embeddings_conf, "image_cache_entries"),
+    )
 
 
 class EmbeddingPredictionClient:
     """Wrapper around Prediction Service Client."""
 
+    client_class = aiplatform.gapic.PredictionServiceClient
+
     def __init__(self):
         project = Config.value(Config.SECTION_PROJECT, "id")
         location = Config.value(Config.SECTION_PROJECT, "location")
@@ -41,33 +100,38 @@ class EmbeddingPredictionClient:
         client_options = {"api_endpoint": api_regional_endpoint}
         # Initialize client that will be used to create and send requests.
         # This client only needs to be created once, and can be reused for multiple requests.
-        self.client = aiplatform.gapic.PredictionServiceClient(
-            client_options=client_options
-        )
+        self.client = self.client_class(client_options=client_options)
         self.location = location
         self.project = project
+        self.preprocessor = get_preprocessor()
+        self.limiter = rate_limit.get_limiter("embedding")
+        self.model = embedding_model
 
-    def get_embedding(
-        self,
-        text: Optional[str] = None,
-        image: Optional[str] = None,
-        base64: bool = False,
-    ):
-        """Invoke Vertex multimodal embedding API.
+    @property
+    def endpoint(self) -> str:
+        return (
+            f"projects/{self.project}/locations/{self.location}"
+            f"/publishers/google/models/{self.model}"
+        )
 
-        You can pass text and/or image. If neither is passed will raise exception
+    @staticmethod
+    def build_parameters(dimension: int) -> struct_pb2.Value:
+        """Prediction parameters requesting embeddings of the given dimension."""
+        if dimension not in supported_dimensions:
+            raise ValueError(
+                f"Embedding dimension {dimension} is not one of {supported_dimensions}"
+            )
+        parameters = struct_pb2.Value()
+        parameters.struct_value.fields["dimension"].number_value = dimension
+        return parameters
 
-        Args:
-          text: text to embed
-          image: can be local file path, GCS URI or base64 encoded image
-          base64: True indicates image is base64. False (default) will be
-            interpreted as image path (either local or GCS)
-        Returns:
-        named tuple with the following attributes:
-          text_embedding: 1408 dimension vector of type Sequence[float]
-          image_embedding: 1408 dimension vector of type Sequence[float] OR None if
-            no image provide
+    def build_instance(self, request: EmbeddingRequest) -> struct_pb2.Struct:
+        """Convert an EmbeddingRequest into a prediction instance.
+
+        Local and base64 images are downsized first when image preprocessing
+        is enabled, see [embeddings] image_max_edge in app.toml.
         """
+        text, image = request.text, request.image
         if not text and not image:
             raise ValueError("At least one of text or image_bytes must be specified.")
 
@@ -82,67 +146,385 @@ class EmbeddingPredictionClient:
 
         if image:
             image_struct = instance.fields["image"].struct_value
-            if base64:
+            processed = (
+                self.preprocessor.process(image, request.base64)
+                if self.preprocessor
+                else None
+            )
+            if processed:
+                image_struct.fields["bytesBase64Encoded"].string_value = processed.data
+            elif request.base64:
                 image_struct.fields["bytesBase64Encoded"].string_value = image
             elif image.lower().startswith("gs://"):
                 image_struct.fields["gcsUri"].string_value = image
             else:
                 with open(image, "rb") as f:
                     image_bytes = f.read()
-                encoded_content = base64.b64encode(image_bytes).decode("utf-8")
+                encoded_content = b64encode(image_bytes).decode("utf-8")
                 image_struct.fields["bytesBase64Encoded"].string_value = encoded_content
+        return instance
 
-        instances = [instance]
-
-        # TODO - THIS SHOULD NOT BE HARD CODED
-
-        endpoint = (
-            f"projects/{self.project}/locations/{self.location}"
-            "/publishers/google/models/multimodalembedding@001"
-        )
-        response = self.client.predict(endpoint=endpoint, instances=instances)
-
+    @staticmethod
+    def parse_prediction(request: EmbeddingRequest, prediction) -> EmbeddingResponse:
+        """Convert a single prediction into an EmbeddingResponse."""
         text_embedding = None
-        if text:
-            text_emb_value = response.predictions[0]["textEmbedding"]
-            text_embedding = [v for v in text_emb_value]
+        if request.text:
+            text_embedding = as_vector(prediction["textEmbedding"])
 
         image_embedding = None
-        if image:
-            image_emb_value = response.predictions[0]["imageEmbedding"]
-            image_embedding = [v for v in image_emb_value]
+        if request.image:
+            image_embedding = as_vector(prediction["imageEmbedding"])
 
         return EmbeddingResponse(
             text_embedding=text_embedding, image_embedding=image_embedding
         )
 
+    def get_embedding(
+        self,
+        text: Optional[str] = None,
+        image: Optional[str] = None,
+        base64: bool = False,
+        dimension: int = embedding_dimension,
+    ):
+        """Invoke Vertex multimodal embedding API.
+
+        You can pass text and/or image. If neither is passed will raise exception
+
+        Args:
+          text: text to embed
+          image: can be local file path, GCS URI or base64 encoded image
+          base64: True indicates image is base64. False (default) will be
+            interpreted as image path (either local or GCS)
+          dimension: size of the returned vectors, one of 128, 256, 512 or 1408
+        Returns:
+        named tuple with the following attributes:
+          text_embedding: float32 numpy array of length dimension
+          image_embedding: float32 numpy array of length dimension OR None if
+            no image provide
+        """
+        return self.get_embeddings(
+            [EmbeddingRequest(text, image, base64)], dimension=dimension
+        )[0]
+
+    def get_embeddings(
+        self,
+        requests: Sequence[EmbeddingRequest],
+        batch_size: int = max_instances_per_request,
+        dimension: int = embedding_dimension,
+    ) -> list[EmbeddingResponse]:
+        """Invoke Vertex multimodal embedding API for many requests.
+
+        Requests are packed into predict calls of at most batch_size instances.
+
+        Args:
+          requests: texts and/or images to embed
+          batch_size: maximum number of instances sent per predict call
+          dimension: size of the returned vectors, one of 128, 256, 512 or 1408
+
+        Returns:
+          list of EmbeddingResponse in the same order as requests
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+        parameters = self.build_parameters(dimension)
+        requests = [EmbeddingRequest(*r) for r in requests]
+        instances = [self.build_instance(r) for r in requests]
+        responses = []
+        for i in range(0, len(instances), batch_size):
+            response = self.limiter.call(
+                self.client.predict,
+                endpoint=self.endpoint,
+                instances=instances[i : i + batch_size],
+                parameters=parameters,
+            )
+            responses.extend(
+                self.parse_prediction(r, p)
+                for r, p in zip(requests[i : i + batch_size], response.predictions)
+            )
+        return responses
+
+
+class AsyncEmbeddingPredictionClient(EmbeddingPredictionClient):
+    """Wrapper around Prediction Service Async Client.
+
+    Same interface as EmbeddingPredictionClient but get_embedding and
+    get_embeddings are coroutines. At most max_concurrency predict calls are
+    in flight at any time.
+    """
+
+    client_class = aiplatform.gapic.PredictionServiceAsyncClient
+
+    def __init__(self, max_concurrency: int = max_concurrency):
+        super().__init__()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def get_embedding(
+        self,
+        text: Optional[str] = None,
+        image: Optional[str] = None,
+        base64: bool = False,
+        dimension: int = embedding_dimension,
+    ) -> EmbeddingResponse:
+        """See EmbeddingPredictionClient.get_embedding."""
+        responses = await self.get_embeddings(
+            [EmbeddingRequest(text, image, base64)], dimension=dimension
+        )
+        return responses[0]
+
+    async def get_embeddings(
+        self,
+        requests: Sequence[EmbeddingRequest],
+        batch_size: int = max_instances_per_request,
+        dimension: int = embedding_dimension,
+    ) -> list[EmbeddingResponse]:
+        """See EmbeddingPredictionClient.get_embeddings.
+
+        Batches are sent concurrently, bounded by the client semaphore.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+        parameters = self.build_parameters(dimension)
+        requests = [EmbeddingRequest(*r) for r in requests]
+        if any(r.image for r in requests):
+            # file reads, base64 and image preprocessing stay off the event loop
+            instances = await asyncio.to_thread(
+                lambda: [self.build_instance(r) for r in requests]
+            )
+        else:
+            instances = [self.build_instance(r) for r in requests]
+
+        async def predict(start: int) -> list[EmbeddingResponse]:
+            async with self.semaphore:
+                response = await self.limiter.acall(
+                    self.client.predict,
+                    endpoint=self.endpoint,
+                    instances=instances[start : start + batch_size],
+                    parameters=parameters,
+                )
+            return [
+                self.parse_prediction(r, p)
+                for r, p in zip(
+                    requests[start : start + batch_size], response.predictions
+                )
+            ]
+
+        batches = await asyncio.gather(
+            *[predict(i) for i in range(0, len(instances), batch_size)]
+        )
+        return [res for batch in batches for res in batch]
+
 
 @cache
 def get_client(project):
     return EmbeddingPredictionClient()
 
 
+@cache
+def get_batcher(project, dimension) -> Optional[batcher.EmbeddingBatcher]:
+    """Request coalescer in front of the client, None when disabled in app.toml."""
+    if not coalesce_window_ms:
+        return None
+    return batcher.EmbeddingBatcher(
+        partial(get_client(project).get_embeddings, dimension=dimension),
+        max_items=Config.value(embeddings_conf, "coalesce_max_items"),
+        max_wait_ms=coalesce_window_ms,
+        max_inflight=Config.value(embeddings_conf, "coalesce_max_inflight"),
+    )
+
+
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_async_clients_lock = threading.Lock()
+
+
+def get_async_client(project) -> AsyncEmbeddingPredictionClient:
+    """Async client for the running event loop.
+
+    gRPC asyncio channels are bound to the loop they are created on, so one
+    client is kept per (project, loop). Clients are dropped with their loop,
+    and once it is closed, as they hold references to it.
+    """
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        for closed in [other for other in _async_clients if other.is_closed()]:
+            del _async_clients[closed]
+        clients = _async_clients.setdefault(loop, {})
+        if project not in clients:
+            clients[project] = AsyncEmbeddingPredictionClient()
+        return clients[project]
+
+
+@cache
+def get_cache() -> Optional[embedding_cache.EmbeddingCache]:
+    """Shared embedding cache, None when disabled in app.toml."""
+    if not Config.value(embeddings_conf, "cache_enabled"):
+        return None
+    return embedding_cache.EmbeddingCache(
+        max_entries=Config.value(embeddings_conf, "cache_max_entries"),
+        path=Config.value(embeddings_conf, "cache_path") or None,
+    )
+
+
+def _cache_key(
+    model: str, dimension: int, text: Optional[str], image: Optional[str], base64: bool
+) -> str:
+    preprocessor = get_preprocessor()
+    return embedding_cache.cache_key(
+        model,
+        text,
+        image,
+        base64,
+        dimension,
+        preprocessor.version if preprocessor else "",
+    )
+
+
+def _flight_key(
+    model: str, dimension: int, text: Optional[str], image: Optional[str], base64: bool
+) -> str:
+    """Key shared by identical concurrent calls.
+
+    Local images are only hashed when the embedding cache is enabled, the
+    path identifies them otherwise.
+    """
+    if get_cache() is None:
+        return singleflight.fingerprint(model, dimension, text, image, base64)
+    return _cache_key(model, dimension, text, image, base64)
+
+
+def _cache_lookup(
+    model: str, dimension: int, requests: Sequence[EmbeddingRequest]
+) -> tuple[list[Optional[str]], list[Optional[tuple]]]:
+    """Return (keys, cached results) for requests, results are None on a miss."""
+    store = get_cache()
+    if store is None:
+        return [None] * len(requests), [None] * len(requests)
+    keys = [_cache_key(model, dimension, r.text, r.image, r.base64) for r in requests]
+    return keys, [store.get(k) for k in keys]
+
+
+def _cache_fill(
+    keys: list[Optional[str]],
+    results: list[Optional[tuple]],
+    misses: list[int],
+    fetched: list[EmbeddingResponse],
+) -> list[EmbeddingResponse]:
+    """Merge fetched responses for misses into results and the cache."""
+    store = get_cache()
+    for i, res in zip(misses, fetched):
+        if store is not None:
+            store.put(keys[i], res)
+        results[i] = res
+    return [EmbeddingResponse(*res) for res in results]
+
+
+def _cached_embeddings(
+    model: str,
+    dimension: int,
+    requests: Sequence[EmbeddingRequest],
+    fetch: Callable[[list[EmbeddingRequest]], list[EmbeddingResponse]],
+) -> list[EmbeddingResponse]:
+    """Serve requests from the cache, embedding only the misses with fetch."""
+    requests = [EmbeddingRequest(*r) for r in requests]
+    keys, results = _cache_lookup(model, dimension, requests)
+    misses = [i for i, res in enumerate(results) if res is None]
+    fetched = fetch([requests[i] for i in misses]) if misses else []
+    return _cache_fill(keys, results, misses, fetched)
+
+
 def embed(
     text: str,
     image: Optional[str] = None,
     base64: bool = False,
     project: str = Config.value("project", "id"),
+    dimension: int = embedding_dimension,
 ) -> EmbeddingResponse:
     """Invoke vertex multimodal embedding API.
 
+    Responses are served from the embedding cache when the same text, image
+    and model have been embedded before. Concurrent identical calls share a
+    single request, and distinct concurrent calls are coalesced into
+    multi-instance predict calls, see [embeddings] coalesce_window_ms in
+    app.toml.
+
     Args:
       text: text to embed
       image: can be local file path, GCS URI or base64 encoded image
       base64: True indicates image is base64. False (default) will be
           interpreted as image path (either local or GCS)
       project: GCP Project ID
+      dimension: size of the returned vectors, one of 128, 256, 512 or 1408.
+        Defaults to [models] embedding_dimension in app.toml
 
     Returns:
       named tuple with the following attributes:
-        text_embedding: 1408 dimension vector of type Sequence[float]
-        image_embedding: 1408 dimension vector of type Sequence[float] OR None if
+        text_embedding: float32 numpy array of length dimension
+        image_embedding: float32 numpy array of length dimension OR None if
           no image provide
     """
     client = get_client(project)
-    response = client.get_embedding(text=text, image=image, base64=base64)
-    return response
+    coalescer = get_batcher(project, dimension)
+    fetch = (
+        coalescer.embed_many
+        if coalescer
+        else partial(client.get_embeddings, dimension=dimension)
+    )
+    request = EmbeddingRequest(text, image, base64)
+    return flights.do(
+        _flight_key(client.model, dimension, text, image, base64),
+        lambda: _cached_embeddings(client.model, dimension, [request], fetch)[0],
+    )
+
+
+def embed_many(
+    items: Sequence[EmbeddingRequest],
+    project: str = Config.value("project", "id"),
+    dimension: int = embedding_dimension,
+) -> list[EmbeddingResponse]:
+    """Invoke vertex multimodal embedding API for many items at once.
+
+    Items are packed into as few predict calls as the per request instance
+    limit (app.toml [embeddings] max_instances_per_request) allows. Items
+    already in the embedding cache are not sent.
+
+    Args:
+      items: EmbeddingRequest (or equivalent (text, image, base64) tuples)
+      project: GCP Project ID
+      dimension: size of the returned vectors, see embed()
+
+    Returns:
+      list of EmbeddingResponse, one per item and in the same order as items
+    """
+    client = get_client(project)
+    fetch = partial(client.get_embeddings, dimension=dimension)
+    return _cached_embeddings(client.model, dimension, items, fetch)
+
+
+async def aembed(
+    text: str,
+    image: Optional[str] = None,
+    base64: bool = False,
+    project: str = Config.value("project", "id"),
+    dimension: int = embedding_dimension,
+) -> EmbeddingResponse:
+    """Asyncio version of embed(), see embed() for arguments and return value."""
+    client = get_async_client(project)
+    requests = [EmbeddingRequest(text, image, base64)]
+
+    async def run(fn, *args):
+        # cache keys of local images hash the file
+        return await asyncio.to_thread(fn, *args) if image else fn(*args)
+
+    async def fetch() -> EmbeddingResponse:
+        keys, results = await run(_cache_lookup, client.model, dimension, requests)
+        misses = [i for i, res in enumerate(results) if res is None]
+        fetched = (
+            await client.get_embeddings(requests, dimension=dimension) if misses else []
+        )
+        return _cache_fill(keys, results, misses, fetched)[0]
+
+    return await flights.ado(
+        await run(_flight_key, client.model, dimension, text, image, base64),
+        fetch,
+    )
@@ -20,12 +20,18 @@ the expected format. This integration test assumes:
 -The appropriate variables have been set in config.py
 -The test is run from an environment that has permission to call the API
 
+OfflineEmbeddingsTest runs against a fake prediction service instead.
+
 https://cloud.google.com/vertex-ai/docs/generative-ai/embeddings/get-multimodal-embeddings
 """
 
+import asyncio
 import unittest
+from unittest import mock
+
+import numpy as np
 
-from google.cloud.ml.applied.embeddings import embeddings
+from google.cloud.ml.applied.embeddings import cache, embeddings
 
 from google.cloud.ml.applied.config import Config
 
@@ -36,6 +42,8 @@ class EmbeddingsTest(unittest.TestCase):
             "This is a test description",
         )
         self.assertEqual(len(res.text_embedding), 1408)
+        self.assertEqual(res.text_embedding.dtype, np.float32)
+        self.assertEqual(len(res.text_embedding_list), 1408)
         self.assertIsNone(res.image_embedding)
 
     def test_embeddings_api_long_text(self):
@@ -74,6 +82,172 @@ class EmbeddingsTest(unittest.TestCase):
         self.assertEqual(len(res.text_embedding), 1408)
         self.assertEqual(len(res.image_embedding), 1408)
 
+    def test_embeddings_api_dimension(self):
+        res = embeddings.embed(
+            "This is a test description",
+            Config.value(Config.SECTION_TEST, "gcs_image"),
+            dimension=256,
+        )
+        self.assertEqual(len(res.text_embedding), 256)
+        self.assertEqual(len(res.image_embedding), 256)
+
+    def test_embed_many(self):
+        items = [
+            embeddings.EmbeddingRequest(text=f"This is test description {i}")
+            for i in range(embeddings.max_instances_per_request + 1)
+        ]
+        items.append(
+            embeddings.EmbeddingRequest(
+                "This is a test description",
+                Config.value(Config.SECTION_TEST, "gcs_image"),
+            )
+        )
+        res = embeddings.embed_many(items)
+        self.assertEqual(len(res), len(items))
+        self.assertEqual(len(res[0].text_embedding), 1408)
+        self.assertIsNone(res[0].image_embedding)
+        self.assertEqual(len(res[-1].image_embedding), 1408)
+
+    def test_aembed(self):
+        res = asyncio.run(
+            embeddings.aembed(
+                "This is a test description",
+                Config.value(Config.SECTION_TEST, "gcs_image"),
+            )
+        )
+        self.assertEqual(len(res.text_embedding), 1408)
+        self.assertEqual(len(res.image_embedding), 1408)
+
+    def test_async_client_per_loop(self):
+        async def clients():
+            return embeddings.get_async_client("a"), embeddings.get_async_client("a")
+
+        # like gRPC channels, the stand-in clients reference their loop
+        with mock.patch.object(
+            embeddings,
+            "AsyncEmbeddingPredictionClient",
+            side_effect=lambda: mock.Mock(loop=asyncio.get_running_loop()),
+        ):
+            first, again = asyncio.run(clients())
+            second, _ = asyncio.run(clients())
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+        # the client of the closed first loop was released
+        self.assertEqual(
+            [
+                c
+                for clients in embeddings._async_clients.values()
+                for c in clients.values()
+            ],
+            [second],
+        )
+
+
+class FakePredictionService:
+    """Stands in for the Vertex prediction client.
+
+    Text "t<n>" embeds to a vector of n, image "gs://<n>" to a vector of -n.
+    """
+
+    def __init__(self, client_options=None):
+        self.calls = []
+
+    def predict(self, endpoint, instances, parameters):
+        dimension = int(parameters.struct_value.fields["dimension"].number_value)
+        self.calls.append((len(instances), dimension))
+        predictions = []
+        for instance in instances:
+            prediction = {}
+            if "text" in instance.fields:
+                n = float(instance.fields["text"].string_value[1:])
+                prediction["textEmbedding"] = [n] * dimension
+            if "image" in instance.fields:
+                uri = instance.fields["image"].struct_value.fields["gcsUri"]
+                prediction["imageEmbedding"] = [
+                    -float(uri.string_value[5:])
+                ] * dimension
+            predictions.append(prediction)
+        return mock.Mock(predictions=predictions)
+
+
+class OfflineEmbeddingsTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch.object(
+            embeddings.EmbeddingPredictionClient,
+            "client_class",
+            FakePredictionService,
+        ):
+            self.client = embeddings.EmbeddingPredictionClient()
+        self.calls = self.client.client.calls
+        self.cache = cache.EmbeddingCache()
+        for name, value in (
+            ("get_client", self.client),
+            ("get_cache", self.cache),
+            ("get_batcher", None),
+            ("get_preprocessor", None),
+        ):
+            patcher = mock.patch.object(embeddings, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_batches_in_order(self):
+        requests = [
+            embeddings.EmbeddingRequest(f"t{i}", f"gs://{i}" if i % 2 else None)
+            for i in range(5)
+        ]
+        res = self.client.get_embeddings(requests, batch_size=2, dimension=128)
+        self.assertEqual([n for n, _ in self.calls], [2, 2, 1])
+        self.assertEqual([r.text_embedding[0] for r in res], [0, 1, 2, 3, 4])
+        self.assertEqual(
+            [None if r.image_embedding is None else r.image_embedding[0] for r in res],
+            [None, -1, None, -3, None],
+        )
+
+    def test_cache_hits_merged_with_misses(self):
+        items = [(f"t{i}",) for i in range(6)]
+        embeddings.embed_many(items[1::2], dimension=128)
+        self.calls.clear()
+        res = embeddings.embed_many(items, dimension=128)
+        # only the misses are sent, in one call
+        self.assertEqual(self.calls, [(3, 128)])
+        self.assertEqual([r.text_embedding[0] for r in res], list(range(6)))
+        self.assertEqual(self.cache.stats().hits, 3)
+        self.calls.clear()
+        self.assertEqual(embeddings.embed("t4", dimension=128).text_embedding[0], 4)
+        self.assertEqual(self.calls, [])
+
+    def test_numpy_responses(self):
+        res = embeddings.embed("t2", "gs://5", dimension=256)
+        for vector, value in ((res.text_embedding, 2), (res.image_embedding, -5)):
+            self.assertIsInstance(vector, np.ndarray)
+            self.assertEqual((vector.dtype, vector.shape), (np.float32, (256,)))
+            self.assertTrue(vector.flags.c_contiguous)
+            self.assertFalse(vector.flags.writeable)
+            self.assertEqual(vector[0], value)
+        self.assertEqual(res.text_embedding_list, [2.0] * 256)
+        self.assertIsNone(embeddings.embed("t2", dimension=256).image_embedding)
+        # served from the cache in the same shape
+        self.assertEqual(
+            embeddings.embed("t2", "gs://5", dimension=256).image_embedding.shape,
+            (256,),
+        )
+
+    def test_dimension_passed_through(self):
+        for dimension in (128, 512):
+            self.assertEqual(
+                len(embeddings.embed("t1", dimension=dimension).text_embedding),
+                dimension,
+            )
+        res = embeddings.embed_many([("t1",), ("t2",)], dimension=1408)
+        self.assertEqual([len(r.text_embedding) for r in res], [1408, 1408])
+        # each dimension is requested and cached separately
+        self.assertEqual(self.calls, [(1, 128), (1, 512), (2, 1408)])
+        self.assertEqual(
+            len(embeddings.embed("t1").text_embedding), embeddings.embedding_dimension
+        )
+        with self.assertRaisesRegex(ValueError, "not one of"):
+            embeddings.embed("t1", dimension=100)
+
 
 if __name__ == "__main__":
     unittest.main()
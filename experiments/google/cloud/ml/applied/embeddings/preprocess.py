@@ -0,0 +1,151 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Downsize and re-encode images before sending them for embedding."""
+
+import base64
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+
+class PreprocessResult(NamedTuple):
+    data: str  # base64 encoded image to send
+    bytes_in: int
+    bytes_out: int
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+
+class PreprocessStats(NamedTuple):
+    images: int
+    cache_hits: int
+    bytes_in: int
+    bytes_out: int
+
+
+class ImagePreprocessor:
+    """Decode, downsize to max_edge and re-encode images.
+
+    The multimodal embedding model works at a much lower resolution than
+    typical product photos, so there is no point sending full size images.
+    Results are cached by a digest of the source bytes. If re-encoding does
+    not make the payload smaller the original bytes are kept.
+
+    Args:
+        max_edge: maximum width and height in pixels after resizing
+        image_format: Pillow format name used to re-encode e.g. JPEG or WEBP
+        quality: encoder quality setting (1-100)
+        cache_entries: number of processed images kept in memory
+    """
+
+    def __init__(
+        self,
+        max_edge: int,
+        image_format: str = "JPEG",
+        quality: int = 85,
+        cache_entries: int = 256,
+    ):
+        try:
+            from PIL import Image
+        except ImportError as e:
+            raise ImportError(
+                "Image preprocessing requires Pillow, run `pip install Pillow` "
+                "or set [embeddings] image_max_edge = 0 in app.toml"
+            ) from e
+        self._image = Image
+        self.max_edge = max_edge
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.cache_entries = cache_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._images = self._cache_hits = self._bytes_in = self._bytes_out = 0
+
+    @property
+    def version(self) -> str:
+        """Settings that change the processed image, part of embedding cache keys."""
+        return f"{self.max_edge}:{self.image_format}:{self.quality}"
+
+    def process(
+        self, image: str, is_base64: bool = False
+    ) -> Optional[PreprocessResult]:
+        """Preprocess a local file path or base64 encoded image.
+
+        Returns:
+            PreprocessResult, or None for GCS URIs which are passed through
+            untouched since the service reads them directly.
+        """
+        if is_base64:
+            raw = base64.b64decode(image)
+        elif image.lower().startswith("gs://"):
+            return None
+        else:
+            with open(image, "rb") as f:
+                raw = f.read()
+        return self.process_bytes(raw)
+
+    def process_bytes(self, raw: bytes) -> PreprocessResult:
+        digest = hashlib.sha256(raw).digest()
+        with self._lock:
+            result = self._cache.get(digest)
+            if result is not None:
+                self._cache.move_to_end(digest)
+                self._cache_hits += 1
+        if result is None:
+            result = self._encode(raw)
+            with self._lock:
+                self._cache[digest] = result
+                while len(self._cache) > self.cache_entries:
+                    self._cache.popitem(last=False)
+        with self._lock:
+            self._images += 1
+            self._bytes_in += result.bytes_in
+            self._bytes_out += result.bytes_out
+        logging.info(
+            f"Image preprocessing saved {result.bytes_saved} bytes "
+            f"({result.bytes_in} -> {result.bytes_out})"
+        )
+        return result
+
+    def _encode(self, raw: bytes) -> PreprocessResult:
+        with self._image.open(io.BytesIO(raw)) as img:
+            img.thumbnail((self.max_edge, self.max_edge))
+            if self.image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, format=self.image_format, quality=self.quality)
+        processed = out.getvalue()
+        if len(processed) >= len(raw):
+            processed = raw
+        return PreprocessResult(
+            data=base64.b64encode(processed).decode("utf-8"),
+            bytes_in=len(raw),
+            bytes_out=len(processed),
+        )
+
+    def stats(self) -> PreprocessStats:
+        with self._lock:
+            return PreprocessStats(
+                images=self._images,
+                cache_hits=self._cache_hits,
+                bytes_in=self._bytes_in,
+                bytes_out=self._bytes_out,
+            )
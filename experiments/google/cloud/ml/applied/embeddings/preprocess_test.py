@@ -0,0 +1,69 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Image Preprocessing Unit Test."""
+
+import base64
+import io
+import unittest
+
+from PIL import Image
+
+from google.cloud.ml.applied.embeddings import preprocess
+
+
+def _png(width: int, height: int) -> bytes:
+    out = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(out, format="PNG")
+    return out.getvalue()
+
+
+class ImagePreprocessorTest(unittest.TestCase):
+    def test_downsize(self):
+        raw = _png(1200, 800)
+        p = preprocess.ImagePreprocessor(max_edge=256)
+        res = p.process(base64.b64encode(raw).decode("utf-8"), is_base64=True)
+        self.assertEqual(res.bytes_in, len(raw))
+        self.assertGreater(res.bytes_saved, 0)
+        with Image.open(io.BytesIO(base64.b64decode(res.data))) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(max(img.size), 256)
+
+    def test_cache_and_stats(self):
+        raw = _png(600, 600)
+        p = preprocess.ImagePreprocessor(max_edge=128, image_format="WEBP")
+        first = p.process_bytes(raw)
+        second = p.process_bytes(raw)
+        self.assertEqual(first, second)
+        stats = p.stats()
+        self.assertEqual((stats.images, stats.cache_hits), (2, 1))
+        self.assertEqual(stats.bytes_in, 2 * len(raw))
+
+    def test_version(self):
+        versions = {
+            preprocess.ImagePreprocessor(max_edge=256).version,
+            preprocess.ImagePreprocessor(max_edge=512).version,
+            preprocess.ImagePreprocessor(max_edge=256, quality=70).version,
+            preprocess.ImagePreprocessor(max_edge=256, image_format="webp").version,
+        }
+        self.assertEqual(len(versions), 4)
+
+    def test_gcs_passthrough(self):
+        p = preprocess.ImagePreprocessor(max_edge=128)
+        self.assertIsNone(p.process("gs://bucket/image.jpg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
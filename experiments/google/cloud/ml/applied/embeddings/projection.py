@@ -0,0 +1,227 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+r"""Catalog fitted dimensionality reduction for stored and query embeddings.
+
+A Projection maps embeddings to fewer dimensions with a single matrix
+multiply. It is fitted once on a sample of catalog embeddings, either with
+PCA or as an orthogonal random projection, saved as a versioned artifact and
+applied to every vector written to or queried from the vector index, see
+[vectors] projection in app.toml. Usage:
+
+    python -m google.cloud.ml.applied.embeddings.projection \
+        --method pca --dimension 256 --sample 20000 --output pca-256-v1.npz
+"""
+
+import argparse
+import logging
+import os
+from functools import cache
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.config import Config
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2 normalize rows, cosine distance is preserved as dot product."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+class RecallReport(NamedTuple):
+    k: int
+    queries: int
+    recall: float  # mean recall@k of projected search against full dimension search
+
+    @property
+    def recall_loss(self) -> float:
+        return 1 - self.recall
+
+
+class Projection:
+    """Linear map from input_dim to output_dim, (x - mean) @ components.
+
+    Outputs are L2 normalized so cosine distances remain meaningful.
+    """
+
+    def __init__(
+        self, method: str, version: str, mean: np.ndarray, components: np.ndarray
+    ):
+        self.method = method
+        self.version = version
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def output_dim(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit_pca(cls, sample: np.ndarray, dim: int, version: str) -> "Projection":
+        """Top dim principal components of a (n, input_dim) sample."""
+        sample = normalize(np.asarray(sample, dtype=np.float32))
+        if dim > min(sample.shape):
+            raise ValueError(
+                f"PCA to {dim} dimensions needs at least {dim} samples, "
+                f"got {sample.shape[0]}"
+            )
+        mean = sample.mean(axis=0)
+        _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+        return cls("pca", version, mean, vt[:dim].T)
+
+    @classmethod
+    def fit_random(
+        cls, input_dim: int, dim: int, version: str, seed: int = 0
+    ) -> "Projection":
+        """Orthogonal random projection, independent of the data."""
+        rng = np.random.default_rng(seed)
+        q, _ = np.linalg.qr(rng.standard_normal((input_dim, dim)))
+        return cls("random", version, np.zeros(input_dim), q)
+
+    def apply(self, vectors: np.ndarray) -> np.ndarray:
+        """Project a single vector or a (n, input_dim) matrix."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[-1] != self.input_dim:
+            raise ValueError(
+                f"Projection {self.version} expects {self.input_dim} dimensions, "
+                f"got {vectors.shape[-1]}"
+            )
+        return normalize((normalize(vectors) - self.mean) @ self.components)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                method=self.method,
+                version=self.version,
+                mean=self.mean,
+                components=self.components,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "Projection":
+        with np.load(path) as data:
+            return cls(
+                str(data["method"]),
+                str(data["version"]),
+                data["mean"],
+                data["components"],
+            )
+
+    def evaluate(
+        self, catalog: np.ndarray, queries: np.ndarray, k: int
+    ) -> RecallReport:
+        """Recall@k of cosine search in projected space against the full space."""
+        catalog = normalize(np.asarray(catalog, dtype=np.float32))
+        queries = normalize(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(catalog))
+
+        def top_k(q: np.ndarray, c: np.ndarray) -> np.ndarray:
+            return np.argpartition(-(q @ c.T), k - 1, axis=1)[:, :k]
+
+        exact = top_k(queries, catalog)
+        approx = top_k(self.apply(queries), self.apply(catalog))
+        hits = [len(np.intersect1d(e, a)) for e, a in zip(exact, approx)]
+        return RecallReport(k=k, queries=len(queries), recall=float(np.mean(hits) / k))
+
+
+@cache
+def get_projection() -> Optional[Projection]:
+    """Projection configured by [vectors] projection, None if not configured."""
+    path = Config.value(Config.SECTION_VECTORS, "projection")
+    if not path:
+        return None
+    projection = Projection.load(path)
+    index_dimension = Config.value(Config.SECTION_VECTORS, "dimension")
+    if projection.output_dim != index_dimension:
+        raise ValueError(
+            f"Projection {projection.version} outputs {projection.output_dim} "
+            f"dimensions but the vector search index expects {index_dimension}"
+        )
+    logging.info(
+        f"Loaded {projection.method} projection {projection.version} "
+        f"{projection.input_dim} -> {projection.output_dim}"
+    )
+    return projection
+
+
+def project(vectors: np.ndarray) -> np.ndarray:
+    """Apply the configured projection, if any, to one or more embeddings."""
+    projection = get_projection()
+    return vectors if projection is None else projection.apply(vectors)
+
+
+def embedding_dimension(index_dimension: int) -> int:
+    """Dimension to request from the embedding API for an index."""
+    projection = get_projection()
+    return index_dimension if projection is None else projection.input_dim
+
+
+def load_sample(limit: int) -> np.ndarray:
+    """Random sample of stored catalog text and image embeddings."""
+    from google.cloud.ml.applied.utils import utils
+
+    bq = Config.SECTION_BIG_QUERY
+    column_text = Config.value(bq, "product_text_embedding_column")
+    column_image = Config.value(bq, "product_image_embedding_column")
+    query = f"""
+    SELECT emb FROM (
+        SELECT {column_text} AS emb FROM `{Config.value(bq, "product_table")}`
+        UNION ALL
+        SELECT {column_image} AS emb FROM `{Config.value(bq, "product_table")}`
+    )
+    WHERE ARRAY_LENGTH(emb) > 0
+    ORDER BY RAND()
+    LIMIT {int(limit)}
+    """
+    rows = utils.get_bq_client().query(query).result()
+    return np.array([row["emb"] for row in rows], dtype=np.float32)
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--method", choices=["pca", "random"], default="pca")
+    parser.add_argument("--dimension", type=int, required=True)
+    parser.add_argument("--sample", type=int, default=20000)
+    parser.add_argument("--holdout", type=float, default=0.1)
+    parser.add_argument("--k", type=int, default=7)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    sample = load_sample(args.sample)
+    n_holdout = max(1, int(len(sample) * args.holdout))
+    train, holdout = sample[n_holdout:], sample[:n_holdout]
+    version = os.path.splitext(os.path.basename(args.output))[0]
+    if args.method == "pca":
+        projection = Projection.fit_pca(train, args.dimension, version)
+    else:
+        projection = Projection.fit_random(train.shape[1], args.dimension, version)
+    report = projection.evaluate(train, holdout, args.k)
+    logging.info(
+        f"{args.method} {projection.input_dim} -> {projection.output_dim}: "
+        f"recall@{report.k} {report.recall:.4f} on {report.queries} held out queries"
+    )
+    projection.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Projection Unit Test."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.embeddings import projection
+
+
+def _catalog(n: int, dim: int = 64, rank: int = 8, seed: int = 0) -> np.ndarray:
+    """Vectors that mostly live in a low rank subspace, like real embeddings."""
+    rng = np.random.default_rng(seed)
+    basis = rng.standard_normal((rank, dim))
+    noise = 0.05 * rng.standard_normal((n, dim))
+    return (rng.standard_normal((n, rank)) @ basis + noise).astype(np.float32)
+
+
+class ProjectionTest(unittest.TestCase):
+    def test_pca_shapes(self):
+        p = projection.Projection.fit_pca(_catalog(200), 16, "pca-16-v1")
+        self.assertEqual((p.input_dim, p.output_dim), (64, 16))
+        out = p.apply(_catalog(5, seed=1))
+        self.assertEqual(out.shape, (5, 16))
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_allclose(np.linalg.norm(out, axis=1), 1, rtol=1e-5)
+        self.assertEqual(p.apply(_catalog(1, seed=1)[0]).shape, (16,))
+
+    def test_random_is_orthogonal(self):
+        p = projection.Projection.fit_random(64, 16, "random-16-v1")
+        np.testing.assert_allclose(p.components.T @ p.components, np.eye(16), atol=1e-5)
+
+    def test_wrong_dimension(self):
+        p = projection.Projection.fit_random(64, 16, "random-16-v1")
+        with self.assertRaises(ValueError):
+            p.apply(np.zeros(32))
+        with self.assertRaises(ValueError):
+            projection.Projection.fit_pca(_catalog(8), 16, "pca-16-v1")
+
+    def test_save_load(self):
+        p = projection.Projection.fit_pca(_catalog(200), 16, "pca-16-v1")
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "pca-16-v1.npz")
+            p.save(path)
+            loaded = projection.Projection.load(path)
+        self.assertEqual((loaded.method, loaded.version), ("pca", "pca-16-v1"))
+        x = _catalog(3, seed=2)
+        np.testing.assert_array_equal(loaded.apply(x), p.apply(x))
+
+    def test_recall(self):
+        catalog = _catalog(500)
+        queries = _catalog(50, seed=3)
+        pca = projection.Projection.fit_pca(catalog, 8, "pca-8-v1")
+        report = pca.evaluate(catalog, queries, k=7)
+        self.assertEqual((report.k, report.queries), (7, 50))
+        self.assertGreater(report.recall, 0.8)
+        self.assertAlmostEqual(report.recall_loss, 1 - report.recall)
+
+        full = projection.Projection.fit_random(64, 64, "random-64-v1")
+        self.assertEqual(full.evaluate(catalog, queries, k=7).recall, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,62 +13,109 @@
 #  limitations under the License.
 
 
+import numpy as np
 from google.cloud import aiplatform_v1
 
-from google.cloud.ml.applied.embeddings import embeddings
-from google.cloud.ml.applied.utils import utils
+from google.cloud.ml.applied.embeddings import embeddings, projection
+from google.cloud.ml.applied.knn import backends, base, local, result_cache
 from google.cloud.ml.applied.config import Config
 
-index_client = utils.get_vector_search_index_client()
-
 search_index_id = Config.value(Config.SECTION_VECTORS, "index_path")
+index_dimension = Config.value(Config.SECTION_VECTORS, "dimension")
+
 
+def datapoint(dp_id: str, emb: np.ndarray, cat=[]) -> aiplatform_v1.IndexDatapoint:
+    emb = projection.project(emb)
+    if len(emb) != index_dimension:
+        raise ValueError(
+            f"Embedding for {dp_id} has dimension {len(emb)} but the vector "
+            f"search index expects {index_dimension}"
+        )
+    if cat:
+        return aiplatform_v1.IndexDatapoint(
+            datapoint_id=dp_id,
+            feature_vector=emb,
+            restricts=base.category_restricts(cat),
+        )
+    return aiplatform_v1.IndexDatapoint(datapoint_id=dp_id, feature_vector=emb)
+
+
+def unpack(
+    datapoints: list[aiplatform_v1.IndexDatapoint],
+) -> tuple[list[str], np.ndarray, list[local.Restricts]]:
+    """Ids, vectors and restricts of datapoints, as the backends take them."""
+    return (
+        [dp.datapoint_id for dp in datapoints],
+        np.array([dp.feature_vector for dp in datapoints], dtype=np.float32),
+        [
+            local.parse_restricts(
+                {"namespace": r.namespace, "allow_list": list(r.allow_list)}
+                for r in dp.restricts
+            )
+            for dp in datapoints
+        ],
+    )
 
-def insert_dp(dp_id: str, emb: list[float], cat=[]):
+
+def insert_dps(datapoints: list[aiplatform_v1.IndexDatapoint]):
     print(
-        "Inserting data point id "
-        + dp_id
-        + " into vector search index "
+        "Inserting "
+        + str(len(datapoints))
+        + " data points into vector search index "
         + str(search_index_id)
     )
     try:
-        if cat:
-            insert_datapoints_payload = aiplatform_v1.IndexDatapoint(
-                datapoint_id=dp_id,
-                feature_vector=emb,
-                restricts=[{"namespace": "L0", "allow_list": cat}],
-            )
-        else:
-            insert_datapoints_payload = aiplatform_v1.IndexDatapoint(
-                datapoint_id=dp_id, feature_vector=emb
-            )
-        upsert_request = aiplatform_v1.UpsertDatapointsRequest(
-            index=search_index_id, datapoints=[insert_datapoints_payload]
-        )
-
-        res = index_client.upsert_datapoints(request=upsert_request)
-        print(
-            res
-        )  # If successful, the response body is empty [https://cloud.google.com/vertex-ai/docs/reference/rest/v1/projects.locations.indexes/upsertDatapoints].
-
+        ids, vectors, restricts = unpack(datapoints)
+        backends.get_backend().upsert(ids, vectors, restricts)
+        result_cache.publish_upsert(ids, vectors, restricts)
     except Exception as e:
         print("An error occurred:", e)
         print("Unable to insert into vector search index")
 
 
+def insert_dp(dp_id: str, emb: np.ndarray, cat=[]):
+    insert_dps([datapoint(dp_id, emb, cat)])
+
+
 def upsert_dp(prod_id: str, desc: str, image: str, cat=[]):
-    res = embeddings.embed(desc, image, base64=False)
+    res = embeddings.embed(
+        desc,
+        image,
+        base64=False,
+        dimension=projection.embedding_dimension(index_dimension),
+    )
 
     if desc:
         dp_id = prod_id + "_T"
-        emb = list(res.text_embedding)
+        emb = res.text_embedding
         insert_dp(dp_id, emb, cat)
     if image:
         dp_id = prod_id + "_I"
-        emb = list(res.image_embedding)
+        emb = res.image_embedding
         insert_dp(dp_id, emb, cat)
 
 
+def upsert_dps(products: list[tuple[str, str, str, list[str]]], batch_size=100):
+    """Embed and upsert many products using batched embedding calls.
+
+    Args:
+        products: (prod_id, desc, image, cat) tuples, same semantics as upsert_dp
+        batch_size: maximum number of datapoints per upsert request
+    """
+    results = embeddings.embed_many(
+        [embeddings.EmbeddingRequest(desc, image) for _, desc, image, _ in products],
+        dimension=projection.embedding_dimension(index_dimension),
+    )
+    datapoints = []
+    for (prod_id, desc, image, cat), res in zip(products, results):
+        if desc:
+            datapoints.append(datapoint(prod_id + "_T", res.text_embedding, cat))
+        if image:
+            datapoints.append(datapoint(prod_id + "_I", res.image_embedding, cat))
+    for i in range(0, len(datapoints), batch_size):
+        insert_dps(datapoints[i : i + batch_size])
+
+
 def remove_dp(dp_id: str):
     print(
         "Deleting data point id "
@@ -77,14 +124,8 @@ def remove_dp(dp_id: str):
         + str(search_index_id)
     )
     try:
-        remove_request = aiplatform_v1.RemoveDatapointsRequest(
-            index=search_index_id, datapoint_ids=[dp_id]
-        )
-
-        res = index_client.remove_datapoints(request=remove_request)
-        print(
-            res
-        )  # If successful, the response body is empty[https://cloud.google.com/vertex-ai/docs/reference/rest/v1/projects.locations.indexes/removeDatapoints}
+        backends.get_backend().remove([dp_id])
+        result_cache.publish_remove([dp_id])
     except Exception as e:
         print("An error occurred:", e)
         print("Unable to delete/remove data point from vector search index")
@@ -15,15 +15,14 @@
 
 import http.client
 import json
+import logging
 import typing
 import urllib.request
 
 from google.cloud.ml.applied.model import domain_model as m
-from google.cloud.ml.applied.utils import utils
+from google.cloud.ml.applied.utils import rate_limit, utils
 from vertexai.preview.generative_models import Image, Part
 
-multimodal_model = utils.get_gemini_pro_vision()
-
 
 def get_image_bytes_from_url(image_url: str) -> bytes:
     with urllib.request.urlopen(image_url) as response:
@@ -58,9 +57,9 @@ def from_gsc_uri(image_uri):
 
 
 def content_generation(prompt: str, im):
-    responses = ""
     try:
-        responses = multimodal_model.generate_content(
+        return rate_limit.get_limiter("gemini").call(
+            utils.get_gemini_pro_vision().generate_content,
             contents=[prompt, im],
             generation_config={
                 "max_output_tokens": 2048,
@@ -70,8 +69,8 @@ def content_generation(prompt: str, im):
             },
         )
     except Exception as e:
-        print(e)
-    return responses
+        logging.error(f"Gemini content generation failed: {e}")
+        raise
 
 
 def image_to_attributes(req: m.ImageRequest) -> m.ProductAttributes:
@@ -0,0 +1,74 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Memory mapped array files.
+
+Indexes derived from a knn.store file, e.g. posting lists, IVF partitions
+and quantized codes, are saved next to it in this format. Opening one maps
+the file, so loading takes constant time and processes share its pages.
+"""
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b"GVARRAY1"
+ALIGN = 64
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write(path: str, meta: dict, **arrays: np.ndarray):
+    """Write arrays and JSON meta to one file, replacing it atomically.
+
+    Layout: magic, uint64 header length, a JSON header with meta and the
+    dtype, shape and offset of each array, then the arrays aligned to 64 bytes.
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    at, layout = 0, {}
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, list(array.shape), at]
+        at = _align(at + array.nbytes)
+    header = json.dumps({"meta": meta, "arrays": layout}).encode()
+    start = _align(len(MAGIC) + 8 + len(header))
+    tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name][2])
+            f.write(array.tobytes())
+        f.truncate(start + at)
+    os.replace(tmp, path)
+
+
+def read(path: str) -> tuple[dict, dict[str, np.ndarray]]:
+    """Meta and read only, memory mapped arrays of a file written by write."""
+    with open(path, "rb") as f:
+        magic, length = f.read(len(MAGIC)), f.read(8)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an arrays file")
+        (length,) = struct.unpack("<Q", length)
+        header = json.loads(f.read(length))
+    start = _align(len(MAGIC) + 8 + length)
+    mapped = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {
+        name: np.ndarray(tuple(shape), np.dtype(dtype), mapped, start + offset)
+        for name, (dtype, shape, offset) in header["arrays"].items()
+    }
+    return header["meta"], arrays
@@ -0,0 +1,57 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Memory Mapped Arrays Unit Test."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import arrays
+
+
+class ArraysTest(unittest.TestCase):
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "index")
+            codes = np.arange(30, dtype=np.uint8).reshape(10, 3)
+            centroids = np.ones((4, 5), dtype=np.float32)
+            arrays.write(
+                path,
+                {"store": "abc"},
+                codes=codes,
+                centroids=centroids,
+                empty=np.empty(0, dtype=np.int64),
+            )
+            meta, loaded = arrays.read(path)
+            self.assertEqual(meta, {"store": "abc"})
+            np.testing.assert_array_equal(loaded["codes"], codes)
+            np.testing.assert_array_equal(loaded["centroids"], centroids)
+            self.assertEqual(loaded["empty"].shape, (0,))
+            self.assertFalse(loaded["codes"].flags.writeable)
+            self.assertEqual(os.listdir(d), ["index"])
+
+    def test_not_an_arrays_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"\0" * 64)
+            f.flush()
+            with self.assertRaises(ValueError):
+                arrays.read(f.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
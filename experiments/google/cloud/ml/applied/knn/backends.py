@@ -0,0 +1,374 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Pluggable vector search backends selected by [vectors] backend.
+
+    vertex  Vertex AI Vector Search, a deployed index endpoint
+    local   exact in-process search, optionally over quantized codes
+    ivf     approximate in-process search over k-means partitions
+    sharded local or ivf search split by L0 category across worker processes
+
+Clients and indexes are created on first use, importing this module does no
+network, auth or disk work.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, cached_property, partial
+from typing import Any, Callable, Optional, Protocol
+
+import numpy as np
+from google.cloud import aiplatform, aiplatform_v1
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import (
+    Namespace,
+)
+
+from google.cloud.ml.applied.config import Config
+from google.cloud.ml.applied.knn import loaders, segments, sharded, snapshots
+from google.cloud.ml.applied.knn.base import Neighbor
+from google.cloud.ml.applied.knn.local import Restricts
+from google.cloud.ml.applied.utils import rate_limit, utils
+
+Filters = list[tuple[str, list[str]]]
+
+
+def group_rows(filters_per_row: list[Filters]) -> list[tuple[Filters, np.ndarray]]:
+    """Rows sharing each distinct filter, in order of first appearance."""
+    groups = {}
+    for row, filters in enumerate(filters_per_row):
+        key = tuple((ns, tuple(tokens)) for ns, tokens in filters)
+        groups.setdefault(key, (filters, []))[1].append(row)
+    return [(filters, np.array(rows)) for filters, rows in groups.values()]
+
+
+class VectorBackend(Protocol):
+    def query(self, embedding: np.ndarray, filters: Filters, k: int) -> list[Neighbor]:
+        """Closest first neighbors of one embedding."""
+
+    def batch_query(
+        self, embeds: list[np.ndarray], filters: Filters, k: int
+    ) -> list[list[Neighbor]]:
+        """Closest first neighbors of each embedding."""
+
+    def search_batch(
+        self, queries: np.ndarray, filters_per_row: list[Filters], k: int
+    ) -> list[list[Neighbor]]:
+        """Closest first neighbors of each row of queries, with its own filters."""
+
+    def upsert(self, ids: list[str], vectors: np.ndarray, restricts: list[Restricts]):
+        """Add or replace datapoints."""
+
+    def remove(self, ids: list[str]):
+        """Remove datapoints, unknown ids are ignored."""
+
+    def stats(self) -> dict[str, Any]:
+        """Backend specific counters."""
+
+
+class VertexBackend:
+    """Vertex AI Vector Search, queried through a deployed index endpoint."""
+
+    name = "vertex"
+
+    def __init__(
+        self,
+        endpoint_id: str,
+        deployed_index: str,
+        index_path: str,
+        project: str,
+        location: str,
+        batch_chunk: int = 50,
+        batch_workers: int = 8,
+    ):
+        self.endpoint_id = endpoint_id
+        self.deployed_index = deployed_index
+        self.index_path = index_path
+        self.project = project
+        self.location = location
+        self.batch_chunk = batch_chunk
+        self.batch_workers = batch_workers
+        self.search_limiter = rate_limit.get_limiter("vector_search")
+        self.index_limiter = rate_limit.get_limiter("vector_index")
+
+    @cached_property
+    def endpoint(self) -> aiplatform.MatchingEngineIndexEndpoint:
+        return aiplatform.MatchingEngineIndexEndpoint(
+            index_endpoint_name=self.endpoint_id,
+            project=self.project,
+            location=self.location,
+        )
+
+    @cached_property
+    def index_client(self) -> aiplatform_v1.IndexServiceClient:
+        return utils.get_vector_search_index_client()
+
+    def query(self, embedding: np.ndarray, filters: Filters, k: int) -> list[Neighbor]:
+        return self.batch_query([embedding], filters, k)[0]
+
+    def batch_query(
+        self, embeds: list[np.ndarray], filters: Filters, k: int
+    ) -> list[list[Neighbor]]:
+        response = self.search_limiter.call(
+            self.endpoint.find_neighbors,
+            deployed_index_id=self.deployed_index,
+            queries=embeds,
+            num_neighbors=k,
+            filter=[Namespace(name, tokens) for name, tokens in filters],
+        )
+        return [[Neighbor(r.id, r.distance) for r in neighbor] for neighbor in response]
+
+    def search_batch(
+        self, queries: np.ndarray, filters_per_row: list[Filters], k: int
+    ) -> list[list[Neighbor]]:
+        """Multi-query find_neighbors requests of up to batch_chunk rows sharing
+        a filter, batch_workers of them in flight at once."""
+        requests = [
+            (filters, rows[i : i + self.batch_chunk])
+            for filters, rows in group_rows(filters_per_row)
+            for i in range(0, len(rows), self.batch_chunk)
+        ]
+        results = [None] * len(queries)
+        with ThreadPoolExecutor(
+            max_workers=self.batch_workers, thread_name_prefix="vector-search-batch"
+        ) as pool:
+            responses = pool.map(
+                lambda r: self.batch_query(
+                    [queries[row].tolist() for row in r[1]], r[0], k
+                ),
+                requests,
+            )
+            for (_, rows), neighbors in zip(requests, responses):
+                for row, n in zip(rows, neighbors):
+                    results[row] = n
+        return results
+
+    def upsert(self, ids: list[str], vectors: np.ndarray, restricts: list[Restricts]):
+        datapoints = [
+            aiplatform_v1.IndexDatapoint(
+                datapoint_id=dp_id,
+                feature_vector=vector,
+                restricts=[
+                    {"namespace": ns, "allow_list": sorted(tokens)}
+                    for ns, tokens in r.items()
+                ],
+            )
+            for dp_id, vector, r in zip(ids, vectors, restricts)
+        ]
+        request = aiplatform_v1.UpsertDatapointsRequest(
+            index=self.index_path, datapoints=datapoints
+        )
+        # If successful, the response body is empty [https://cloud.google.com/vertex-ai/docs/reference/rest/v1/projects.locations.indexes/upsertDatapoints].
+        self.index_limiter.call(self.index_client.upsert_datapoints, request=request)
+
+    def remove(self, ids: list[str]):
+        request = aiplatform_v1.RemoveDatapointsRequest(
+            index=self.index_path, datapoint_ids=ids
+        )
+        self.index_limiter.call(self.index_client.remove_datapoints, request=request)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "backend": self.name,
+            "vector_search": self.search_limiter.stats()._asdict(),
+            "vector_index": self.index_limiter.stats()._asdict(),
+        }
+
+
+class LocalBackend:
+    """In-process index, built by loader on first use.
+
+    Args:
+        name: backend name reported by stats()
+        loader: returns a BruteForceIndex, IVFIndex or QuantizedIndex
+        tile_scores: bound on the query x datapoint scores computed at once by
+            search_batch, which sets the number of queries per tile
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Any], tile_scores: int = 2**26):
+        self.name = name
+        self.loader = loader
+        self.tile_scores = tile_scores
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self.loader()
+        return self._index
+
+    def query(self, embedding: np.ndarray, filters: Filters, k: int) -> list[Neighbor]:
+        return self.batch_query([embedding], filters, k)[0]
+
+    def batch_query(
+        self, embeds: list[np.ndarray], filters: Filters, k: int
+    ) -> list[list[Neighbor]]:
+        return self.index.search(np.asarray(embeds), k, filters)
+
+    def search_batch(
+        self, queries: np.ndarray, filters_per_row: list[Filters], k: int
+    ) -> list[list[Neighbor]]:
+        """Rows sharing a filter are searched together, one matrix multiply and
+        per row top k for each tile of queries."""
+        queries = np.atleast_2d(queries)
+        index = self.index
+        tile = max(1, self.tile_scores // max(1, len(index)))
+        results = [None] * len(queries)
+        for filters, rows in group_rows(filters_per_row):
+            for i in range(0, len(rows), tile):
+                tile_rows = rows[i : i + tile]
+                for row, n in zip(
+                    tile_rows, index.search(queries[tile_rows], k, filters)
+                ):
+                    results[row] = n
+        return results
+
+    def upsert(self, ids: list[str], vectors: np.ndarray, restricts: list[Restricts]):
+        self.index.upsert(ids, vectors, restricts)
+
+    def remove(self, ids: list[str]):
+        self.index.remove(ids)
+
+    def stats(self) -> dict[str, Any]:
+        out = {"backend": self.name, "loaded": self._index is not None}
+        if self._index is not None:
+            out["datapoints"] = len(self._index)
+            # writes to read only indexes raise base.ReadOnlyIndexError
+            out["read_only"] = getattr(self._index, "read_only", False)
+            if hasattr(self._index, "postings"):
+                out["postings"] = self._index.postings.stats()._asdict()
+            if isinstance(self._index, sharded.ShardedIndex):
+                out["shards"] = self._index.stats()
+            if isinstance(self._index, snapshots.SnapshotIndex):
+                out["snapshot"] = self._index.stats()
+            if isinstance(self._index, snapshots.SegmentedSnapshotIndex):
+                out["snapshot"] = self._index.snapshot_stats()
+            if isinstance(self._index, segments.SegmentedIndex):
+                out["segments"] = self._index.stats()._asdict()
+            if hasattr(self._index, "filter_stats"):
+                out["filters"] = self._index.filter_stats()._asdict()
+        return out
+
+
+def _configured_local_index(name: str) -> Callable[[], Any]:
+    def load():
+        vectors = Config.SECTION_VECTORS
+        options = dict(
+            approximate=(
+                Config.value(vectors, "shard_index") == "ivf"
+                if name == "sharded"
+                else name == "ivf"
+            ),
+            quantization_kind=Config.value(vectors, "quantization"),
+            nlist=Config.value(vectors, "ivf_nlist"),
+            nprobe=Config.value(vectors, "ivf_nprobe"),
+            rerank=Config.value(vectors, "rerank"),
+        )
+        if name == "sharded":
+            index = sharded.ShardedIndex(
+                Config.value(vectors, "local_path"),
+                options,
+                replicas=Config.value(vectors, "shard_replicas"),
+            )
+        else:
+            path = Config.value(vectors, "local_path")
+            snapshot_dir = Config.value(vectors, "snapshot_dir")
+            if snapshot_dir:
+                identity = snapshots.configured_identity()
+                keep = Config.value(vectors, "snapshot_keep")
+                # first boot, snapshot the datapoints at local_path
+                snapshots.bootstrap(
+                    snapshot_dir,
+                    partial(loaders.read_datapoints, path),
+                    identity,
+                    keep=keep,
+                    **options,
+                )
+            segment_options = dict(
+                segment_rows=Config.value(vectors, "segment_rows"),
+                compact_delta_rows=Config.value(vectors, "compact_delta_rows"),
+                compact_tombstones=Config.value(vectors, "compact_tombstones"),
+                compact_interval=Config.value(vectors, "compact_interval"),
+                log=Config.value(vectors, "segment_log"),
+            )
+            poll_interval = Config.value(vectors, "snapshot_poll")
+            if not Config.value(vectors, "segments"):
+                index = (
+                    snapshots.SnapshotIndex(
+                        snapshot_dir, identity, options, poll_interval=poll_interval
+                    )
+                    if snapshot_dir
+                    else loaders.load_local_index(path, **options)
+                )
+            elif snapshot_dir:
+                index = snapshots.SegmentedSnapshotIndex(
+                    snapshot_dir,
+                    identity,
+                    options,
+                    keep=keep,
+                    poll_interval=poll_interval,
+                    **segment_options,
+                )
+            else:
+                if segment_options["log"]:
+                    raise ValueError(
+                        "[vectors] segment_log needs a snapshot_dir, compactions "
+                        "of local_path are not persisted"
+                    )
+                index = segments.SegmentedIndex(
+                    loaders.load_local_index(path, **options),
+                    partial(
+                        loaders.build_local_index,
+                        directory=os.path.dirname(os.path.abspath(path)),
+                        **options,
+                    ),
+                    **segment_options,
+                )
+        dimension = Config.value(vectors, "dimension")
+        if index.dimension != dimension:
+            raise ValueError(
+                f"Local index has dimension {index.dimension} but [vectors] "
+                f"dimension is {dimension}"
+            )
+        return index
+
+    return load
+
+
+@cache
+def get_backend(name: Optional[str] = None) -> VectorBackend:
+    """Shared backend, [vectors] backend unless name is given."""
+    name = name or Config.value(Config.SECTION_VECTORS, "backend")
+    if name == "vertex":
+        return VertexBackend(
+            endpoint_id=Config.value(Config.SECTION_VECTORS, "endpoint_id"),
+            deployed_index=Config.value(Config.SECTION_VECTORS, "deployed_index"),
+            index_path=Config.value(Config.SECTION_VECTORS, "index_path"),
+            project=Config.value(Config.SECTION_PROJECT, "id"),
+            location=Config.value(Config.SECTION_PROJECT, "location"),
+            batch_chunk=Config.value(Config.SECTION_VECTORS, "batch_chunk"),
+            batch_workers=Config.value(Config.SECTION_VECTORS, "batch_workers"),
+        )
+    if name in ("local", "ivf", "sharded"):
+        return LocalBackend(
+            name,
+            _configured_local_index(name),
+            tile_scores=Config.value(Config.SECTION_VECTORS, "batch_tile_scores"),
+        )
+    raise ValueError(
+        f"Unknown [vectors] backend {name}, use vertex, local, ivf or sharded"
+    )
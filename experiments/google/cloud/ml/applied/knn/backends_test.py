@@ -0,0 +1,159 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Vector Search Backends Unit Test.
+
+Runs without cloud credentials, importing the modules below must not create
+any clients.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.categories import category  # noqa: F401
+from google.cloud.ml.applied.embeddings import search  # noqa: F401
+from google.cloud.ml.applied.knn import backends, base, loaders, local, store
+
+
+def _write_datapoints(path: str):
+    with open(path, "w") as f:
+        for dp_id, emb, cat in [
+            ("1_T", [1, 0, 0], "Mens"),
+            ("1_I", [0.9, 0.1, 0], "Mens"),
+            ("2_T", [0, 1, 0], "Womens"),
+        ]:
+            restricts = [{"namespace": "L0", "allow": [cat]}]
+            f.write(json.dumps({"id": dp_id, "embedding": emb, "restricts": restricts}))
+            f.write("\n")
+
+
+class LocalBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "datapoints.json")
+        _write_datapoints(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_lazy_load(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return loaders.load_local_index(self.path)
+
+        backend = backends.LocalBackend("local", loader)
+        self.assertEqual(backend.stats(), {"backend": "local", "loaded": False})
+        self.assertEqual(loads, [])
+        res = backend.query(np.array([1, 0, 0]), [], 2)
+        self.assertEqual([n.id for n in res], ["1_T", "1_I"])
+        backend.batch_query([np.array([0, 1, 0])], [], 1)
+        self.assertEqual(loads, [1])
+        self.assertEqual(backend.stats()["datapoints"], 3)
+
+    def test_upsert_remove(self):
+        backend = backends.LocalBackend(
+            "local", lambda: loaders.load_local_index(self.path)
+        )
+        filters = base.filter_namespaces(["Womens"])
+        backend.upsert(["3_T"], np.array([[0, 0.9, 0.1]]), [{"L0": {"Womens"}}])
+        res = backend.query(np.array([0, 1, 0]), filters, 5)
+        self.assertEqual([n.id for n in res], ["2_T", "3_T"])
+        backend.remove(["2_T"])
+        res = backend.query(np.array([0, 1, 0]), filters, 5)
+        self.assertEqual([n.id for n in res], ["3_T"])
+
+    def test_load_variants(self):
+        vec = os.path.join(self.dir.name, "catalog" + store.SUFFIX)
+        store.main([self.path, vec])
+        for kwargs in [
+            {},
+            {"approximate": True, "nlist": 2, "nprobe": 2},
+            {"quantization_kind": "int8"},
+        ]:
+            index = loaders.load_local_index(vec, **kwargs)
+            res = index.search(np.array([1, 0, 0]), 1, base.filter_namespaces(["Mens"]))
+            self.assertEqual(res[0][0].id, "1_T", kwargs)
+        self.assertTrue(os.path.exists(vec + ".int8"))
+        with self.assertRaises(ValueError):
+            loaders.load_local_index(self.path, quantization_kind="int8")
+
+
+class SearchBatchTest(unittest.TestCase):
+    def test_group_rows(self):
+        a, b = [("L0", ["Mens"])], [("L0", ["Womens"])]
+        groups = backends.group_rows([a, [], a, b])
+        self.assertEqual([f for f, _ in groups], [a, [], b])
+        self.assertEqual([r.tolist() for _, r in groups], [[0, 2], [1], [3]])
+
+    def test_local_matches_query(self):
+        rng = np.random.default_rng(0)
+        index = local.BruteForceIndex(8)
+        cats = ["Mens", "Womens", "Kids"]
+        index.upsert(
+            [str(i) for i in range(60)],
+            rng.standard_normal((60, 8)),
+            [{"L0": frozenset([cats[i % 3]])} for i in range(60)],
+        )
+        # at most 2 queries per tile
+        backend = backends.LocalBackend("local", lambda: index, tile_scores=120)
+        queries = rng.standard_normal((7, 8))
+        filters = [
+            base.filter_namespaces([cats[i % 3]] if i % 4 else []) for i in range(7)
+        ]
+        results = backend.search_batch(queries, filters, 5)
+        self.assertEqual(len(results), 7)
+        for q, f, res in zip(queries, filters, results):
+            expected = backend.query(q, f, 5)
+            self.assertEqual([n.id for n in res], [n.id for n in expected])
+            for n, e in zip(res, expected):
+                self.assertAlmostEqual(n.distance, e.distance, places=5)
+
+    def test_vertex_chunks(self):
+        calls = []
+
+        class FakeVertex(backends.VertexBackend):
+            def batch_query(self, embeds, filters, k):
+                calls.append((len(embeds), filters))
+                return [[base.Neighbor(f"{e[0]:.0f}", 0.0)] for e in embeds]
+
+        backend = FakeVertex("e", "d", "i", "p", "l", batch_chunk=2, batch_workers=3)
+        queries = np.arange(5, dtype=np.float32)[:, None] * np.ones((1, 3))
+        filters = [[("L0", ["A"])], [], [("L0", ["A"])], [("L0", ["A"])], []]
+        results = backend.search_batch(queries, filters, 1)
+        self.assertEqual([r[0].id for r in results], ["0", "1", "2", "3", "4"])
+        self.assertEqual(sorted(n for n, _ in calls), [1, 2, 2])
+
+
+class GetBackendTest(unittest.TestCase):
+    def test_vertex_is_lazy(self):
+        backend = backends.get_backend("vertex")
+        self.assertIsInstance(backend, backends.VertexBackend)
+        self.assertNotIn("endpoint", vars(backend))
+        self.assertNotIn("index_client", vars(backend))
+        self.assertEqual(backend.stats()["vector_search"]["calls"], 0)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            backends.get_backend("faiss")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Types and category restrict helpers shared by the nearest neighbor backends."""
+import logging
+from collections import namedtuple
+from typing import Optional
+
+from google.cloud.ml.applied.config import Config
+
+Neighbor = namedtuple("Neighbor", ["id", "distance"])
+# distance is the closest of text_distance and image_distance, a modality
+# distance is None if that datapoint was not among the neighbors
+ProductNeighbor = namedtuple(
+    "ProductNeighbor", ["id", "distance", "text_distance", "image_distance", "score"]
+)
+
+MODALITY_SUFFIXES = {"_T": "text_distance", "_I": "image_distance"}
+
+
+class ReadOnlyIndexError(Exception):
+    """Upsert or remove on a local index that cannot be updated in place."""
+
+
+category_depth = Config.value(Config.SECTION_CATEGORY, "depth")
+category_filter = Config.value(Config.SECTION_CATEGORY, "filter")
+
+
+def category_restricts(cat: list[str]) -> list[dict]:
+    """Restricts for a datapoint, one namespace per category level.
+
+    ['Mens', 'Pants'] becomes L0: Mens, L1: Pants. Levels stop at the first
+    empty value, same as the index data preparation.
+    """
+    restricts = []
+    for namespace, level in zip(category_filter, cat):
+        if not level:
+            break
+        restricts.append({"namespace": namespace, "allow_list": [level]})
+    return restricts
+
+
+def filter_namespaces(filters: list[str]) -> list[tuple[str, list[str]]]:
+    """(namespace, allowed tokens) pairs for a category prefix filter."""
+    if len(filters) > category_depth:
+        logging.warning(
+            f"""Number of category filters {len(filters)} is greater
+         than supported category depth {category_depth}. Truncating"""
+        )
+        filters = filters[:category_depth]
+    return [(category_filter[i], [f]) for i, f in enumerate(filters)]
+
+
+def product_id(dp_id: str) -> tuple[str, Optional[str]]:
+    """Split a datapoint id into product id and ProductNeighbor modality field."""
+    field = MODALITY_SUFFIXES.get(dp_id[-2:])
+    return (dp_id[:-2], field) if field else (dp_id, None)
+
+
+def fuse(
+    neighbors: list[list[Neighbor]], method: str = "rrf", rrf_k: int = 60
+) -> list[ProductNeighbor]:
+    """Fuse per query datapoint neighbors into one candidate per product.
+
+    Args:
+        neighbors: closest first neighbors of each query embedding
+        method: "rrf" orders products by reciprocal rank fusion, the sum over
+            queries and modalities of 1 / (rrf_k + rank). "min" orders by the
+            closest distance of any of the product's datapoints.
+        rrf_k: rank offset for reciprocal rank fusion
+
+    Returns:
+        Products, best first. score is the fused RRF score, or the negated
+        distance for "min", so higher is always better.
+    """
+    if method not in ("rrf", "min"):
+        raise ValueError(f"Unknown fusion method {method}, use rrf or min")
+    products = {}
+    for query in neighbors:
+        for rank, n in enumerate(sorted(query, key=lambda n: n.distance), start=1):
+            pid, field = product_id(n.id)
+            p = products.setdefault(
+                pid, {"distance": n.distance, "rrf": 0.0, "modalities": {}}
+            )
+            p["distance"] = min(p["distance"], n.distance)
+            p["rrf"] += 1 / (rrf_k + rank)
+            if field:
+                previous = p["modalities"].get(field, n.distance)
+                p["modalities"][field] = min(previous, n.distance)
+    fused = [
+        ProductNeighbor(
+            id=pid,
+            distance=p["distance"],
+            text_distance=p["modalities"].get("text_distance"),
+            image_distance=p["modalities"].get("image_distance"),
+            score=p["rrf"] if method == "rrf" else -p["distance"],
+        )
+        for pid, p in products.items()
+    ]
+    return sorted(fused, key=lambda p: (-p.score, p.distance))
+
+
+def cutoff(
+    neighbors: list[Neighbor],
+    max_distance: float = 0.0,
+    max_gap: float = 0.0,
+    min_neighbors: int = 1,
+) -> list[Neighbor]:
+    """Closest first neighbors up to the first one past a distance cutoff.
+
+    Args:
+        neighbors: closest first neighbors of one query
+        max_distance: drop neighbors farther than this, 0 to disable
+        max_gap: drop a neighbor and everything after it when the jump from
+            the previous distance is more than this fraction of its distance,
+            e.g. 0.5 cuts 0.02 -> 0.3 but keeps 0.3 -> 0.32. 0 to disable
+        min_neighbors: always keep at least this many
+
+    Returns:
+        A prefix of neighbors
+    """
+    for i, n in enumerate(neighbors):
+        if i < min_neighbors:
+            continue
+        if max_distance and n.distance > max_distance:
+            return neighbors[:i]
+        jump = n.distance - neighbors[i - 1].distance
+        if max_gap and i and jump > max_gap * max(n.distance, 1e-9):
+            return neighbors[:i]
+    return neighbors
@@ -0,0 +1,77 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Product Fusion Unit Test."""
+
+import unittest
+
+from google.cloud.ml.applied.knn import base
+from google.cloud.ml.applied.knn.base import Neighbor
+
+TEXT_QUERY = [Neighbor("1_T", 0.1), Neighbor("1_I", 0.2), Neighbor("2_T", 0.3)]
+IMAGE_QUERY = [Neighbor("2_I", 0.05), Neighbor("1_I", 0.15), Neighbor("3_I", 0.4)]
+
+
+class FuseTest(unittest.TestCase):
+    def test_product_id(self):
+        self.assertEqual(base.product_id("123_T"), ("123", "text_distance"))
+        self.assertEqual(base.product_id("123_I"), ("123", "image_distance"))
+        self.assertEqual(base.product_id("123"), ("123", None))
+
+    def test_one_candidate_per_product(self):
+        fused = base.fuse([TEXT_QUERY, IMAGE_QUERY])
+        self.assertEqual(sorted(p.id for p in fused), ["1", "2", "3"])
+        one = next(p for p in fused if p.id == "1")
+        self.assertEqual((one.text_distance, one.image_distance), (0.1, 0.15))
+        self.assertEqual(one.distance, 0.1)
+        three = next(p for p in fused if p.id == "3")
+        self.assertIsNone(three.text_distance)
+
+    def test_rrf(self):
+        fused = base.fuse([TEXT_QUERY, IMAGE_QUERY], "rrf", rrf_k=0)
+        # 1: 1/1 + 1/2 + 1/2, 2: 1/3 + 1/1, 3: 1/3
+        self.assertEqual([p.id for p in fused], ["1", "2", "3"])
+        self.assertAlmostEqual(fused[0].score, 2.0)
+
+    def test_min(self):
+        fused = base.fuse([TEXT_QUERY, IMAGE_QUERY], "min")
+        self.assertEqual([p.id for p in fused], ["2", "1", "3"])
+        self.assertEqual([p.distance for p in fused], [0.05, 0.1, 0.4])
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            base.fuse([TEXT_QUERY], "max")
+
+
+class CutoffTest(unittest.TestCase):
+    def test_disabled(self):
+        self.assertEqual(base.cutoff(TEXT_QUERY), TEXT_QUERY)
+
+    def test_max_distance(self):
+        self.assertEqual(base.cutoff(TEXT_QUERY, max_distance=0.25), TEXT_QUERY[:2])
+        self.assertEqual(base.cutoff(TEXT_QUERY, max_distance=0.01), TEXT_QUERY[:1])
+        self.assertEqual(
+            base.cutoff(TEXT_QUERY, max_distance=0.01, min_neighbors=0), []
+        )
+
+    def test_relative_gap(self):
+        exact = [Neighbor("1_T", 0.01), Neighbor("2_T", 0.3), Neighbor("3_T", 0.31)]
+        self.assertEqual(base.cutoff(exact, max_gap=0.5), exact[:1])
+        self.assertEqual(base.cutoff(exact, max_gap=0.5, min_neighbors=2), exact)
+        self.assertEqual(base.cutoff(TEXT_QUERY, max_gap=0.6), TEXT_QUERY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,261 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Inverted file (IVF) approximate nearest neighbor index.
+
+Datapoints are partitioned into nlist lists by their nearest k-means
+centroid. A query scores only the nprobe lists whose centroids are closest,
+so nprobe trades recall for latency. With category restricts, more lists
+are probed until at least k matching datapoints have been seen.
+
+The centroids and lists of an index over a knn.store file are saved next to
+it, so it is trained once rather than on every load.
+"""
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import arrays
+from google.cloud.ml.applied.knn.base import Neighbor
+from google.cloud.ml.applied.knn.local import (
+    BruteForceIndex,
+    Restricts,
+    normalize,
+    read_jsonl,
+)
+
+SUFFIX = ".ivf"
+
+
+def kmeans(
+    vectors: np.ndarray, k: int, iterations: int = 20, seed: int = 0
+) -> np.ndarray:
+    """Spherical k-means, returns (k, dimension) unit length centroids."""
+    rng = np.random.default_rng(seed)
+    vectors = normalize(vectors)
+    if len(vectors) < k:
+        raise ValueError(f"Need at least {k} vectors to train {k} lists")
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = ~sums.any(axis=1)
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFIndex(BruteForceIndex):
+    """Approximate cosine KNN over k-means partitions of the datapoints.
+
+    Args:
+        dimension: vector dimension
+        nlist: number of partitions, around sqrt(number of datapoints)
+        nprobe: partitions scored per query, raise for recall, lower for speed
+    """
+
+    def __init__(self, dimension: int, nlist: int, nprobe: int = 8):
+        super().__init__(dimension)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.assign = np.empty(0, dtype=np.int32)
+        self._lists: Optional[list[np.ndarray]] = None
+
+    def train(self, sample: np.ndarray, iterations: int = 20, seed: int = 0):
+        """Fit the coarse centroids, existing datapoints are reassigned."""
+        sample = np.asarray(sample, dtype=np.float32)
+        if len(sample) > 256 * self.nlist:
+            rng = np.random.default_rng(seed)
+            sample = sample[rng.choice(len(sample), 256 * self.nlist, replace=False)]
+        centroids = kmeans(sample, self.nlist, iterations, seed)
+        with self._lock:
+            self.centroids = centroids
+            self.assign = self._nearest_list(self.vectors)
+            self._lists = None
+
+    def _nearest_list(self, vectors: np.ndarray) -> np.ndarray:
+        if not len(vectors):
+            return np.empty(0, dtype=np.int32)
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def upsert(
+        self,
+        ids: list[str],
+        vectors: np.ndarray,
+        restricts: Optional[list[Restricts]] = None,
+    ):
+        if self.centroids is None:
+            raise ValueError("IVF index must be trained before adding datapoints")
+        vectors = normalize(np.atleast_2d(vectors))
+        with self._lock:
+            super().upsert(ids, vectors, restricts)
+            self.assign = np.concatenate([self.assign, self._nearest_list(vectors)])
+            self._lists = None
+
+    def _remove(self, ids: list[str]) -> Optional[np.ndarray]:
+        keep = super()._remove(ids)
+        if keep is not None:
+            self.assign = self.assign[keep]
+            self._lists = None
+        return keep
+
+    def lists(self) -> list[np.ndarray]:
+        """Row numbers of the datapoints in each list."""
+        with self._lock:
+            if self._lists is None:
+                order = np.argsort(self.assign, kind="stable")
+                bounds = np.searchsorted(self.assign[order], np.arange(self.nlist + 1))
+                self._lists = [
+                    order[bounds[i] : bounds[i + 1]] for i in range(self.nlist)
+                ]
+            return self._lists
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: Optional[list[tuple[str, list[str]]]] = None,
+        exclude: Optional[np.ndarray] = None,
+        nprobe: Optional[int] = None,
+    ) -> list[list[Neighbor]]:
+        """Approximate k nearest datapoints for each query, closest first.
+
+        Rows set in the boolean exclude mask are skipped, e.g. tombstones.
+        """
+        filters = filters or []
+        if self.centroids is None:
+            raise ValueError("IVF index must be trained before searching")
+        queries = normalize(np.atleast_2d(queries))
+        if queries.shape[1] != self.dimension:
+            raise ValueError(
+                f"Query embedding has dimension {queries.shape[1]} but the "
+                f"local index expects {self.dimension}"
+            )
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        with self._lock:
+            ids, vectors, lists = self.ids, self.vectors, self.lists()
+            mask = self.allowed(filters)
+        if exclude is not None:
+            mask = ~exclude if mask is None else mask & ~exclude
+        probe_order = np.argsort(-(queries @ self.centroids.T), axis=1)
+
+        results, scanned = [], 0
+        for query, order in zip(queries, probe_order):
+            candidates, found = [], 0
+            for probed, lst in enumerate(order):
+                rows = lists[lst]
+                if mask is not None:
+                    rows = rows[mask[rows]]
+                candidates.append(rows)
+                found += len(rows)
+                if probed + 1 >= nprobe and found >= k:
+                    break
+            rows = np.concatenate(candidates)
+            scanned += len(rows)
+            n = min(k, len(rows))
+            if n == 0:
+                results.append([])
+                continue
+            scores = vectors[rows] @ query
+            top = np.argpartition(-scores, n - 1)[:n]
+            top = top[np.argsort(-scores[top])]
+            results.append([Neighbor(ids[rows[i]], float(1 - scores[i])) for i in top])
+        if filters:
+            self._count_filtered(len(queries), scanned, len(ids))
+        return results
+
+    @classmethod
+    def build(
+        cls,
+        ids: list[str],
+        vectors: np.ndarray,
+        restricts: Optional[list[Restricts]] = None,
+        nlist: int = 0,
+        nprobe: int = 8,
+    ) -> "IVFIndex":
+        """Train on and index datapoints, nlist = 0 picks sqrt(len(ids))."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        nlist = nlist or max(1, int(np.sqrt(len(ids))))
+        index = cls(vectors.shape[1], nlist, nprobe)
+        index.train(vectors)
+        index.upsert(ids, vectors, restricts)
+        return index
+
+    def save(self, path: str):
+        """Write the centroids and lists of an index over a store."""
+        lists = self.lists()
+        arrays.write(
+            path,
+            {"store": self.store.fingerprint, "nlist": self.nlist},
+            centroids=self.centroids,
+            assign=self.assign,
+            rows=np.concatenate(lists),
+            bounds=np.cumsum([0] + [len(rows) for rows in lists]),
+        )
+
+    @classmethod
+    def load(cls, path: str, store, nlist: int = 0, nprobe: int = 8) -> "IVFIndex":
+        """Memory map an index saved by save, ValueError if it is stale.
+
+        nlist = 0 accepts any number of lists.
+        """
+        meta, saved = arrays.read(path)
+        if meta["store"] != store.fingerprint:
+            raise ValueError(f"{path} was saved for another version of {store.path}")
+        if nlist and meta["nlist"] != nlist:
+            raise ValueError(f"{path} has {meta['nlist']} lists, not {nlist}")
+        index = cls(store.dimension, meta["nlist"], nprobe)
+        index._attach(store)
+        index.centroids = saved["centroids"]
+        index.assign = saved["assign"]
+        bounds = saved["bounds"]
+        index._lists = [
+            saved["rows"][bounds[i] : bounds[i + 1]] for i in range(index.nlist)
+        ]
+        return index
+
+    @classmethod
+    def from_store(cls, store, nlist: int = 0, nprobe: int = 8) -> "IVFIndex":
+        """Index the datapoints of an open knn.store.VectorStore.
+
+        Loaded from the file saved next to the store when it is up to date,
+        otherwise trained and saved there.
+        """
+        path = store.path + SUFFIX
+        try:
+            return cls.load(path, store, nlist, nprobe)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.info(f"Retraining IVF index: {e}")
+        index = cls(store.dimension, nlist or max(1, int(np.sqrt(len(store)))), nprobe)
+        index._attach(store)
+        index.train(index.vectors)
+        # stores mapped from an unlinked file have nowhere to save to
+        if os.path.exists(store.path):
+            try:
+                index.save(path)
+            except OSError as e:
+                logging.warning(f"Unable to save IVF index to {path}: {e}")
+        return index
+
+    @classmethod
+    def from_jsonl(cls, path: str, nlist: int = 0, nprobe: int = 8) -> "IVFIndex":
+        """Build from datapoints in the Vertex index JSON lines format."""
+        return cls.build(*read_jsonl(path), nlist=nlist, nprobe=nprobe)
@@ -0,0 +1,108 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""IVF Index Unit Test."""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, ivf, local, store
+
+
+def _datapoints(n: int, dim: int = 16, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((8, dim))
+    vectors = centers[rng.integers(0, 8, n)] + 0.3 * rng.standard_normal((n, dim))
+    ids = [f"{i}_T" for i in range(n)]
+    cats = ["Mens" if i % 4 else "Womens" for i in range(n)]
+    restricts = [local.parse_restricts(base.category_restricts([c])) for c in cats]
+    return ids, vectors.astype(np.float32), restricts
+
+
+def _recall(approx, exact) -> float:
+    hits = [len({n.id for n in a} & {n.id for n in e}) for a, e in zip(approx, exact)]
+    return sum(hits) / sum(len(e) for e in exact)
+
+
+class IVFIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ids, vectors, restricts = _datapoints(2000)
+        cls.ivf = ivf.IVFIndex.build(ids, vectors, restricts, nlist=32, nprobe=4)
+        cls.exact = local.BruteForceIndex(vectors.shape[1])
+        cls.exact.upsert(ids, vectors, restricts)
+        cls.queries = _datapoints(50, seed=1)[1]
+
+    def test_lists_partition_datapoints(self):
+        rows = np.concatenate(self.ivf.lists())
+        self.assertEqual(sorted(rows), list(range(len(self.ivf))))
+
+    def test_recall_improves_with_nprobe(self):
+        exact = self.exact.search(self.queries, 7)
+        low = _recall(self.ivf.search(self.queries, 7, nprobe=1), exact)
+        high = _recall(self.ivf.search(self.queries, 7, nprobe=32), exact)
+        self.assertLessEqual(low, high)
+        self.assertEqual(high, 1.0)
+
+    def test_restricts(self):
+        filters = base.filter_namespaces(["Womens"])
+        res = self.ivf.search(self.queries, 7, filters, nprobe=1)
+        for neighbors in res:
+            self.assertEqual(len(neighbors), 7)
+            for n in neighbors:
+                self.assertEqual(int(n.id.split("_")[0]) % 4, 0)
+
+    def test_upsert_remove(self):
+        index = ivf.IVFIndex.build(*_datapoints(200), nlist=8)
+        index.upsert(["new"], np.ones((1, 16)))
+        res = index.search(np.ones(16), 1, nprobe=8)
+        self.assertEqual(res[0][0].id, "new")
+        index.remove(["new"])
+        self.assertEqual(len(index.assign), len(index))
+        self.assertNotIn("new", [n.id for n in index.search(np.ones(16), 5)[0]])
+
+    def test_untrained(self):
+        with self.assertRaises(ValueError):
+            ivf.IVFIndex(16, nlist=4).upsert(["1_T"], np.ones((1, 16)))
+
+    def test_saved_lists(self):
+        ids, vectors, restricts = _datapoints(2000)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "catalog" + store.SUFFIX)
+            store.VectorStore.write(path, ids, vectors, restricts)
+            trained = ivf.IVFIndex.from_store(store.VectorStore.open(path), nlist=32)
+            self.assertTrue(os.path.exists(path + ivf.SUFFIX))
+            with mock.patch.object(ivf, "kmeans", side_effect=AssertionError):
+                loaded = ivf.IVFIndex.from_store(store.VectorStore.open(path))
+            self.assertEqual(loaded.nlist, 32)
+            filters = base.filter_namespaces(["Womens"])
+            self.assertEqual(
+                loaded.search(self.queries, 7, filters),
+                trained.search(self.queries, 7, filters),
+            )
+            # other nlist, retrained
+            self.assertEqual(
+                ivf.IVFIndex.from_store(store.VectorStore.open(path), nlist=8).nlist, 8
+            )
+            loaded.upsert(["new"], np.ones((1, 16)))
+            self.assertEqual(len(loaded), 2001)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Load local indexes from datapoint files.
+
+Kept free of cloud client imports so that shard worker processes start fast.
+"""
+import logging
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import ivf, local, quantization, store
+from google.cloud.ml.applied.knn.local import Restricts
+
+
+def read_datapoints(path: str) -> tuple[np.ndarray, np.ndarray, list[Restricts]]:
+    """Ids, vectors and restricts of a store (.vec) or Vertex JSON lines file."""
+    if path.endswith(store.SUFFIX):
+        vector_store = store.VectorStore.open(path)
+        restricts = [vector_store.restricts(i) for i in range(len(vector_store))]
+        return vector_store.ids(), vector_store.vectors, restricts
+    ids, vectors, restricts = local.read_jsonl(path)
+    return np.array(ids, dtype=object), vectors, restricts
+
+
+def load_local_index(
+    path: str,
+    approximate: bool = False,
+    quantization_kind: str = "",
+    nlist: int = 0,
+    nprobe: int = 8,
+    rerank: int = 10,
+):
+    """Local index over a memory mapped knn.store file (.vec) or Vertex JSON lines.
+
+    Exact unless approximate, in which case an IVF index is built. With
+    quantization_kind set, an exact index over a store scans quantized codes,
+    trained on first use and saved next to the store.
+    """
+    if quantization_kind and not approximate:
+        if not path.endswith(store.SUFFIX):
+            raise ValueError("[vectors] quantization requires a .vec local_path")
+        return load_quantized(
+            store.VectorStore.open(path),
+            quantization_kind,
+            f"{path}.{quantization_kind}",
+            rerank,
+        )
+    if path.endswith(store.SUFFIX):
+        source = store.VectorStore.open(path)
+        if approximate:
+            return ivf.IVFIndex.from_store(source, nlist=nlist, nprobe=nprobe)
+        return local.BruteForceIndex.from_store(source)
+    if approximate:
+        return ivf.IVFIndex.from_jsonl(path, nlist=nlist, nprobe=nprobe)
+    return local.BruteForceIndex.from_jsonl(path)
+
+
+def load_quantized(
+    vector_store: store.VectorStore, kind: str, path: str, rerank: int = 10
+) -> quantization.QuantizedIndex:
+    """Load the quantized index saved at path, building it if missing or stale.
+
+    Codes are stale when saved for another version of the store file, even
+    one with the same number of rows.
+    """
+    if os.path.exists(path):
+        try:
+            return quantization.QuantizedIndex.load(path, vector_store)
+        except ValueError as e:
+            logging.warning(f"Rebuilding quantized index {path}: {e}")
+    index = quantization.QuantizedIndex.build(vector_store, kind, rerank=rerank)
+    index.save(path)
+    return index
+
+
+def build_local_index(
+    ids: list[str],
+    vectors: np.ndarray,
+    restricts: list[Restricts],
+    directory: Optional[str] = None,
+    approximate: bool = False,
+    quantization_kind: str = "",
+    nlist: int = 0,
+    nprobe: int = 8,
+    rerank: int = 10,
+):
+    """Index of the same kind as load_local_index, from datapoints in memory.
+
+    The datapoints are written to a temporary store in directory, which is
+    unlinked once mapped, so the index is backed by the page cache rather
+    than the heap.
+    """
+    fd, path = tempfile.mkstemp(suffix=store.SUFFIX, dir=directory)
+    os.close(fd)
+    try:
+        store.VectorStore.write(path, ids, vectors, restricts)
+        vector_store = store.VectorStore.open(path)
+    finally:
+        os.remove(path)
+    if quantization_kind and not approximate:
+        return quantization.QuantizedIndex.build(
+            vector_store, quantization_kind, rerank=rerank
+        )
+    if approximate:
+        return ivf.IVFIndex.from_store(vector_store, nlist=nlist, nprobe=nprobe)
+    return local.BruteForceIndex.from_store(vector_store)
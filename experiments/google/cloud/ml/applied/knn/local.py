@@ -0,0 +1,285 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""In-process exact nearest neighbor search over a float32 matrix.
+
+Distances are cosine distances (1 - cosine similarity), the same measure the
+Vertex index is configured with. Datapoints can be loaded from the JSON lines
+format used to build Vertex indexes:
+
+    {"id": "43_T", "embedding": [...], "restricts": [{"namespace": "L0", "allow": ["Mens"]}]}
+"""
+import json
+import threading
+from typing import Iterable, NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn.base import Neighbor
+from google.cloud.ml.applied.knn.postings import PostingLists
+
+Restricts = dict[str, frozenset[str]]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def parse_restricts(restricts: Iterable[dict]) -> Restricts:
+    """Namespace -> allowed tokens, from Vertex JSON or IndexDatapoint style dicts."""
+    out = {}
+    for r in restricts or []:
+        tokens = r.get("allow", r.get("allow_list", []))
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        out[r["namespace"]] = out.get(r["namespace"], frozenset()) | frozenset(tokens)
+    return out
+
+
+class FilterStats(NamedTuple):
+    queries: int  # filtered queries
+    rows_scanned: int
+    rows_total: int  # rows in the index, summed over filtered queries
+
+    @property
+    def selectivity(self) -> float:
+        return self.rows_scanned / self.rows_total if self.rows_total else 0.0
+
+    def __add__(self, other: "FilterStats") -> "FilterStats":
+        return FilterStats(*(a + b for a, b in zip(self, other)))
+
+
+def filter_stats(index) -> FilterStats:
+    """Filter stats of an index, zeros if it does not keep any."""
+    if hasattr(index, "filter_stats"):
+        return index.filter_stats()
+    return FilterStats(0, 0, 0)
+
+
+class BruteForceIndex:
+    """Exact cosine KNN, one matrix multiply and argpartition per query batch.
+
+    A query filter is a list of (namespace, tokens) pairs. A datapoint matches
+    when, for every namespace in the filter, it has a restrict in that
+    namespace containing one of the tokens. Category prefix filters are
+    answered from posting lists and only the matching rows are scored.
+    """
+
+    def __init__(self, dimension: int):
+        self.dimension = dimension
+        self.ids = np.empty(0, dtype=object)
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+        self.restricts: list[Restricts] = []
+        self._rows: dict[str, int] = {}
+        self._lock = threading.RLock()
+        self.store = None  # VectorStore backing the datapoints, until modified
+        self.postings = PostingLists()
+        self._filter_counts = [0, 0, 0]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def upsert(
+        self,
+        ids: list[str],
+        vectors: np.ndarray,
+        restricts: Optional[list[Restricts]] = None,
+    ):
+        """Add datapoints, replacing any existing datapoints with the same id."""
+        vectors = normalize(np.atleast_2d(vectors))
+        if vectors.shape != (len(ids), self.dimension):
+            raise ValueError(
+                f"Expected {len(ids)} vectors of dimension {self.dimension}, "
+                f"got shape {vectors.shape}"
+            )
+        restricts = restricts or [{}] * len(ids)
+        with self._lock:
+            self._detach()
+            self._remove(ids)
+            self.ids = np.concatenate([self.ids, np.array(ids, dtype=object)])
+            self.vectors = np.concatenate([self.vectors, vectors])
+            self.restricts.extend(restricts)
+            self.postings.add(restricts)
+            self._rows = {dp_id: i for i, dp_id in enumerate(self.ids)}
+
+    def remove(self, ids: list[str]):
+        with self._lock:
+            self._detach()
+            self._remove(ids)
+            self._rows = {dp_id: i for i, dp_id in enumerate(self.ids)}
+
+    def _remove(self, ids: list[str]) -> Optional[np.ndarray]:
+        """Drop rows for ids, returning the mask of rows kept if any were dropped."""
+        rows = [self._rows[i] for i in ids if i in self._rows]
+        if not rows:
+            return None
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[rows] = False
+        self.ids = self.ids[keep]
+        self.vectors = self.vectors[keep]
+        self.restricts = [r for r, k in zip(self.restricts, keep) if k]
+        self.postings.remove(keep)
+        return keep
+
+    def allowed(self, filters: list[tuple[str, list[str]]]) -> Optional[np.ndarray]:
+        """Boolean mask of datapoints matching filters, None if unfiltered."""
+        if not filters:
+            return None
+        rows = self.postings.lookup(filters)
+        if rows is not None:
+            mask = np.zeros(len(self.ids), dtype=bool)
+            mask[rows] = True
+            return mask
+        if self.store is not None:
+            return self.store.allowed(filters)
+        return np.array(
+            [
+                all(
+                    not r.get(ns, frozenset()).isdisjoint(tokens)
+                    for ns, tokens in filters
+                )
+                for r in self.restricts
+            ],
+            dtype=bool,
+        )
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: Optional[list[tuple[str, list[str]]]] = None,
+        exclude: Optional[np.ndarray] = None,
+    ) -> list[list[Neighbor]]:
+        """k nearest datapoints for each query, closest first.
+
+        Rows set in the boolean exclude mask are skipped, e.g. tombstones.
+        """
+        filters = filters or []
+        queries = normalize(np.atleast_2d(queries))
+        if queries.shape[1] != self.dimension:
+            raise ValueError(
+                f"Query embedding has dimension {queries.shape[1]} but the "
+                f"local index expects {self.dimension}"
+            )
+        with self._lock:
+            ids, vectors = self.ids, self.vectors
+            rows = self.matching_rows(filters)
+        if exclude is not None and rows is not None:
+            rows = rows[~exclude[rows]]
+        if rows is not None:
+            vectors = vectors[rows]
+            exclude = None
+        if filters:
+            self._count_filtered(len(queries), len(queries) * len(rows), len(ids))
+        live = len(vectors) if exclude is None else len(vectors) - int(exclude.sum())
+        k = min(k, live)
+        if k == 0:
+            return [[] for _ in queries]
+        scores = queries @ vectors.T
+        if exclude is not None:
+            # masked rather than gathered, which would copy the vectors
+            scores[:, exclude] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        if rows is not None:
+            top = rows[top]
+        return [
+            [Neighbor(ids[i], float(1 - s)) for i, s in zip(row, row_scores)]
+            for row, row_scores in zip(top, top_scores)
+        ]
+
+    def matching_rows(
+        self, filters: list[tuple[str, list[str]]]
+    ) -> Optional[np.ndarray]:
+        """Sorted rows matching filters, None if unfiltered."""
+        if not filters:
+            return None
+        rows = self.postings.lookup(filters)
+        if rows is None:
+            rows = np.flatnonzero(self.allowed(filters))
+        return rows
+
+    def _count_filtered(self, queries: int, scanned: int, rows: int):
+        with self._lock:
+            self._filter_counts[0] += queries
+            self._filter_counts[1] += scanned
+            self._filter_counts[2] += queries * rows
+
+    def filter_stats(self) -> FilterStats:
+        """Rows scanned by filtered queries relative to the index size."""
+        with self._lock:
+            return FilterStats(*self._filter_counts)
+
+    def _attach(self, store):
+        """Serve the datapoints of a VectorStore without copying them.
+
+        float32 normalized stores are used in place, so processes opening the
+        same file share its pages. Other stores are converted into memory.
+        Ids are decoded on access and posting lists loaded from the file
+        saved next to the store.
+        """
+        self.store = store
+        self.ids = store.lazy_ids()
+        self.vectors = store.vectors
+        if store.vectors.dtype != np.float32 or not store.normalized:
+            self.vectors = normalize(store.vectors)
+        self.restricts = []
+        self._rows = {}
+        self.postings = PostingLists.for_store(store)
+
+    def _detach(self):
+        """Copy store backed restricts into memory before the first change."""
+        if self.store is None:
+            return
+        self.restricts = [self.store.restricts(i) for i in range(len(self.ids))]
+        self.ids = self.store.ids()
+        self._rows = {dp_id: i for i, dp_id in enumerate(self.ids)}
+        self.store = None
+
+    @classmethod
+    def from_store(cls, store) -> "BruteForceIndex":
+        """Index the datapoints of an open knn.store.VectorStore."""
+        index = cls(store.dimension)
+        index._attach(store)
+        return index
+
+    @classmethod
+    def from_jsonl(cls, path: str) -> "BruteForceIndex":
+        """Load datapoints in the Vertex index JSON lines format."""
+        ids, vectors, restricts = read_jsonl(path)
+        index = cls(vectors.shape[1])
+        index.upsert(ids, vectors, restricts)
+        return index
+
+
+def read_jsonl(path: str) -> tuple[list[str], np.ndarray, list[Restricts]]:
+    """Ids, float32 vectors and restricts from a Vertex JSON lines file."""
+    ids, vectors, restricts = [], [], []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            dp = json.loads(line)
+            ids.append(dp["id"])
+            vectors.append(dp["embedding"])
+            restricts.append(parse_restricts(dp.get("restricts")))
+    if not ids:
+        raise ValueError(f"No datapoints in {path}")
+    return ids, np.array(vectors, dtype=np.float32), restricts
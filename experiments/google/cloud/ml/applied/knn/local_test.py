@@ -0,0 +1,108 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Local Brute Force Index Unit Test."""
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, local
+
+
+def _restricts(*levels):
+    return local.parse_restricts(base.category_restricts(list(levels)))
+
+
+class CategoryRestrictsTest(unittest.TestCase):
+    def test_one_namespace_per_level(self):
+        self.assertEqual(
+            base.category_restricts(["Mens", "Pants", ""]),
+            [
+                {"namespace": "L0", "allow_list": ["Mens"]},
+                {"namespace": "L1", "allow_list": ["Pants"]},
+            ],
+        )
+
+    def test_filter_truncated_to_depth(self):
+        namespaces = base.filter_namespaces(["a", "b", "c", "d", "e"])
+        self.assertEqual(len(namespaces), base.category_depth)
+        self.assertEqual(namespaces[1], ("L1", ["b"]))
+
+
+class BruteForceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = local.BruteForceIndex(3)
+        self.index.upsert(
+            ["1_T", "2_T", "3_T"],
+            np.array([[1, 0, 0], [0.9, 0.1, 0], [0, 1, 0]]),
+            [
+                _restricts("Mens", "Pants"),
+                _restricts("Mens", "Shirts"),
+                _restricts("Womens", "Pants"),
+            ],
+        )
+
+    def test_search(self):
+        res = self.index.search(np.array([[1, 0, 0], [0, 1, 0]]), k=2)
+        self.assertEqual([n.id for n in res[0]], ["1_T", "2_T"])
+        self.assertEqual([n.id for n in res[1]], ["3_T", "2_T"])
+        self.assertAlmostEqual(res[0][0].distance, 0, places=5)
+        self.assertEqual(res[0][0]._fields, ("id", "distance"))
+
+    def test_filters(self):
+        q = np.array([0, 1, 0])
+        res = self.index.search(q, 3, base.filter_namespaces(["Mens"]))
+        self.assertEqual([n.id for n in res[0]], ["2_T", "1_T"])
+        res = self.index.search(q, 3, base.filter_namespaces(["Mens", "Pants"]))
+        self.assertEqual([n.id for n in res[0]], ["1_T"])
+        res = self.index.search(q, 3, base.filter_namespaces(["Kids"]))
+        self.assertEqual(res, [[]])
+
+    def test_upsert_replaces_and_remove(self):
+        self.index.upsert(["1_T"], np.array([[0, 0, 1]]))
+        self.assertEqual(len(self.index), 3)
+        res = self.index.search(np.array([0, 0, 1]), 1)
+        self.assertEqual(res[0][0].id, "1_T")
+        self.index.remove(["1_T", "missing"])
+        self.assertEqual(len(self.index), 2)
+        res = self.index.search(np.array([0, 0, 1]), 5)
+        self.assertEqual({n.id for n in res[0]}, {"2_T", "3_T"})
+
+    def test_wrong_dimension(self):
+        with self.assertRaises(ValueError):
+            self.index.search(np.zeros(4), 1)
+
+    def test_from_jsonl(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "datapoints.json")
+            with open(path, "w") as f:
+                for dp_id, emb, cat in [
+                    ("1_T", [1, 0], "Mens"),
+                    ("1_I", [0, 1], "Womens"),
+                ]:
+                    restricts = [{"namespace": "L0", "allow": [cat]}]
+                    dp = {"id": dp_id, "embedding": emb, "restricts": restricts}
+                    f.write(json.dumps(dp) + "\n")
+            index = local.BruteForceIndex.from_jsonl(path)
+        res = index.search(np.array([1, 0]), 2, base.filter_namespaces(["Womens"]))
+        self.assertEqual([n.id for n in res[0]], ["1_I"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,68 +13,226 @@
 #  limitations under the License.
 
 
-"""Functions for Vertex Vector Search."""
-import logging
-from collections import namedtuple
+"""Nearest neighbor queries against the configured vector search backend."""
+from functools import cache
+from typing import Optional
 
-from google.cloud import aiplatform
-from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import (
-    Namespace,
-)
+import numpy as np
 
 from google.cloud.ml.applied.config import Config
+from google.cloud.ml.applied.embeddings import projection
+from google.cloud.ml.applied.knn import backends, base, result_cache
+from google.cloud.ml.applied.knn.base import Neighbor, ProductNeighbor
 
-Neighbor = namedtuple("Neighbor", ["id", "distance"])
-index_endpoint = aiplatform.MatchingEngineIndexEndpoint(
-    index_endpoint_name=Config.value(Config.SECTION_VECTORS, "endpoint_id"),
-    project=Config.value(Config.SECTION_PROJECT, "id"),
-    location=Config.value(Config.SECTION_PROJECT, "location"),
-)
-
-deployed_index = Config.value(Config.SECTION_VECTORS, "deployed_index")
 number_of_neighbors = Config.value(Config.SECTION_VECTORS, "number_of_neighbors")
-category_depth = Config.value(Config.SECTION_CATEGORY, "depth")
-category_filter = Config.value(Config.SECTION_CATEGORY, "filter")
+fusion = Config.value(Config.SECTION_VECTORS, "fusion")
+index_dimension = Config.value(Config.SECTION_VECTORS, "dimension")
+adaptive = Config.value(Config.SECTION_VECTORS, "adaptive")
+adaptive_max_distance = Config.value(Config.SECTION_VECTORS, "adaptive_max_distance")
+adaptive_max_gap = Config.value(Config.SECTION_VECTORS, "adaptive_max_gap")
+adaptive_min_neighbors = Config.value(Config.SECTION_VECTORS, "adaptive_min_neighbors")
+adaptive_max_neighbors = Config.value(Config.SECTION_VECTORS, "adaptive_max_neighbors")
+
+
+@cache
+def get_result_cache() -> Optional[result_cache.NeighborCache]:
+    """Shared result cache, None if [vectors] result_cache_entries is 0."""
+    entries = Config.value(Config.SECTION_VECTORS, "result_cache_entries")
+    if not entries:
+        return None
+    neighbor_cache = result_cache.NeighborCache(
+        entries,
+        ttl=Config.value(Config.SECTION_VECTORS, "result_cache_ttl"),
+        resolution=Config.value(Config.SECTION_VECTORS, "result_cache_resolution"),
+        # streaming upserts reach Vertex searches after a delay, local
+        # backends see writes immediately
+        readmit_after=(
+            Config.value(Config.SECTION_VECTORS, "result_cache_readmit_after")
+            if Config.value(Config.SECTION_VECTORS, "backend") == "vertex"
+            else 0
+        ),
+    )
+    result_cache.subscribe(neighbor_cache.invalidate)
+    return neighbor_cache
+
+
+def search_neighbors(
+    embeds: list[np.ndarray],
+    namespaces: list[tuple[str, list[str]]],
+    num_neighbors: int,
+) -> list[list[Neighbor]]:
+    """Uncached nearest neighbors of each embedding from the configured backend."""
+    return backends.get_backend().batch_query(embeds, namespaces, num_neighbors)
 
 
 def get_nn(
-    embeds: list[list[float]],
+    embeds: list[np.ndarray],
     filters: list[str] = [],
     num_neighbors: int = number_of_neighbors,
+    adaptive: Optional[bool] = None,
 ) -> list[Neighbor]:
     """Fetch nearest neighbors in vector store.
 
     Neighbors are fetched independently for each embedding then unioned.
+    Results are served from the result cache when enabled.
+
+    In adaptive mode each embedding's neighbors are cut off at [vectors]
+    adaptive_max_distance or at a relative distance jump of adaptive_max_gap,
+    see base.cutoff. When nothing is cut off, the neighbors past
+    num_neighbors may still qualify, and they are fetched again with up to
+    adaptive_max_neighbors.
 
     Args:
-        embeds: list of embeddings to find neareast neighbors
+        embeds: list of embeddings to find neareast neighbors, float32 arrays
+            as returned by embeddings.embed() or lists of floats. If
+            [vectors] projection is configured they are projected first
         filters: category prefix to restrict results to
         - example 1: ['Mens']
             will only return suggestiongs with top level category 'Mens'
         - example 2: ['Mens', 'Pants']
             will only return suggestions with top level category 'Mens'
             and second level category 'Pants'
-        num_neighbors: number of nearest neighbors to return for EACH embedding
+        num_neighbors: number of nearest neighbors to return for EACH embedding,
+            the number fetched first in adaptive mode
+        adaptive: override [vectors] adaptive
 
     Returns:
         A list of named tuples containing the the following attributes
             id: unique item identifier, usually used to join to a reference DB
             distance: the embedding distance
     """
-    if len(filters) > category_depth:
-        logging.warning(
-            f"""Number of category filters {len(filters)} is greater
-         than supported category depth {category_depth}. Truncating"""
-        )
-        filters = filters[:category_depth]
+    return [
+        n
+        for neighbors in adaptive_nn(embeds, filters, num_neighbors, adaptive)
+        for n in neighbors
+    ]
+
+
+def get_product_nn(
+    embeds: list[np.ndarray],
+    filters: Optional[list[str]] = None,
+    num_neighbors: int = number_of_neighbors,
+    adaptive: Optional[bool] = None,
+) -> list[ProductNeighbor]:
+    """Fetch nearest products in vector store.
+
+    Like get_nn, but the text (<id>_T) and image (<id>_I) datapoints of a
+    product are fused into a single candidate, ordered by [vectors] fusion.
+    In adaptive mode the neighbors of each embedding are cut off before
+    fusion.
+
+    Returns:
+        A list of named tuples, best first, containing the following attributes
+            id: product ID, without the datapoint suffix
+            distance: closest embedding distance of any of the product's datapoints
+            text_distance: distance of the text datapoint, None if not returned
+            image_distance: distance of the image datapoint, None if not returned
+            score: fusion score, higher is better
+    """
+    return base.fuse(
+        adaptive_nn(embeds, filters or [], num_neighbors, adaptive), fusion
+    )
+
 
-    filters = [Namespace(category_filter[i], [f]) for i, f in enumerate(filters)]
+def get_nn_batch(
+    embeds_matrix: np.ndarray,
+    filters_per_row: Optional[list[list[str]]] = None,
+    num_neighbors: int = number_of_neighbors,
+) -> list[list[Neighbor]]:
+    """Fetch nearest neighbors for many query embeddings in one call.
+
+    Intended for bulk jobs such as categorizing a whole feed. Rows sharing a
+    filter are searched together: local backends score them with tiled
+    matrix multiplies, Vertex with concurrent multi-query requests, see
+    [vectors] batch_* in app.toml. The result cache is bypassed.
 
-    response = index_endpoint.find_neighbors(
-        deployed_index_id=deployed_index,
-        queries=embeds,
-        num_neighbors=num_neighbors,
-        filter=filters,
+    Args:
+        embeds_matrix: (n, dimension) query embeddings, projected first if
+            [vectors] projection is configured
+        filters_per_row: category prefix filter of each row, see get_nn.
+            None for no filters
+        num_neighbors: number of nearest neighbors to return for EACH row
+
+    Returns:
+        n lists of closest first neighbors, the i-th for the i-th row
+    """
+    embeds_matrix = projection.project(np.atleast_2d(embeds_matrix))
+    if embeds_matrix.shape[1] != index_dimension:
+        raise ValueError(
+            f"Query embeddings have dimension {embeds_matrix.shape[1]} but the "
+            f"vector search index expects {index_dimension}, check [models] "
+            "embedding_dimension, [vectors] dimension and projection in app.toml"
+        )
+    if filters_per_row is None:
+        filters_per_row = [[]] * len(embeds_matrix)
+    if len(filters_per_row) != len(embeds_matrix):
+        raise ValueError(
+            f"{len(filters_per_row)} filters for {len(embeds_matrix)} query rows"
+        )
+    return backends.get_backend().search_batch(
+        embeds_matrix,
+        [base.filter_namespaces(filters) for filters in filters_per_row],
+        num_neighbors,
     )
 
-    return [Neighbor(r.id, r.distance) for neighbor in response for r in neighbor]
+
+def adaptive_nn(
+    embeds: list[np.ndarray],
+    filters: list[str],
+    num_neighbors: int,
+    enabled: Optional[bool] = None,
+) -> list[list[Neighbor]]:
+    """query_nn, cut off by distance in adaptive mode, see get_nn."""
+    enabled = adaptive if enabled is None else enabled
+    response = list(query_nn(embeds, filters, num_neighbors))
+    if not enabled:
+        return response
+
+    def cut(neighbors: list[Neighbor]) -> list[Neighbor]:
+        return base.cutoff(
+            neighbors,
+            adaptive_max_distance,
+            adaptive_max_gap,
+            adaptive_min_neighbors,
+        )
+
+    ambiguous = [
+        i
+        for i, neighbors in enumerate(response)
+        if len(neighbors) == num_neighbors and len(cut(neighbors)) == num_neighbors
+    ]
+    if ambiguous and adaptive_max_neighbors > num_neighbors:
+        more = query_nn([embeds[i] for i in ambiguous], filters, adaptive_max_neighbors)
+        for i, neighbors in zip(ambiguous, more):
+            response[i] = neighbors
+    return [cut(neighbors) for neighbors in response]
+
+
+def query_nn(
+    embeds: list[np.ndarray],
+    filters: list[str],
+    num_neighbors: int,
+) -> list[list[Neighbor]]:
+    """Closest first neighbors of each embedding, see get_nn."""
+    embeds = list(projection.project(embeds))
+    for emb in embeds:
+        if len(emb) != index_dimension:
+            raise ValueError(
+                f"Query embedding has dimension {len(emb)} but the vector search "
+                f"index expects {index_dimension}, check [models] "
+                "embedding_dimension, [vectors] dimension and projection in app.toml"
+            )
+
+    namespaces = base.filter_namespaces(filters)
+
+    neighbor_cache = get_result_cache()
+    if neighbor_cache is None:
+        response = search_neighbors(embeds, namespaces, num_neighbors)
+    else:
+        response = neighbor_cache.search(
+            embeds,
+            namespaces,
+            num_neighbors,
+            lambda misses: search_neighbors(misses, namespaces, num_neighbors),
+        )
+    return response
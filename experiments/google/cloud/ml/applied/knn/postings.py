@@ -0,0 +1,195 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Category prefix posting lists for filtered nearest neighbor queries.
+
+Every category prefix of a datapoint, e.g. (Mens,) and (Mens, Pants), maps
+to a sorted array of the index rows holding it. A get_nn filter is always
+a prefix, so its matching rows are a single lookup and a filtered query only
+scores that subset.
+
+Posting lists of a knn.store file are saved next to it and memory mapped
+on the next load, see PostingLists.for_store.
+"""
+import logging
+import os
+from itertools import product
+from typing import Iterable, NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import arrays
+from google.cloud.ml.applied.knn.base import category_filter
+
+SUFFIX = ".postings"
+
+
+class PostingStats(NamedTuple):
+    lists: int
+    entries: int  # total rows over all lists
+    largest: int  # rows in the longest list
+
+
+class PostingLists:
+    """Sorted row arrays keyed by category prefix.
+
+    Args:
+        namespaces: restrict namespaces of the category levels, in order
+    """
+
+    def __init__(self, namespaces: Iterable[str] = category_filter):
+        self.namespaces = list(namespaces)
+        self.rows = 0
+        self._lists: dict[tuple[str, ...], np.ndarray] = {}
+
+    def _prefixes(self, restricts: dict) -> Iterable[tuple[str, ...]]:
+        levels = []
+        for ns in self.namespaces:
+            if not restricts.get(ns):
+                break
+            levels.append(sorted(restricts[ns]))
+            yield from product(*levels)
+
+    def add(self, restricts: list[dict]):
+        """Append rows, in order, after the rows already indexed."""
+        new = {}
+        for row, r in enumerate(restricts, start=self.rows):
+            for prefix in self._prefixes(r):
+                new.setdefault(prefix, []).append(row)
+        for prefix, rows in new.items():
+            rows = np.array(rows, dtype=np.int64)
+            if prefix in self._lists:
+                rows = np.concatenate([self._lists[prefix], rows])
+            self._lists[prefix] = rows
+        self.rows += len(restricts)
+
+    def remove(self, keep: np.ndarray):
+        """Drop rows where keep is False and renumber the rest."""
+        renumber = np.cumsum(keep) - 1
+        for prefix, rows in list(self._lists.items()):
+            rows = renumber[rows[keep[rows]]]
+            if len(rows):
+                self._lists[prefix] = rows
+            else:
+                del self._lists[prefix]
+        self.rows = int(keep.sum())
+
+    def lookup(self, filters: list[tuple[str, list[str]]]) -> Optional[np.ndarray]:
+        """Sorted rows matching filters.
+
+        Returns:
+            None when filters are not a category prefix, so the caller must
+            evaluate them another way.
+        """
+        if [ns for ns, _ in filters] != self.namespaces[: len(filters)]:
+            return None
+        matches = [
+            self._lists.get(prefix, np.empty(0, dtype=np.int64))
+            for prefix in product(*(tokens for _, tokens in filters))
+        ]
+        if len(matches) == 1:
+            return matches[0]
+        return np.unique(np.concatenate(matches))
+
+    def selectivity(self, filters: list[tuple[str, list[str]]]) -> Optional[float]:
+        """Fraction of rows matching filters, None if not a category prefix."""
+        rows = self.lookup(filters)
+        if rows is None:
+            return None
+        return len(rows) / self.rows if self.rows else 0.0
+
+    def stats(self) -> PostingStats:
+        sizes = [len(rows) for rows in self._lists.values()]
+        return PostingStats(
+            lists=len(sizes), entries=sum(sizes), largest=max(sizes, default=0)
+        )
+
+    def save(self, path: str, fingerprint: str = ""):
+        """Write the lists to path, fingerprint identifies the rows they index."""
+        prefixes = list(self._lists)
+        sizes = [len(self._lists[prefix]) for prefix in prefixes]
+        rows = [self._lists[prefix] for prefix in prefixes]
+        arrays.write(
+            path,
+            {
+                "store": fingerprint,
+                "namespaces": self.namespaces,
+                "rows": self.rows,
+                "prefixes": [list(prefix) for prefix in prefixes],
+                "bounds": np.concatenate([[0], np.cumsum(sizes)]).tolist(),
+            },
+            rows=np.concatenate(rows) if rows else np.empty(0, dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path: str, fingerprint: str = "") -> "PostingLists":
+        """Memory map lists saved by save, ValueError if saved for other rows."""
+        meta, saved = arrays.read(path)
+        if meta["store"] != fingerprint:
+            raise ValueError(f"{path} was saved for another version of the store")
+        postings = cls(meta["namespaces"])
+        if postings.namespaces != list(category_filter):
+            raise ValueError(f"{path} was saved for other [category] namespaces")
+        postings.rows = meta["rows"]
+        bounds = meta["bounds"]
+        for i, prefix in enumerate(meta["prefixes"]):
+            postings._lists[tuple(prefix)] = saved["rows"][bounds[i] : bounds[i + 1]]
+        return postings
+
+    @classmethod
+    def for_store(cls, store) -> "PostingLists":
+        """Posting lists of a knn.store.VectorStore.
+
+        Loaded from the file saved next to the store when it is up to date,
+        otherwise built from the restrict columns and saved there.
+        """
+        path = store.path + SUFFIX
+        try:
+            return cls.load(path, store.fingerprint)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.info(f"Rebuilding posting lists: {e}")
+        postings = cls.from_store(store)
+        # stores mapped from an unlinked file have nowhere to save to
+        if os.path.exists(store.path):
+            try:
+                postings.save(path, store.fingerprint)
+            except OSError as e:
+                logging.warning(f"Unable to save posting lists to {path}: {e}")
+        return postings
+
+    @classmethod
+    def from_store(cls, store) -> "PostingLists":
+        """Build from the restrict columns of a knn.store.VectorStore."""
+        postings = cls()
+        postings.rows = len(store)
+        columns = []
+        for ns in postings.namespaces:
+            if ns not in store.namespaces:
+                break
+            columns.append(store.codes[:, store.namespaces.index(ns)])
+            codes = np.stack(columns, axis=1)
+            present = np.flatnonzero(codes.all(axis=1))
+            keys, groups = np.unique(codes[present], axis=0, return_inverse=True)
+            order = np.argsort(groups.ravel(), kind="stable")
+            bounds = np.searchsorted(groups.ravel()[order], np.arange(len(keys) + 1))
+            for i, key in enumerate(keys):
+                prefix = tuple(
+                    store.tokens[ns][code - 1]
+                    for ns, code in zip(postings.namespaces, key.tolist())
+                )
+                postings._lists[prefix] = present[order[bounds[i] : bounds[i + 1]]]
+        return postings
@@ -0,0 +1,128 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Posting Lists Unit Test."""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, local, postings, store
+
+CATEGORIES = [
+    ["Mens", "Pants"],
+    ["Mens", "Shirts"],
+    ["Womens", "Pants"],
+    ["Mens", "Pants", "Jeans"],
+    [],
+]
+
+
+def _restricts():
+    return [local.parse_restricts(base.category_restricts(c)) for c in CATEGORIES]
+
+
+class PostingListsTest(unittest.TestCase):
+    def setUp(self):
+        self.postings = postings.PostingLists()
+        self.postings.add(_restricts())
+
+    def lookup(self, *levels):
+        return self.postings.lookup(base.filter_namespaces(list(levels))).tolist()
+
+    def test_lookup(self):
+        self.assertEqual(self.lookup("Mens"), [0, 1, 3])
+        self.assertEqual(self.lookup("Mens", "Pants"), [0, 3])
+        self.assertEqual(self.lookup("Pants"), [])
+        self.assertEqual(
+            self.postings.lookup([("L0", ["Mens", "Womens"])]).tolist(), [0, 1, 2, 3]
+        )
+        self.assertIsNone(self.postings.lookup([("L1", ["Pants"])]))
+        self.assertAlmostEqual(
+            self.postings.selectivity(base.filter_namespaces(["Mens"])), 0.6
+        )
+
+    def test_add_and_remove(self):
+        self.postings.add([local.parse_restricts(base.category_restricts(["Mens"]))])
+        self.assertEqual(self.lookup("Mens"), [0, 1, 3, 5])
+        self.postings.remove(np.array([False, True, True, True, True, True]))
+        self.assertEqual(self.lookup("Mens"), [0, 2, 4])
+        self.assertEqual(self.lookup("Mens", "Pants"), [2])
+        self.assertEqual(self.postings.rows, 5)
+
+    def test_stats(self):
+        stats = self.postings.stats()
+        self.assertEqual(stats.lists, 6)
+        self.assertEqual(stats.largest, 3)
+
+    def test_from_store(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "catalog" + store.SUFFIX)
+            ids = [str(i) for i in range(len(CATEGORIES))]
+            store.VectorStore.write(path, ids, np.eye(5), _restricts())
+            built = postings.PostingLists.from_store(store.VectorStore.open(path))
+        self.assertEqual(built._lists.keys(), self.postings._lists.keys())
+        for prefix, rows in self.postings._lists.items():
+            self.assertEqual(built._lists[prefix].tolist(), rows.tolist())
+
+    def test_for_store_saved(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "catalog" + store.SUFFIX)
+            ids = [str(i) for i in range(len(CATEGORIES))]
+            store.VectorStore.write(path, ids, np.eye(5), _restricts())
+            built = postings.PostingLists.for_store(store.VectorStore.open(path))
+            self.assertTrue(os.path.exists(path + postings.SUFFIX))
+            with mock.patch.object(
+                postings.PostingLists, "from_store", side_effect=AssertionError
+            ):
+                loaded = postings.PostingLists.for_store(store.VectorStore.open(path))
+            self.assertEqual(loaded.rows, 5)
+            self.assertEqual(loaded._lists.keys(), built._lists.keys())
+            for prefix, rows in built._lists.items():
+                self.assertEqual(loaded._lists[prefix].tolist(), rows.tolist())
+
+            # a rewritten store is indexed again
+            store.VectorStore.write(path, ids, np.eye(5), _restricts()[::-1])
+            rebuilt = postings.PostingLists.for_store(store.VectorStore.open(path))
+            self.assertEqual(
+                rebuilt.lookup(base.filter_namespaces(["Womens"])).tolist(), [2]
+            )
+
+
+class FilteredSearchTest(unittest.TestCase):
+    def test_consistent_with_upsert_remove(self):
+        index = local.BruteForceIndex(5)
+        ids = [f"{i}_T" for i in range(len(CATEGORIES))]
+        index.upsert(ids, np.eye(5), _restricts())
+        filters = base.filter_namespaces(["Mens", "Pants"])
+        res = index.search(np.ones(5), 5, filters)
+        self.assertEqual({n.id for n in res[0]}, {"0_T", "3_T"})
+
+        index.remove(["0_T"])
+        index.upsert(["3_T"], np.eye(5)[:1], [{}])
+        index.upsert(["new"], np.eye(5)[:1], _restricts()[:1])
+        res = index.search(np.ones(5), 5, filters)
+        self.assertEqual([n.id for n in res[0]], ["new"])
+
+        stats = index.filter_stats()
+        self.assertEqual(stats.queries, 2)
+        self.assertLess(stats.selectivity, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
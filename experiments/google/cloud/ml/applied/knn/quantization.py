@@ -0,0 +1,323 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Quantized candidate scan with full precision re-rank.
+
+Vectors of a knn.store.VectorStore are compressed to one byte per dimension
+(8-bit scalar quantization, 4x smaller than float32) or one byte per
+subvector (product quantization, 16x smaller with the default 4 dimensions
+per subvector). Queries scan the codes for rerank * k candidates, then
+re-rank those exactly with the full precision vectors read from the store.
+The quantizer and codes are saved next to the store and memory mapped back
+with it.
+"""
+import threading
+from typing import Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import arrays
+from google.cloud.ml.applied.knn.base import Neighbor, ReadOnlyIndexError
+from google.cloud.ml.applied.knn.local import FilterStats, normalize
+from google.cloud.ml.applied.knn.postings import PostingLists
+
+SCAN_ROWS = 65536  # rows of codes decoded per block during a scan
+
+
+class ScalarQuantizer:
+    """Per dimension 8-bit quantization, x ~ low + code * scale."""
+
+    kind = "int8"
+
+    def __init__(self, low: np.ndarray, scale: np.ndarray):
+        self.low = np.asarray(low, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def train(cls, sample: np.ndarray, **_) -> "ScalarQuantizer":
+        low, high = sample.min(axis=0), sample.max(axis=0)
+        scale = np.maximum(high - low, 1e-12) / 255
+        return cls(low, scale)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, np.float32) - self.low) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Approximate dot products of queries with encoded vectors."""
+        return queries @ self.low[:, None] + (queries * self.scale) @ codes.T.astype(
+            np.float32
+        )
+
+    def params(self) -> dict:
+        return {"low": self.low, "scale": self.scale}
+
+
+class ProductQuantizer:
+    """Splits vectors into m subvectors, each encoded as its nearest of 256 centroids."""
+
+    kind = "pq"
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = np.asarray(centroids, dtype=np.float32)  # (m, 256, d / m)
+
+    @property
+    def m(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(
+        cls, sample: np.ndarray, m: int = 0, iterations: int = 20, seed: int = 0
+    ) -> "ProductQuantizer":
+        dimension = sample.shape[1]
+        m = m or dimension // 4
+        if dimension % m:
+            raise ValueError(f"Dimension {dimension} is not divisible by m = {m}")
+        rng = np.random.default_rng(seed)
+        sub = sample.reshape(len(sample), m, -1)
+        k = min(256, len(sample))
+        centroids = np.zeros((m, 256, dimension // m), dtype=np.float32)
+        for j in range(m):
+            centroids[j, :k] = _kmeans(sub[:, j], k, iterations, rng)
+            centroids[j, k:] = centroids[j, 0]
+        return cls(centroids)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        sub = np.asarray(vectors, np.float32).reshape(len(vectors), self.m, -1)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _nearest(sub[:, j], self.centroids[j])
+        return codes
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Approximate dot products from per subvector lookup tables."""
+        tables = np.einsum(
+            "qjd,jcd->qjc", queries.reshape(len(queries), self.m, -1), self.centroids
+        )
+        out = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            out += tables[:, j, codes[:, j]]
+        return out
+
+    def params(self) -> dict:
+        return {"centroids": self.centroids}
+
+
+QUANTIZERS = {q.kind: q for q in (ScalarQuantizer, ProductQuantizer)}
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    d = (centroids**2).sum(axis=1) - 2 * vectors @ centroids.T
+    return np.argmin(d, axis=1)
+
+
+def _kmeans(
+    vectors: np.ndarray, k: int, iterations: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Euclidean k-means."""
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids
+
+
+class QuantizedIndex:
+    """Read only index over the datapoints of a VectorStore.
+
+    Upserts and removals raise ReadOnlyIndexError, wrap the index in a
+    segments.SegmentedIndex for live updates.
+
+    Args:
+        store: knn.store.VectorStore holding the full precision vectors
+        quantizer: trained ScalarQuantizer or ProductQuantizer
+        codes: quantizer codes for every row of the store
+        rerank: candidates re-ranked exactly per query, as a multiple of k
+    """
+
+    read_only = True
+
+    def __init__(self, store, quantizer, codes: np.ndarray, rerank: int = 10):
+        if len(codes) != len(store):
+            raise ValueError(
+                f"{len(codes)} codes for a store of {len(store)} datapoints, "
+                "rebuild the quantized index"
+            )
+        self.store = store
+        self.dimension = store.dimension
+        self.quantizer = quantizer
+        self.codes = codes
+        self.rerank = rerank
+        self.ids = store.lazy_ids()
+        self.postings = PostingLists.for_store(store)
+        self._filter_counts = [0, 0, 0]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def compression(self) -> float:
+        """Size of the float32 vectors relative to the codes."""
+        return 4 * self.dimension / self.codes.shape[1]
+
+    @classmethod
+    def build(
+        cls,
+        store,
+        kind: str = "int8",
+        sample_size: int = 100000,
+        rerank: int = 10,
+        seed: int = 0,
+        **train_args,
+    ) -> "QuantizedIndex":
+        """Train a quantizer on a sample of the store and encode every row."""
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(len(store), min(sample_size, len(store)), False))
+        quantizer = QUANTIZERS[kind].train(_rows(store, rows), **train_args)
+        codes = np.concatenate(
+            [
+                quantizer.encode(_rows(store, slice(i, i + SCAN_ROWS)))
+                for i in range(0, len(store), SCAN_ROWS)
+            ]
+        )
+        return cls(store, quantizer, codes, rerank)
+
+    def save(self, path: str):
+        arrays.write(
+            path,
+            {
+                "kind": self.quantizer.kind,
+                "store": self.store.fingerprint,
+                "rerank": self.rerank,
+            },
+            codes=self.codes,
+            **self.quantizer.params(),
+        )
+
+    @classmethod
+    def load(cls, path: str, store) -> "QuantizedIndex":
+        """Memory map codes saved for store, ValueError if the store has changed since."""
+        meta, saved = arrays.read(path)
+        if meta["store"] != store.fingerprint:
+            raise ValueError(
+                f"{path} was saved for another version of {store.path}, "
+                "rebuild the quantized index"
+            )
+        codes = saved.pop("codes")
+        return cls(store, QUANTIZERS[meta["kind"]](**saved), codes, meta["rerank"])
+
+    def upsert(self, ids, vectors, restricts=None):
+        raise ReadOnlyIndexError(
+            "Quantized indexes are read only, enable [vectors] segments for live "
+            "updates"
+        )
+
+    def remove(self, ids):
+        raise ReadOnlyIndexError(
+            "Quantized indexes are read only, enable [vectors] segments for live "
+            "updates"
+        )
+
+    def candidates(
+        self, queries: np.ndarray, n: int, rows: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Rows of the n best approximate matches per query, scanning codes.
+
+        Only rows are scanned if given, all rows otherwise.
+        """
+        rows = np.arange(len(self)) if rows is None else rows
+        n = min(n, len(rows))
+        scores = np.empty((len(queries), len(rows)), dtype=np.float32)
+        for i in range(0, len(rows), SCAN_ROWS):
+            block = rows[i : i + SCAN_ROWS]
+            scores[:, i : i + len(block)] = self.quantizer.scores(
+                queries, self.codes[block]
+            )
+        if n == 0:
+            return np.empty((len(queries), 0), dtype=np.int64)
+        return rows[np.argpartition(-scores, n - 1, axis=1)[:, :n]]
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: Optional[list[tuple[str, list[str]]]] = None,
+        exclude: Optional[np.ndarray] = None,
+    ) -> list[list[Neighbor]]:
+        """k nearest datapoints for each query, closest first.
+
+        Rows set in the boolean exclude mask are skipped, e.g. tombstones.
+        """
+        filters = filters or []
+        queries = normalize(np.atleast_2d(queries))
+        if queries.shape[1] != self.dimension:
+            raise ValueError(
+                f"Query embedding has dimension {queries.shape[1]} but the "
+                f"local index expects {self.dimension}"
+            )
+        rows = None
+        if filters:
+            rows = self.postings.lookup(filters)
+            if rows is None:
+                rows = np.flatnonzero(self.store.allowed(filters))
+            with self._lock:
+                self._filter_counts[0] += len(queries)
+                self._filter_counts[1] += len(queries) * len(rows)
+                self._filter_counts[2] += len(queries) * len(self)
+        if exclude is not None:
+            rows = np.flatnonzero(~exclude) if rows is None else rows[~exclude[rows]]
+        candidates = self.candidates(queries, self.rerank * k, rows)
+        results = []
+        for query, rows in zip(queries, candidates):
+            rows = np.sort(rows)  # sequential reads from the store
+            scores = _rows(self.store, rows) @ query
+            top = np.argsort(-scores)[:k]
+            results.append(
+                [Neighbor(self.ids[rows[i]], float(1 - scores[i])) for i in top]
+            )
+        return results
+
+    def filter_stats(self) -> FilterStats:
+        """Codes scanned by filtered queries relative to the index size."""
+        with self._lock:
+            return FilterStats(*self._filter_counts)
+
+    def evaluate(self, queries: np.ndarray, k: int) -> float:
+        """Recall@k against exact search over the full precision store."""
+        queries = normalize(np.atleast_2d(queries))
+        exact = np.empty((len(queries), len(self)), dtype=np.float32)
+        for i in range(0, len(self), SCAN_ROWS):
+            exact[:, i : i + SCAN_ROWS] = (
+                queries @ _rows(self.store, slice(i, i + SCAN_ROWS)).T
+            )
+        k = min(k, len(self))
+        truth = np.argpartition(-exact, k - 1, axis=1)[:, :k]
+        approx = self.search(queries, k)
+        hits = [
+            len(set(self.ids[t]) & {n.id for n in a}) for t, a in zip(truth, approx)
+        ]
+        return sum(hits) / (k * len(queries))
+
+
+def _rows(store, rows) -> np.ndarray:
+    """Full precision, unit length float32 rows of a store."""
+    vectors = np.asarray(store.vectors[rows], dtype=np.float32)
+    return vectors if store.normalized else normalize(vectors)
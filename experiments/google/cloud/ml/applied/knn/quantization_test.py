@@ -0,0 +1,129 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Quantized Index Unit Test."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, loaders, local, quantization, store
+
+
+def _vectors(n: int, dim: int = 64, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((16, dim))
+    return centers[rng.integers(0, 16, n)] + 0.5 * rng.standard_normal((n, dim))
+
+
+class QuantizedIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.dir.name, "catalog" + store.SUFFIX)
+        ids = [f"{i}_T" for i in range(3000)]
+        restricts = [
+            local.parse_restricts(
+                base.category_restricts(["Mens" if i % 3 else "Kids"])
+            )
+            for i in range(3000)
+        ]
+        store.VectorStore.write(cls.path, ids, _vectors(3000), restricts)
+        cls.store = store.VectorStore.open(cls.path)
+        cls.queries = _vectors(100, seed=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def test_int8_recall(self):
+        index = quantization.QuantizedIndex.build(self.store, "int8")
+        self.assertEqual(index.compression, 4)
+        self.assertGreater(index.evaluate(self.queries, 7), 0.98)
+
+    def test_pq_recall(self):
+        index = quantization.QuantizedIndex.build(self.store, "pq")
+        self.assertEqual(index.compression, 16)
+        self.assertGreater(index.evaluate(self.queries, 7), 0.98)
+
+    def test_matches_exact_order(self):
+        index = quantization.QuantizedIndex.build(self.store, "int8")
+        exact = local.BruteForceIndex.from_store(self.store)
+        approx = index.search(self.queries[:5], 3)
+        for a, e in zip(approx, exact.search(self.queries[:5], 3)):
+            self.assertEqual([n.id for n in a], [n.id for n in e])
+            self.assertAlmostEqual(a[0].distance, e[0].distance, places=5)
+
+    def test_filters(self):
+        index = quantization.QuantizedIndex.build(self.store, "int8")
+        res = index.search(self.queries, 7, base.filter_namespaces(["Kids"]))
+        for neighbors in res:
+            self.assertEqual(len(neighbors), 7)
+            self.assertTrue(all(int(n.id[:-2]) % 3 == 0 for n in neighbors))
+
+    def test_save_load(self):
+        for kind in quantization.QUANTIZERS:
+            index = quantization.QuantizedIndex.build(self.store, kind, rerank=5)
+            path = f"{self.path}.{kind}"
+            index.save(path)
+            loaded = quantization.QuantizedIndex.load(path, self.store)
+            self.assertEqual(loaded.rerank, 5)
+            self.assertEqual(
+                loaded.search(self.queries[:3], 7), index.search(self.queries[:3], 7)
+            )
+
+    def test_stale_codes(self):
+        index = quantization.QuantizedIndex.build(self.store, "int8")
+        with self.assertRaises(ValueError):
+            quantization.QuantizedIndex(self.store, index.quantizer, index.codes[:10])
+
+    def test_rewritten_store(self):
+        path = os.path.join(self.dir.name, "rewritten" + store.SUFFIX)
+        ids = [f"{i}_T" for i in range(3000)]
+        store.VectorStore.write(path, ids, _vectors(3000), [{}] * 3000)
+        index = loaders.load_local_index(path, quantization_kind="int8")
+        # re-embedded with the same ids and row count
+        store.VectorStore.write(path, ids, _vectors(3000, seed=2), [{}] * 3000)
+        with self.assertRaisesRegex(ValueError, "another version"):
+            quantization.QuantizedIndex.load(
+                f"{path}.int8", store.VectorStore.open(path)
+            )
+        reloaded = loaders.load_local_index(path, quantization_kind="int8")
+        self.assertFalse(np.array_equal(reloaded.codes, index.codes))
+        exact = local.BruteForceIndex.from_store(store.VectorStore.open(path))
+        self.assertEqual(
+            [n.id for n in reloaded.search(self.queries[:1], 3)[0]],
+            [n.id for n in exact.search(self.queries[:1], 3)[0]],
+        )
+        # and reused while the store is unchanged
+        self.assertTrue(
+            np.array_equal(
+                loaders.load_local_index(path, quantization_kind="int8").codes,
+                reloaded.codes,
+            )
+        )
+
+    def test_read_only(self):
+        index = quantization.QuantizedIndex.build(self.store, "int8")
+        with self.assertRaises(base.ReadOnlyIndexError):
+            index.upsert(["x"], np.ones((1, 64)))
+        with self.assertRaises(base.ReadOnlyIndexError):
+            index.remove(["0_T"])
+
+
+if __name__ == "__main__":
+    unittest.main()
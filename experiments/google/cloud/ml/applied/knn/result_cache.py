@@ -0,0 +1,238 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Nearest neighbor result cache invalidated by index writes.
+
+Results are cached per query embedding, keyed by the embedding quantized to
+a grid (so near identical embeddings share an entry), the filters and the
+number of neighbors. Writes through embeddings.search publish invalidation
+events to every cache in the process:
+
+- removing a datapoint evicts entries whose results contain it
+- upserting a datapoint evicts entries whose results contain it, and entries
+  whose filters it matches when it is closer to the cached query than the
+  entry's k-th neighbor
+
+Writes made by other processes are only picked up when entries expire. When
+writes become visible to searches some time after they are made (Vertex
+streaming updates), readmit_after holds off caching results for that long
+after each invalidation, so results read before the write is visible are not
+cached again.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn.base import Neighbor
+
+Filters = list[tuple[str, list[str]]]
+
+_subscribers: list[Callable[[str, list[str], Optional[np.ndarray], list], None]] = []
+
+
+def subscribe(fn: Callable[[str, list[str], Optional[np.ndarray], list], None]):
+    """Call fn(kind, ids, vectors, restricts) on every published write."""
+    _subscribers.append(fn)
+
+
+def publish_upsert(ids: list[str], vectors: np.ndarray, restricts: list[dict]):
+    for fn in _subscribers:
+        fn("upsert", ids, vectors, restricts)
+
+
+def publish_remove(ids: list[str]):
+    for fn in _subscribers:
+        fn("remove", ids, None, [])
+
+
+class ResultCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    invalidated: int  # entries evicted by write events
+    expired: int  # entries dropped after ttl
+    evicted: int  # entries dropped by the size bound
+    hit_age: float  # mean age in seconds of the entries served
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class _Entry(NamedTuple):
+    query: np.ndarray  # unit length query embedding
+    filters: Filters
+    neighbors: list[Neighbor]
+    kth_distance: float
+    created: float
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / max(float(np.linalg.norm(vector)), np.finfo(np.float32).tiny)
+
+
+def _matches(restricts: dict, filters: Filters) -> bool:
+    return all(not restricts.get(ns, frozenset()).isdisjoint(t) for ns, t in filters)
+
+
+class NeighborCache:
+    """TTL and size bounded cache of per query nearest neighbor results.
+
+    Args:
+        max_entries: entries kept, least recently used are evicted first
+        ttl: seconds an entry is served for
+        resolution: grid steps per unit used to quantize query embeddings,
+            higher values make near identical queries less likely to collide
+        readmit_after: seconds after an invalidation during which results
+            are not cached
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl: float = 300,
+        resolution=64,
+        readmit_after: float = 0,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.resolution = resolution
+        self.readmit_after = readmit_after
+        self._readmit_at = 0.0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(ResultCacheStats._fields, 0)
+
+    def key(self, embedding: np.ndarray, filters: Filters, k: int) -> str:
+        grid = np.rint(_normalize(embedding) * self.resolution).astype(np.int16)
+        h = hashlib.sha256(grid.tobytes())
+        h.update(repr((filters, k)).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[list[Neighbor]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and now - entry.created > self.ttl:
+                del self._entries[key]
+                self._counts["expired"] += 1
+                entry = None
+            if entry is None:
+                self._counts["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counts["hits"] += 1
+            self._counts["hit_age"] += now - entry.created
+            return entry.neighbors
+
+    def put(
+        self,
+        key: str,
+        embedding: np.ndarray,
+        filters: Filters,
+        k: int,
+        neighbors: list[Neighbor],
+    ):
+        kth = neighbors[k - 1].distance if len(neighbors) >= k else np.inf
+        entry = _Entry(_normalize(embedding), filters, neighbors, kth, time.monotonic())
+        with self._lock:
+            if entry.created < self._readmit_at:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts["evicted"] += 1
+
+    def search(
+        self,
+        embeds: list[np.ndarray],
+        filters: Filters,
+        k: int,
+        search_fn: Callable[[list[np.ndarray]], list[list[Neighbor]]],
+    ) -> list[list[Neighbor]]:
+        """Per query results, calling search_fn once for all cache misses."""
+        keys = [self.key(emb, filters, k) for emb in embeds]
+        results = [self.get(key) for key in keys]
+        misses = [i for i, res in enumerate(results) if res is None]
+        if misses:
+            fetched = search_fn([embeds[i] for i in misses])
+            for i, neighbors in zip(misses, fetched):
+                self.put(keys[i], embeds[i], filters, k, neighbors)
+                results[i] = neighbors
+        return results
+
+    def invalidate(
+        self,
+        kind: str,
+        ids: list[str],
+        vectors: Optional[np.ndarray] = None,
+        restricts: Optional[list[dict]] = None,
+    ):
+        """Evict entries whose results a write could change, see module docstring.
+
+        Distances are computed on a snapshot of the entries without holding
+        the lock, entries replaced in the meantime are kept.
+        """
+        ids = set(ids)
+        with self._lock:
+            if self.readmit_after:
+                self._readmit_at = time.monotonic() + self.readmit_after
+            entries = list(self._entries.items())
+        if not entries:
+            return
+        stale = [
+            (key, entry)
+            for key, entry in entries
+            if any(n.id in ids for n in entry.neighbors)
+        ]
+        if kind == "upsert" and vectors is not None and len(vectors):
+            queries = np.stack([e.query for _, e in entries])
+            vectors = np.atleast_2d(vectors).astype(np.float32)
+            vectors = vectors / np.maximum(
+                np.linalg.norm(vectors, axis=1, keepdims=True),
+                np.finfo(np.float32).tiny,
+            )
+            distances = 1 - queries @ vectors.T
+            seen = {key for key, _ in stale}
+            for (key, entry), row in zip(entries, distances):
+                if key in seen:
+                    continue
+                for distance, r in zip(row, restricts or [{}] * len(vectors)):
+                    if distance < entry.kth_distance and _matches(r, entry.filters):
+                        stale.append((key, entry))
+                        break
+        with self._lock:
+            for key, entry in stale:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                    self._counts["invalidated"] += 1
+
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            counts = dict(self._counts)
+        counts["hit_age"] = (
+            counts["hit_age"] / counts["hits"] if counts["hits"] else 0.0
+        )
+        return ResultCacheStats(**counts)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,146 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Neighbor Result Cache Unit Test."""
+
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, local, result_cache
+
+
+def _restricts(*levels):
+    return local.parse_restricts(base.category_restricts(list(levels)))
+
+
+class NeighborCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.index = local.BruteForceIndex(3)
+        self.index.upsert(
+            ["a", "b", "c"],
+            np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
+            [_restricts("Mens"), _restricts("Mens"), _restricts("Womens")],
+        )
+        self.cache = result_cache.NeighborCache(max_entries=10, ttl=60)
+        self.calls = []
+
+    def search(self, embeds, filters=None, k=1):
+        filters = filters or []
+
+        def fetch(misses):
+            self.calls.append(len(misses))
+            return self.index.search(np.array(misses), k, filters)
+
+        return self.cache.search(embeds, filters, k, fetch)
+
+    def test_hit_for_near_identical_query(self):
+        self.search([np.array([1, 0.1, 0])])
+        res = self.search([np.array([1, 0.1001, 0]), np.array([0, 1, 0])])
+        self.assertEqual([r[0].id for r in res], ["a", "b"])
+        self.assertEqual(self.calls, [1, 1])
+        stats = self.cache.stats()
+        self.assertEqual((stats.hits, stats.misses), (1, 2))
+        self.assertAlmostEqual(stats.hit_rate, 1 / 3)
+
+    def test_filters_and_k_in_key(self):
+        q = [np.array([1, 0, 0])]
+        self.search(q)
+        self.search(q, k=2)
+        self.search(q, base.filter_namespaces(["Womens"]))
+        self.assertEqual(self.calls, [1, 1, 1])
+
+    def test_remove_invalidates_entries_containing_id(self):
+        self.search([np.array([1, 0, 0])])
+        self.search([np.array([0, 1, 0])])
+        self.cache.invalidate("remove", ["a"])
+        self.assertEqual(self.cache.stats().invalidated, 1)
+        self.search([np.array([0, 1, 0])])
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_upsert_invalidates_when_closer(self):
+        filters = base.filter_namespaces(["Mens"])
+        self.search([np.array([1, 0.5, 0])], filters)
+        # far away, does not invalidate
+        self.cache.invalidate(
+            "upsert", ["d"], np.array([[0, 0, 1]]), [_restricts("Mens")]
+        )
+        # closer, but does not match the filter
+        self.cache.invalidate(
+            "upsert", ["d"], np.array([[1, 0.5, 0]]), [_restricts("Womens")]
+        )
+        self.assertEqual(self.cache.stats().invalidated, 0)
+        self.cache.invalidate(
+            "upsert", ["d"], np.array([[1, 0.5, 0]]), [_restricts("Mens")]
+        )
+        self.assertEqual(self.cache.stats().invalidated, 1)
+
+    def test_invalidate_outside_lock(self):
+        filters = base.filter_namespaces(["Mens"])
+        query = np.array([1, 0.5, 0])
+        self.search([query], filters)
+        key = self.cache.key(query, filters, 1)
+        refreshed = []
+
+        def matches(restricts, entry_filters):
+            # the lock is free while distances are checked, a search
+            # re-caching the entry meanwhile keeps it
+            self.assertTrue(self.cache._lock.acquire(timeout=1))
+            self.cache._lock.release()
+            self.cache.put(key, query, filters, 1, self.index.search(query, 1)[0])
+            refreshed.append(key)
+            return True
+
+        with mock.patch.object(result_cache, "_matches", side_effect=matches):
+            self.cache.invalidate(
+                "upsert", ["d"], np.array([[1, 0.5, 0]]), [_restricts("Mens")]
+            )
+        self.assertEqual(refreshed, [key])
+        self.assertEqual(self.cache.stats().invalidated, 0)
+        self.assertIsNotNone(self.cache.get(key))
+
+    def test_readmit_after(self):
+        self.cache.readmit_after = 0.05
+        self.cache.invalidate("remove", ["a"])
+        self.search([np.array([1, 0, 0])])
+        self.search([np.array([1, 0, 0])])
+        self.assertEqual(self.calls, [1, 1])
+        time.sleep(0.06)
+        self.search([np.array([1, 0, 0])])
+        self.search([np.array([1, 0, 0])])
+        self.assertEqual(self.calls, [1, 1, 1])
+
+    def test_published_events(self):
+        result_cache.subscribe(self.cache.invalidate)
+        self.search([np.array([1, 0, 0])])
+        result_cache.publish_remove(["a"])
+        self.assertEqual(self.cache.stats().invalidated, 1)
+        result_cache._subscribers.remove(self.cache.invalidate)
+
+    def test_ttl_and_size(self):
+        self.cache.ttl = 0.01
+        self.search([np.array([1, 0, 0])])
+        time.sleep(0.02)
+        self.search([np.array([1, 0, 0])])
+        self.assertEqual(self.cache.stats().expired, 1)
+        self.cache.max_entries = 1
+        self.search([np.array([0, 1, 0])])
+        self.assertEqual(self.cache.stats().evicted, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
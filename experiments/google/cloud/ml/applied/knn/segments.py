@@ -0,0 +1,583 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Live updates for local indexes without rebuilding them.
+
+The loaded index becomes the read only main segment. Upserts are appended to
+small fixed capacity delta segments and removals set bits in per segment
+tombstone bitmaps, so every write costs one row. Queries search the main
+segment, skipping tombstoned rows, and each delta segment, then merge.
+
+A background thread compacts once the deltas or tombstones cross their
+thresholds: it builds a new main segment from the live rows outside the
+lock and swaps it in, so queries never wait for a rebuild. Writes made
+while compacting go to new deltas and their removals are replayed on the
+new main segment.
+
+Writes are appended to a write-ahead log and fsynced before they are
+applied, and the log is replayed when the index is loaded, so acknowledged
+writes survive a crash. Compaction cuts the writes it folded in from the
+log, the new main segment must be persisted where it is loaded from on
+restart, e.g. as a snapshot by snapshots.SegmentedSnapshotIndex. The log is
+locked by the one process writing to it, indexes without a log are read
+only.
+"""
+
+import base64
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn.base import Neighbor, ReadOnlyIndexError
+from google.cloud.ml.applied.knn.local import (
+    FilterStats,
+    Restricts,
+    filter_stats,
+    normalize,
+)
+from google.cloud.ml.applied.knn.postings import PostingLists
+
+Filters = list[tuple[str, list[str]]]
+
+
+class SegmentStats(NamedTuple):
+    main_rows: int
+    main_tombstones: int
+    delta_segments: int
+    delta_rows: int
+    delta_tombstones: int
+    compactions: int
+    last_compaction_seconds: float
+
+
+def _contents(index) -> tuple[np.ndarray, np.ndarray, Callable[[int], Restricts]]:
+    """Ids, vectors and a row -> restricts function of a local index."""
+    vector_store = getattr(index, "store", None)
+    if vector_store is not None:
+        return vector_store.ids(), vector_store.vectors, vector_store.restricts
+    return index.ids, index.vectors, index.restricts.__getitem__
+
+
+def _top_k(ids: np.ndarray, scores: np.ndarray, k: int) -> list[list[Neighbor]]:
+    """Closest first neighbors per row of a queries x rows score matrix."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return [[] for _ in scores]
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return [
+        [Neighbor(ids[i], float(1 - s)) for i, s in zip(row[o], row_scores[o])]
+        for row, row_scores, o in zip(top, top_scores, order)
+    ]
+
+
+def live_rows(
+    main, tombstones: np.ndarray, frozen: list[tuple]
+) -> tuple[list[str], np.ndarray, list[Restricts]]:
+    """Ids, vectors and restricts a compaction folds into a new main index.
+
+    Args:
+        main, tombstones: local index and a bitmap of its tombstoned rows
+        frozen: (segment, count, tombstones) of each delta segment
+    """
+    ids, vectors, restricts_of = _contents(main)
+    keep = np.flatnonzero(~tombstones)
+    new_ids = list(ids[keep])
+    new_vectors = [np.asarray(vectors[keep], dtype=np.float32)]
+    new_restricts = [restricts_of(int(row)) for row in keep]
+    for segment, count, dead in frozen:
+        rows = np.flatnonzero(~dead[:count])
+        new_ids.extend(segment.ids[rows])
+        new_vectors.append(segment.vectors[rows])
+        new_restricts.extend(segment.restricts[row] for row in rows)
+    return new_ids, np.concatenate(new_vectors), new_restricts
+
+
+def written_ids(main, tombstones: np.ndarray, deltas: list[tuple]) -> set[str]:
+    """Ids upserted or removed since main was loaded, its tombstoned rows and
+    every row of the (segment, count, ...) deltas."""
+    ids, _, _ = _contents(main)
+    written = set(ids[np.flatnonzero(tombstones)])
+    for segment, count, *_ in deltas:
+        written.update(segment.ids[:count])
+    return written
+
+
+def rebased_rows(
+    published, main, tombstones: np.ndarray, frozen: list[tuple], removed: set[str]
+) -> tuple[list[str], np.ndarray, list[Restricts]]:
+    """live_rows on top of an index published by another writer.
+
+    Datapoints upserted or removed here replace its copies, all others are
+    kept, so neither writer's updates are dropped. removed also holds ids
+    that were not in main.
+    """
+    written = written_ids(main, tombstones, frozen) | removed
+    ids, _, _ = _contents(published)
+    dead = np.fromiter((i in written for i in ids), dtype=bool, count=len(ids))
+    return live_rows(published, dead, frozen)
+
+
+class WriteAheadLog:
+    """Upserts and removals as JSON lines, fsynced before they are applied.
+
+    A lock file next to the log, held with flock until close, keeps other
+    processes from writing to it; flock is released if the holder crashes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock_file = open(path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise ReadOnlyIndexError(
+                f"Write-ahead log {path} is held by another process"
+            ) from None
+        self._file = open(path, "ab")
+
+    @property
+    def size(self) -> int:
+        return os.fstat(self._file.fileno()).st_size
+
+    def read(self) -> list[dict]:
+        """Logged writes, oldest first.
+
+        A torn last line is a write that was never acknowledged, it is cut.
+        """
+        with open(self.path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logging.warning(f"Dropping a torn write at the end of {self.path}")
+            self._file.truncate(end)
+        return [json.loads(line) for line in data[:end].splitlines()]
+
+    def append(self, records: list[dict]):
+        self._file.write(b"".join(json.dumps(r).encode() + b"\n" for r in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def cut(self, offset: int):
+        """Drop the first offset bytes, writes compacted into the main index."""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, "ab")
+
+    def close(self):
+        self._file.close()
+        self._lock_file.close()
+
+
+def _upsert_record(dp_id: str, vector: np.ndarray, restricts: Restricts) -> dict:
+    return {
+        "upsert": dp_id,
+        "vector": base64.b64encode(vector.astype(np.float32).tobytes()).decode(),
+        "restricts": {ns: sorted(tokens) for ns, tokens in restricts.items()},
+    }
+
+
+class DeltaSegment:
+    """Append only rows with a tombstone bitmap, exact search."""
+
+    def __init__(self, dimension: int, capacity: int):
+        self.capacity = capacity
+        self.count = 0
+        self.ids = np.empty(capacity, dtype=object)
+        self.vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self.restricts: list[Restricts] = []
+        self.tombstones = np.zeros(capacity, dtype=bool)
+        self.postings = PostingLists()
+        self.sealed = False  # being compacted, no more appends
+
+    @property
+    def full(self) -> bool:
+        return self.sealed or self.count == self.capacity
+
+    @property
+    def live(self) -> int:
+        return self.count - int(self.tombstones[: self.count].sum())
+
+    def append(self, dp_id: str, vector: np.ndarray, restricts: Restricts) -> int:
+        row = self.count
+        self.ids[row] = dp_id
+        self.vectors[row] = vector
+        self.restricts.append(restricts)
+        self.postings.add([restricts])
+        self.count += 1
+        return row
+
+    def search(
+        self, queries: np.ndarray, k: int, filters: Filters, count: int
+    ) -> list[list[Neighbor]]:
+        """Neighbors among the first count rows, a snapshot taken by the caller."""
+        live = ~self.tombstones[:count]
+        if filters:
+            rows = self.postings.lookup(filters)
+            if rows is None:
+                mask = np.array(
+                    [
+                        all(
+                            not r.get(ns, frozenset()).isdisjoint(t)
+                            for ns, t in filters
+                        )
+                        for r in self.restricts[:count]
+                    ],
+                    dtype=bool,
+                )
+            else:
+                mask = np.zeros(count, dtype=bool)
+                mask[rows[rows < count]] = True
+            live &= mask
+        rows = np.flatnonzero(live)
+        scores = queries @ self.vectors[rows].T
+        return _top_k(self.ids[rows], scores, k)
+
+
+class SegmentedIndex:
+    """A read only main index plus delta segments and tombstones.
+
+    Args:
+        main: loaded BruteForceIndex, IVFIndex or QuantizedIndex, searched
+            with an exclude mask of its tombstoned rows
+        build: builds a new main index from (ids, vectors, restricts) of the
+            live rows, e.g. loaders.build_local_index, None if a subclass
+            overrides _compacted
+        segment_rows: capacity of each delta segment
+        compact_delta_rows: compact once the deltas hold this many rows
+        compact_tombstones: compact once this many main rows are tombstoned
+        compact_interval: seconds between threshold checks of the background
+            thread, 0 to only compact when compact() is called
+        log: write-ahead log path, replayed here. Upserts and removals
+            raise ReadOnlyIndexError without one or while another process
+            holds it
+
+    Subclasses can build the new main index differently by overriding
+    _compacted, and serve one published elsewhere with _swap_main.
+    """
+
+    def __init__(
+        self,
+        main,
+        build: Optional[Callable],
+        segment_rows: int = 1024,
+        compact_delta_rows: int = 50000,
+        compact_tombstones: int = 10000,
+        compact_interval: float = 5.0,
+        log: Optional[str] = None,
+    ):
+        self.dimension = main.dimension
+        self.build = build
+        self.segment_rows = segment_rows
+        self.compact_delta_rows = compact_delta_rows
+        self.compact_tombstones = compact_tombstones
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self.main = None
+        self._filter_base = FilterStats(0, 0, 0)
+        self._install(main)
+        self.deltas: list[DeltaSegment] = []
+        self._location: dict[str, tuple[DeltaSegment, int]] = {}
+        self._replay: Optional[list[str]] = None  # removals while compacting
+        # removed since the last compaction, maybe published by another writer
+        self._removed: set[str] = set()
+        self._compactions = 0
+        self._last_compaction = 0.0
+        self._log = None
+        self._log_error = "No write-ahead log, set [vectors] segment_log"
+        self._log_lock = threading.Lock()  # taken before _lock
+        if log:
+            try:
+                self._log = WriteAheadLog(log)
+            except ReadOnlyIndexError as e:
+                logging.warning(f"{e}, serving read only")
+                self._log_error = str(e)
+            else:
+                self._recover()
+        self._stop = threading.Event()
+        self._thread = None
+        if compact_interval:
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(compact_interval,),
+                name="knn-compaction",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def _install(self, main):
+        # stats of compacted away main indexes carry over
+        self._filter_base += filter_stats(self.main)
+        self.main = main
+        self.main_tombstones = np.zeros(len(main), dtype=bool)
+        self._dead_main = 0
+        self._main_rows: Optional[dict[str, int]] = None
+
+    def _main_row(self, dp_id: str) -> Optional[int]:
+        if self._main_rows is None:
+            ids, _, _ = _contents(self.main)
+            self._main_rows = {i: row for row, i in enumerate(ids)}
+        row = self._main_rows.get(dp_id)
+        return None if row is None or self.main_tombstones[row] else row
+
+    def _tombstone_main(self, dp_id: str):
+        row = self._main_row(dp_id)
+        if row is not None:
+            self.main_tombstones[row] = True
+            self._dead_main += 1
+
+    def _swap_main(self, main):
+        """Serve a main index built elsewhere, e.g. by another process.
+
+        Datapoints upserted or removed here stay tombstoned in it, the
+        deltas keep serving them. Call holding _compact_lock.
+        """
+        with self._lock:
+            written = self._removed | written_ids(
+                self.main, self.main_tombstones, [(d, d.count) for d in self.deltas]
+            )
+            self._install(main)
+            for dp_id in written:
+                self._tombstone_main(dp_id)
+
+    def _recover(self):
+        records = self._log.read()
+        for record in records:
+            if "upsert" in record:
+                vector = np.frombuffer(
+                    base64.b64decode(record["vector"]), dtype=np.float32
+                )
+                restricts = {
+                    ns: frozenset(tokens) for ns, tokens in record["restricts"].items()
+                }
+                self._upsert([record["upsert"]], vector[None], [restricts])
+            else:
+                self._remove([record["remove"]])
+        if records:
+            logging.info(f"Replayed {len(records)} writes from {self._log.path}")
+
+    @property
+    def read_only(self) -> bool:
+        return self._log is None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self.main) - self._dead_main + sum(d.live for d in self.deltas)
+
+    @property
+    def postings(self) -> PostingLists:
+        return self.main.postings
+
+    def _tombstone(self, dp_id: str):
+        """Mark the live copy of dp_id dead, wherever it is."""
+        location = self._location.pop(dp_id, None)
+        if location is not None:
+            segment, row = location
+            segment.tombstones[row] = True
+        else:
+            row = self._main_row(dp_id)
+            if row is None:
+                return
+            self.main_tombstones[row] = True
+            self._dead_main += 1
+        if self._replay is not None:
+            self._replay.append(dp_id)
+
+    def upsert(
+        self,
+        ids: list[str],
+        vectors: np.ndarray,
+        restricts: Optional[list[Restricts]] = None,
+    ):
+        """Append datapoints to the open delta, tombstoning previous versions."""
+        vectors = normalize(np.atleast_2d(vectors))
+        if vectors.shape != (len(ids), self.dimension):
+            raise ValueError(
+                f"Expected {len(ids)} vectors of dimension {self.dimension}, "
+                f"got shape {vectors.shape}"
+            )
+        restricts = restricts or [{}] * len(ids)
+        if self._log is None:
+            raise ReadOnlyIndexError(self._log_error)
+        with self._log_lock:
+            self._log.append(
+                [_upsert_record(*write) for write in zip(ids, vectors, restricts)]
+            )
+            self._upsert(ids, vectors, restricts)
+
+    def _upsert(self, ids: list[str], vectors: np.ndarray, restricts: list[Restricts]):
+        with self._lock:
+            for dp_id, vector, r in zip(ids, vectors, restricts):
+                self._tombstone(dp_id)
+                if not self.deltas or self.deltas[-1].full:
+                    self.deltas.append(DeltaSegment(self.dimension, self.segment_rows))
+                segment = self.deltas[-1]
+                self._location[dp_id] = (segment, segment.append(dp_id, vector, r))
+
+    def remove(self, ids: list[str]):
+        if self._log is None:
+            raise ReadOnlyIndexError(self._log_error)
+        with self._log_lock:
+            self._log.append([{"remove": dp_id} for dp_id in ids])
+            self._remove(ids)
+
+    def _remove(self, ids: list[str]):
+        with self._lock:
+            for dp_id in ids:
+                self._tombstone(dp_id)
+            self._removed.update(ids)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: Optional[Filters] = None,
+    ) -> list[list[Neighbor]]:
+        """k nearest live datapoints for each query, closest first."""
+        filters = filters or []
+        queries = normalize(np.atleast_2d(queries))
+        with self._lock:
+            main, tombstones, dead = self.main, self.main_tombstones, self._dead_main
+            deltas = [(d, d.count) for d in self.deltas]
+        # the main index skips tombstoned rows itself, only k are fetched
+        results = main.search(queries, k, filters, tombstones if dead else None)
+        for segment, count in deltas:
+            for merged, neighbors in zip(
+                results, segment.search(queries, k, filters, count)
+            ):
+                merged.extend(neighbors)
+        return [sorted(r, key=lambda n: n.distance)[:k] for r in results]
+
+    def filter_stats(self) -> FilterStats:
+        """Filter selectivity of the main index, see local.FilterStats."""
+        with self._lock:
+            return self._filter_base + filter_stats(self.main)
+
+    def needs_compaction(self) -> bool:
+        with self._lock:
+            delta_rows = sum(d.count for d in self.deltas)
+            return (
+                delta_rows >= self.compact_delta_rows
+                or self._dead_main >= self.compact_tombstones
+            )
+
+    def compact(self) -> bool:
+        """Fold the deltas into a new main segment, dropping tombstoned rows.
+
+        Returns:
+            False if there was nothing to compact
+        """
+        with self._compact_lock:
+            with self._log_lock, self._lock:
+                if not self.deltas and not self._dead_main:
+                    return False
+                # writes logged up to here are folded into the new main
+                logged = self._log.size if self._log is not None else 0
+                main, tombstones = self.main, self.main_tombstones.copy()
+                # frozen deltas stay searchable until the new main replaces them
+                frozen = [(d, d.count, d.tombstones.copy()) for d in self.deltas]
+                for segment in self.deltas:
+                    segment.sealed = True
+                self._replay = []
+                removed, self._removed = self._removed, set()
+            start = time.perf_counter()
+            try:
+                compacted = self._compacted(main, tombstones, frozen, removed)
+            except BaseException:
+                with self._lock:
+                    self._replay = None  # sealed deltas are compacted next time
+                    self._removed |= removed
+                raise
+            if self._log is not None:
+                with self._log_lock:
+                    self._log.cut(logged)
+            with self._lock:
+                replay, self._replay = self._replay, None
+                self._install(compacted)
+                self.deltas = self.deltas[len(frozen) :]
+                for segment, _, _ in frozen:
+                    for dp_id in segment.ids[: segment.count]:
+                        if self._location.get(dp_id, (None,))[0] is segment:
+                            del self._location[dp_id]
+                # removed or upserted while compacting, the copy folded into
+                # the new main segment, or published by another writer, is stale
+                for dp_id in replay:
+                    self._tombstone_main(dp_id)
+                for segment in self.deltas:
+                    for dp_id in segment.ids[: segment.count]:
+                        self._tombstone_main(dp_id)
+            self._compactions += 1
+            self._last_compaction = time.perf_counter() - start
+            logging.info(
+                f"Compacted {len(frozen)} delta segments into {len(compacted)} "
+                f"datapoints in {self._last_compaction:.2f}s"
+            )
+            return True
+
+    def _compacted(
+        self, main, tombstones: np.ndarray, frozen: list[tuple], removed: set[str]
+    ):
+        """New main index of the live rows of main and the frozen deltas.
+
+        removed holds the ids removed since main was built, for subclasses
+        that build on top of another index, see rebased_rows.
+        """
+        return self.build(*live_rows(main, tombstones, frozen))
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                if self.needs_compaction():
+                    self.compact()
+            except Exception:
+                logging.exception("Local index compaction failed")
+
+    def stats(self) -> SegmentStats:
+        with self._lock:
+            return SegmentStats(
+                main_rows=len(self.main),
+                main_tombstones=self._dead_main,
+                delta_segments=len(self.deltas),
+                delta_rows=sum(d.count for d in self.deltas),
+                delta_tombstones=sum(
+                    int(d.tombstones[: d.count].sum()) for d in self.deltas
+                ),
+                compactions=self._compactions,
+                last_compaction_seconds=self._last_compaction,
+            )
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._log is not None:
+            self._log.close()
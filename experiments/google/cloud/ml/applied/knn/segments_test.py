@@ -0,0 +1,260 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Segmented Local Index Unit Test."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import backends, base, loaders, local, segments
+
+CATEGORIES = ["Mens", "Womens", "Kids"]
+
+
+def restricts(i: int) -> dict:
+    return {"L0": frozenset([CATEGORIES[i % 3]])}
+
+
+class SegmentedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((200, 8)).astype(np.float32)
+        ids = [str(i) for i in range(100)]
+        main = loaders.build_local_index(
+            ids, self.vectors[:100], [restricts(i) for i in range(100)]
+        )
+        self.log = os.path.join(self.tmp.name, "segments.log")
+        self.index = segments.SegmentedIndex(
+            main,
+            loaders.build_local_index,
+            segment_rows=16,
+            compact_interval=0,
+            log=self.log,
+        )
+        # the same datapoints in a plain index, updated the slow way
+        self.exact = local.BruteForceIndex(8)
+        self.exact.upsert(ids, self.vectors[:100], [restricts(i) for i in range(100)])
+        self.queries = rng.standard_normal((6, 8))
+
+    def tearDown(self):
+        self.index.close()
+        self.tmp.cleanup()
+
+    def new_log(self) -> str:
+        return os.path.join(tempfile.mkdtemp(dir=self.tmp.name), "segments.log")
+
+    def write(self, upsert: range, remove: list[int]):
+        ids = [str(i) for i in upsert]
+        vectors = self.vectors[upsert.start : upsert.stop]
+        rs = [restricts(i + 1) for i in upsert]  # upserted rows change category
+        for index in (self.index, self.exact):
+            index.upsert(ids, vectors, rs)
+            index.remove([str(i) for i in remove])
+
+    def assertSameNeighbors(self):
+        for filters in ([], base.filter_namespaces(["Kids"])):
+            expected = self.exact.search(self.queries, 12, filters)
+            actual = self.index.search(self.queries, 12, filters)
+            self.assertEqual(
+                [[n.id for n in row] for row in actual],
+                [[n.id for n in row] for row in expected],
+            )
+            for a, e in zip(actual, expected):
+                np.testing.assert_allclose(
+                    [n.distance for n in a], [n.distance for n in e], atol=1e-5
+                )
+
+    def test_deltas_and_tombstones(self):
+        self.write(range(90, 140), [3, 5, 95, 120])
+        stats = self.index.stats()
+        self.assertEqual(stats.delta_segments, 4)
+        self.assertEqual(stats.delta_rows, 50)
+        self.assertEqual(stats.main_tombstones, 12)  # 90-99 replaced, 3 and 5
+        self.assertEqual(stats.delta_tombstones, 2)
+        self.assertEqual(len(self.index), len(self.exact))
+        self.assertSameNeighbors()
+
+    def test_compact(self):
+        self.write(range(90, 140), [3, 5, 95, 120])
+        self.assertTrue(self.index.compact())
+        stats = self.index.stats()
+        self.assertEqual(stats.delta_rows, 0)
+        self.assertEqual(stats.main_tombstones, 0)
+        self.assertEqual(stats.main_rows, len(self.exact))
+        self.assertSameNeighbors()
+        self.write(range(130, 150), [0, 131])
+        self.assertSameNeighbors()
+        self.assertTrue(self.index.compact())
+        self.assertFalse(self.index.compact())
+        self.assertSameNeighbors()
+
+    def test_writes_during_compaction(self):
+        self.write(range(90, 110), [])
+        started, release = threading.Event(), threading.Event()
+
+        def slow_build(*args):
+            started.set()
+            release.wait()
+            return loaders.build_local_index(*args)
+
+        self.index.build = slow_build
+        compaction = threading.Thread(target=self.index.compact, daemon=True)
+        compaction.start()
+        started.wait()
+        try:
+            self.write(range(105, 120), [1, 100, 115])
+            self.assertSameNeighbors()
+        finally:
+            release.set()
+            compaction.join()
+        self.assertEqual(self.index.stats().delta_rows, 15)
+        self.assertEqual(self.index.stats().main_tombstones, 7)
+        self.assertSameNeighbors()
+
+    def test_main_skips_tombstones(self):
+        ids = [str(i) for i in range(100)]
+        for options in (
+            {},
+            {"quantization_kind": "int8", "rerank": 100},
+            {"approximate": True, "nlist": 4, "nprobe": 4},
+        ):
+            self.index.close()
+            main = loaders.build_local_index(
+                ids, self.vectors[:100], [restricts(i) for i in range(100)], **options
+            )
+            fetched = []
+            search = main.search
+
+            def recording_search(queries, k, *args, fetched=fetched, search=search):
+                fetched.append(k)
+                return search(queries, k, *args)
+
+            main.search = recording_search
+            self.index = segments.SegmentedIndex(
+                main, loaders.build_local_index, compact_interval=0, log=self.new_log()
+            )
+            self.exact = local.BruteForceIndex(8)
+            self.exact.upsert(
+                ids, self.vectors[:100], [restricts(i) for i in range(100)]
+            )
+            self.write(range(0, 0), list(range(0, 100, 2)) + list(range(1, 60, 2)))
+            self.assertSameNeighbors()
+            # tombstoned rows are excluded by the main index, not over-fetched
+            self.assertEqual(set(fetched), {12}, options)
+
+    def test_filter_stats(self):
+        filters = base.filter_namespaces(["Kids"])
+        for options in (
+            {},
+            {"quantization_kind": "int8"},
+            {"approximate": True, "nlist": 1},
+        ):
+            self.index.close()
+            ids = [str(i) for i in range(99)]
+            main = loaders.build_local_index(
+                ids, self.vectors[:99], [restricts(i) for i in range(99)], **options
+            )
+            self.index = segments.SegmentedIndex(
+                main, loaders.build_local_index, compact_interval=0, log=self.new_log()
+            )
+            self.index.search(self.queries, 5)
+            self.index.search(self.queries, 5, filters)
+            stats = self.index.filter_stats()
+            self.assertEqual(stats.queries, 6, options)
+            self.assertAlmostEqual(stats.selectivity, 1 / 3)
+            # carried over to the compacted main index
+            self.index.remove(["0"])
+            self.assertTrue(self.index.compact())
+            self.index.search(self.queries, 5, filters)
+            self.assertEqual(self.index.filter_stats().queries, 12)
+
+        backend = backends.LocalBackend("local", lambda: self.index)
+        backend.query(self.queries[0], filters, 5)
+        self.assertEqual(backend.stats()["filters"]["queries"], 13)
+
+    def test_background_compaction(self):
+        self.index.close()
+        self.index = segments.SegmentedIndex(
+            self.index.main,
+            loaders.build_local_index,
+            segment_rows=16,
+            compact_delta_rows=32,
+            compact_interval=0.01,
+            log=self.new_log(),
+        )
+        self.write(range(100, 140), [])
+        for _ in range(500):
+            if self.index.stats().compactions:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.index.stats().compactions, 1)
+        self.assertSameNeighbors()
+
+    def reopen(self):
+        self.index.close()
+        self.index = segments.SegmentedIndex(
+            self.index.main,
+            loaders.build_local_index,
+            segment_rows=16,
+            compact_interval=0,
+            log=self.log,
+        )
+
+    def test_restart_replays_writes(self):
+        self.write(range(90, 140), [3, 5, 95, 120])
+        self.reopen()
+        self.assertEqual(self.index.stats().delta_rows, 50)
+        self.assertSameNeighbors()
+
+        # compacted writes are cut from the log, later ones replayed
+        self.assertTrue(self.index.compact())
+        self.write(range(130, 150), [0, 131])
+        self.reopen()
+        self.assertEqual(self.index.stats().delta_rows, 20)
+        self.assertSameNeighbors()
+
+    def test_torn_write(self):
+        self.write(range(100, 110), [])
+        with open(self.log, "ab") as f:
+            f.write(b'{"upsert": "200", "vec')
+        self.reopen()
+        self.write(range(110, 120), [7])
+        self.reopen()
+        self.assertEqual(self.index.stats().delta_rows, 20)
+        self.assertSameNeighbors()
+
+    def test_read_only_without_log(self):
+        main = self.index.main
+        for log in (None, self.log):  # held by self.index
+            index = segments.SegmentedIndex(
+                main, loaders.build_local_index, compact_interval=0, log=log
+            )
+            self.addCleanup(index.close)
+            self.assertTrue(index.read_only)
+            with self.assertRaises(base.ReadOnlyIndexError):
+                index.upsert(["x"], self.vectors[:1])
+            with self.assertRaises(base.ReadOnlyIndexError):
+                index.remove(["0"])
+        self.assertFalse(self.index.read_only)
+
+
+if __name__ == "__main__":
+    unittest.main()
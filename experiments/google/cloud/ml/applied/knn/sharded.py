@@ -0,0 +1,300 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Local index partitioned by top level category, one worker process per shard.
+
+Datapoints are split by their first [category] filter restrict (L0), which
+holds the first of the [big_query] product_category_column_list values. Each
+shard is a knn.store file served by its own worker processes, so memory and
+CPU are spread across cores. Queries filtered on L0 go to the shards of
+those categories, other queries fan out to every shard in parallel and the
+per shard top k are merged. Shards are written with:
+
+    python -m google.cloud.ml.applied.knn.sharded catalog.vec shards/
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, loaders, local, store
+from google.cloud.ml.applied.knn.base import Neighbor
+from google.cloud.ml.applied.knn.local import Restricts
+
+MANIFEST = "shards.json"
+NO_CATEGORY = ""  # shard of datapoints without an L0 restrict
+
+
+def shard_key(restricts: Restricts, namespace: Optional[str] = None) -> str:
+    tokens = restricts.get(namespace or base.category_filter[0])
+    return min(tokens) if tokens else NO_CATEGORY
+
+
+def write_shards(source: str, directory: str, float16: bool = False) -> dict[str, str]:
+    """Split a store (.vec) or Vertex JSON lines file into one store per L0.
+
+    Returns:
+        L0 token -> shard file name, also written to MANIFEST in directory
+    """
+    namespace = base.category_filter[0]
+    ids, vectors, restricts = loaders.read_datapoints(source)
+    keys = np.array([shard_key(r, namespace) for r in restricts], dtype=object)
+    os.makedirs(directory, exist_ok=True)
+    shards = {}
+    for i, key in enumerate(sorted(set(keys))):
+        rows = np.flatnonzero(keys == key)
+        shards[key] = f"{i}{store.SUFFIX}"
+        store.VectorStore.write(
+            os.path.join(directory, shards[key]),
+            list(ids[rows]),
+            vectors[rows],
+            [restricts[row] for row in rows],
+            float16=float16,
+        )
+    tmp = os.path.join(directory, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"namespace": namespace, "shards": shards}, f, indent=2)
+    os.replace(tmp, os.path.join(directory, MANIFEST))
+    return shards
+
+
+def _serve(conn, path: Optional[str], dimension: int, options: dict):
+    """Worker process loop, calls index methods sent by a ShardWorker."""
+    try:
+        if path:
+            index = loaders.load_local_index(path, **options)
+        else:
+            index = local.BruteForceIndex(dimension)
+        conn.send(("ok", len(index)))
+    except Exception as e:
+        conn.send(("error", e))
+        return
+    while True:
+        method, args = conn.recv()
+        if method == "close":
+            break
+        try:
+            result = getattr(index, method)(*args)
+            conn.send(("ok", (result, len(index))))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+class ShardWorker:
+    """A worker process holding one replica of a shard's index."""
+
+    def __init__(self, path: Optional[str], dimension: int, options: dict):
+        context = multiprocessing.get_context("spawn")
+        self._conn, child = context.Pipe()
+        self._process = context.Process(
+            target=_serve, args=(child, path, dimension, options), daemon=True
+        )
+        self._process.start()
+        child.close()
+        self._lock = threading.Lock()
+        self.size = self._receive()
+
+    def _receive(self) -> Any:
+        status, result = self._conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def call(self, method: str, *args) -> Any:
+        with self._lock:
+            self._conn.send((method, args))
+            result, self.size = self._receive()
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._process.is_alive():
+                self._conn.send(("close", ()))
+            self._process.join(timeout=5)
+            self._conn.close()
+
+
+class Shard:
+    """Replicas of one shard, queries round robin and writes go to every replica."""
+
+    def __init__(self, workers: list[ShardWorker]):
+        self.workers = workers
+        self.queries = 0
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.workers[0].size
+
+    def search(self, queries: np.ndarray, k: int, filters) -> list[list[Neighbor]]:
+        with self._lock:
+            self.queries += len(queries)
+            worker = self.workers[next(self._next) % len(self.workers)]
+        return worker.call("search", queries, k, filters)
+
+    def write(self, method: str, *args):
+        for worker in self.workers:
+            worker.call(method, *args)
+
+
+class ShardedIndex:
+    """Scatter-gather search over per L0 category shards.
+
+    Args:
+        directory: written by write_shards
+        options: load_local_index arguments for every shard, e.g. approximate
+        replicas: worker processes for hot shards, L0 token -> count, 1 for
+            shards not listed
+        max_fanout: shards searched concurrently
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        options: Optional[dict] = None,
+        replicas: Optional[dict[str, int]] = None,
+        max_fanout: int = 0,
+    ):
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.directory = directory
+        self.namespace = manifest["namespace"]
+        self.options = options or {}
+        self.replicas = replicas or {}
+        paths = {
+            key: os.path.join(directory, name)
+            for key, name in manifest["shards"].items()
+        }
+        if not paths:
+            raise ValueError(f"No shards in {directory}")
+        self.dimension = store.VectorStore.open(next(iter(paths.values()))).dimension
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_fanout or os.cpu_count(), thread_name_prefix="knn-shard"
+        )
+        self.shards: dict[str, Shard] = dict(
+            zip(paths, self._pool.map(lambda key: self._start(key, paths[key]), paths))
+        )
+
+    def _start(self, key: str, path: Optional[str]) -> Shard:
+        return Shard(
+            [
+                ShardWorker(path, self.dimension, self.options)
+                for _ in range(self.replicas.get(key, 1))
+            ]
+        )
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards.values())
+
+    def route(self, filters: list[tuple[str, list[str]]]) -> list[Shard]:
+        """Shards that can hold datapoints matching filters."""
+        for ns, tokens in filters:
+            if ns == self.namespace:
+                return [self.shards[t] for t in tokens if t in self.shards]
+        return list(self.shards.values())
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: Optional[list[tuple[str, list[str]]]] = None,
+    ) -> list[list[Neighbor]]:
+        """k nearest datapoints for each query, closest first."""
+        filters = filters or []
+        queries = local.normalize(np.atleast_2d(queries))
+        shards = self.route(filters)
+        if not shards:
+            return [[] for _ in queries]
+        if len(shards) == 1:
+            return shards[0].search(queries, k, filters)
+        results = [[] for _ in queries]
+        for partial in self._pool.map(
+            lambda shard: shard.search(queries, k, filters), shards
+        ):
+            for merged, neighbors in zip(results, partial):
+                merged.extend(neighbors)
+        return [sorted(r, key=lambda n: n.distance)[:k] for r in results]
+
+    def upsert(
+        self,
+        ids: list[str],
+        vectors: np.ndarray,
+        restricts: Optional[list[Restricts]] = None,
+    ):
+        """Write datapoints to the shard of their L0, starting new shards as needed.
+
+        Ids are removed from every other shard in case their category changed.
+        """
+        vectors = np.atleast_2d(vectors)
+        restricts = restricts or [{}] * len(ids)
+        keys = [shard_key(r, self.namespace) for r in restricts]
+        with self._lock:
+            for key in set(keys) - set(self.shards):
+                self.shards[key] = self._start(key, None)
+            for key, shard in self.shards.items():
+                rows = [i for i, k in enumerate(keys) if k == key]
+                others = [dp_id for dp_id, k in zip(ids, keys) if k != key]
+                if others:
+                    shard.write("remove", others)
+                if rows:
+                    shard.write(
+                        "upsert",
+                        [ids[i] for i in rows],
+                        vectors[rows],
+                        [restricts[i] for i in rows],
+                    )
+
+    def remove(self, ids: list[str]):
+        with self._lock:
+            for shard in self.shards.values():
+                shard.write("remove", ids)
+
+    def stats(self) -> dict[str, dict]:
+        """Datapoints, replicas and queries served by each shard."""
+        return {
+            key: {
+                "datapoints": len(shard),
+                "replicas": len(shard.workers),
+                "queries": shard.queries,
+            }
+            for key, shard in self.shards.items()
+        }
+
+    def close(self):
+        for shard in self.shards.values():
+            for worker in shard.workers:
+                worker.close()
+        self._pool.shutdown()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Split datapoints into L0 shards")
+    parser.add_argument("input", help=f"vector store ({store.SUFFIX}) or JSON lines")
+    parser.add_argument("output", help="shard directory")
+    parser.add_argument("--float16", action="store_true")
+    args = parser.parse_args(argv)
+    write_shards(args.input, args.output, float16=args.float16)
+
+
+if __name__ == "__main__":
+    main()
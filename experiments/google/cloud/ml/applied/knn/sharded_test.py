@@ -0,0 +1,108 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Sharded Local Index Unit Test."""
+
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, local, sharded, store
+
+CATEGORIES = ["Mens", "Womens", "Kids"]
+
+
+class ShardedIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.ids = [f"{i}_T" for i in range(90)]
+        cls.vectors = rng.standard_normal((90, 16)).astype(np.float32)
+        cls.restricts = [
+            {"L0": frozenset([CATEGORIES[i % 3]]), "L1": frozenset([str(i % 2)])}
+            for i in range(90)
+        ]
+        source = os.path.join(cls.dir.name, "catalog" + store.SUFFIX)
+        store.VectorStore.write(source, cls.ids, cls.vectors, cls.restricts)
+        cls.shards = os.path.join(cls.dir.name, "shards")
+        sharded.main([source, cls.shards])
+        cls.exact = local.BruteForceIndex(16)
+        cls.exact.upsert(cls.ids, cls.vectors, cls.restricts)
+        cls.queries = rng.standard_normal((5, 16))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def setUp(self):
+        self.index = sharded.ShardedIndex(self.shards, replicas={"Mens": 2})
+
+    def tearDown(self):
+        self.index.close()
+
+    def assertSameNeighbors(self, filters):
+        expected = self.exact.search(self.queries, 10, filters)
+        actual = self.index.search(self.queries, 10, filters)
+        self.assertEqual(
+            [[n.id for n in row] for row in actual],
+            [[n.id for n in row] for row in expected],
+        )
+
+    def test_manifest(self):
+        with open(os.path.join(self.shards, sharded.MANIFEST)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["namespace"], "L0")
+        self.assertEqual(sorted(manifest["shards"]), sorted(CATEGORIES))
+        self.assertEqual(len(self.index), 90)
+
+    def test_unfiltered_merges_all_shards(self):
+        self.assertSameNeighbors([])
+        self.assertSameNeighbors([("L1", ["1"])])
+        self.assertEqual({s["queries"] for s in self.index.stats().values()}, {10})
+
+    def test_l0_filter_routes_to_one_shard(self):
+        filters = base.filter_namespaces(["Womens", "0"])
+        self.assertSameNeighbors(filters)
+        stats = self.index.stats()
+        self.assertEqual(stats["Womens"]["queries"], 5)
+        self.assertEqual(stats["Mens"]["queries"], 0)
+        self.assertEqual(stats["Mens"]["replicas"], 2)
+        self.assertEqual(
+            self.index.search(self.queries, 3, [("L0", ["Pets"])]), [[]] * 5
+        )
+
+    def test_upsert_moves_between_shards(self):
+        vector = self.vectors[0]  # 0_T is in Mens
+        self.index.upsert(["0_T"], vector, [{"L0": frozenset(["Pets"])}])
+        self.assertEqual(self.index.stats()["Pets"]["datapoints"], 1)
+        self.assertEqual(self.index.stats()["Mens"]["datapoints"], 29)
+        res = self.index.search(vector, 1, [])
+        self.assertEqual(res[0][0].id, "0_T")
+        res = self.index.search(vector, 1, [("L0", ["Mens"])])
+        self.assertNotEqual(res[0][0].id, "0_T")
+        self.index.remove(["0_T"])
+        self.assertEqual(len(self.index), 89)
+
+    def test_worker_errors_propagate(self):
+        with self.assertRaises(ValueError):
+            self.index.search(np.ones(3), 1, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,619 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Immutable, versioned local index snapshots with an atomic CURRENT pointer.
+
+A snapshot root holds one directory per snapshot and a CURRENT file naming
+the one to serve:
+
+    CURRENT                  v000042
+    v000042/manifest.json    model, projection, dimension, datapoints...
+    v000042/datapoints.vec   knn.store file, next to its posting lists and
+                             IVF lists or quantized codes if any
+
+Snapshots are written to a temporary directory, renamed into place and only
+then published by replacing CURRENT, so readers never see a partial one.
+Versions are claimed and published under a lock file, so several processes
+can write to the same root. A writer whose snapshot was derived from one
+that is no longer current rebuilds it on top of the current one under the
+lock, so another writer's updates are not dropped.
+Serving processes memory map the current snapshot on boot, nothing is
+trained or decoded, and swap to newer ones when CURRENT changes, queries
+already running finish on the old one. SegmentedSnapshotIndex keeps its
+live updates on top of the snapshots it swaps to and publishes compactions.
+Snapshots built for another embedding model, projection or dimension are
+rejected. The root can be a local directory or a mounted bucket path.
+Snapshots are published from datapoints with:
+
+    python -m google.cloud.ml.applied.knn.snapshots catalog.vec snapshots/
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.config import Config
+from google.cloud.ml.applied.embeddings import projection
+from google.cloud.ml.applied.knn import loaders, segments, store
+from google.cloud.ml.applied.knn.base import Neighbor, ReadOnlyIndexError
+from google.cloud.ml.applied.knn.local import FilterStats, Restricts, filter_stats
+
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+DATAPOINTS = "datapoints" + store.SUFFIX
+LOCK = ".lock"
+BOOTSTRAP_LOCK = ".bootstrap.lock"
+
+
+class Identity(NamedTuple):
+    """What the vectors of a snapshot are comparable with."""
+
+    model: str
+    projection: str  # projection version, empty if raw embeddings
+    dimension: int
+
+
+class Manifest(NamedTuple):
+    name: str
+    version: int
+    created: str
+    identity: Identity
+    datapoints: int
+    quantization: str
+
+    def to_json(self) -> dict:
+        return {**self._asdict(), "identity": self.identity._asdict()}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Manifest":
+        return cls(**{**data, "identity": Identity(**data["identity"])})
+
+
+def configured_identity() -> Identity:
+    """Identity of the vectors this process embeds and queries with."""
+    fitted = projection.get_projection()
+    return Identity(
+        model=Config.value(Config.SECTION_MODELS, "embedding"),
+        projection=fitted.version if fitted is not None else "",
+        dimension=Config.value(Config.SECTION_VECTORS, "dimension"),
+    )
+
+
+@contextmanager
+def locked(path: str, timeout: float = 600.0, stale: float = 30.0):
+    """Hold a lock file created with O_EXCL, which also works on mounted buckets.
+
+    The holder touches the file every stale / 3 seconds, a lock left
+    untouched for stale seconds by a crashed holder is broken.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale:
+                    logging.warning(f"Breaking stale lock {path}")
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for lock {path}") from None
+            time.sleep(0.01)
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(stale / 3):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=heartbeat, name="knn-snapshot-lock", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+        os.remove(path)
+
+
+def current(root: str) -> Optional[Manifest]:
+    """Manifest of the published snapshot, None if nothing is published."""
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return read_manifest(root, name)
+
+
+def read_manifest(root: str, name: str) -> Manifest:
+    with open(os.path.join(root, name, MANIFEST)) as f:
+        return Manifest.from_json(json.load(f))
+
+
+def versions(root: str) -> list[str]:
+    """Snapshot directory names, oldest first."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(root)
+        if name.startswith("v") and os.path.exists(os.path.join(root, name, MANIFEST))
+    )
+
+
+def check(manifest: Manifest, identity: Identity):
+    """Raise ValueError if a snapshot was built for other vectors."""
+    if manifest.identity != identity:
+        mismatched = [
+            f"{field} {have!r} != {want!r}"
+            for field, have, want in zip(Identity._fields, manifest.identity, identity)
+            if have != want
+        ]
+        raise ValueError(
+            f"Snapshot {manifest.name} does not match this index: "
+            f"{', '.join(mismatched)}. Rebuild it with the configured [models] "
+            "embedding and [vectors] projection and dimension"
+        )
+
+
+def publish(root: str, name: str):
+    """Point CURRENT at a snapshot, atomically."""
+    fd, tmp = tempfile.mkstemp(dir=root, prefix=".current-")
+    with os.fdopen(fd, "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(root, CURRENT))
+
+
+def prune(root: str, keep: int):
+    """Delete all but the newest keep snapshots, never the published one.
+
+    Processes still serving a deleted snapshot keep their memory mapping.
+    """
+    published = current(root)
+    for name in versions(root)[:-keep] if keep else []:
+        if published is None or name != published.name:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _stage(
+    staging: str,
+    ids: list[str],
+    vectors: np.ndarray,
+    restricts: list[Restricts],
+    identity: Identity,
+    options: dict,
+):
+    """Write the datapoints and the sidecars of their index to staging."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.shape[1] != identity.dimension:
+        raise ValueError(
+            f"Snapshot vectors have dimension {vectors.shape[1]}, "
+            f"expected {identity.dimension}"
+        )
+    for name in os.listdir(staging):
+        os.remove(os.path.join(staging, name))
+    path = os.path.join(staging, DATAPOINTS)
+    store.VectorStore.write(path, ids, vectors, restricts)
+    loaders.load_local_index(path, **options)
+
+
+def write(
+    root: str,
+    ids: list[str],
+    vectors: np.ndarray,
+    restricts: list[Restricts],
+    identity: Identity,
+    keep: int = 3,
+    base: Optional[str] = None,
+    rebase: Optional[Callable[[Manifest], tuple]] = None,
+    **options,
+) -> Manifest:
+    """Write a new snapshot and publish it.
+
+    The index the snapshot is served with is built once here, posting lists,
+    IVF lists or quantized codes are saved in the snapshot and memory mapped
+    when it is loaded.
+
+    Args:
+        root: snapshot root directory, created if missing
+        ids, vectors, restricts: the datapoints
+        identity: model, projection and dimension the vectors come from
+        keep: snapshots to retain, 0 keeps all
+        base: snapshot the datapoints were derived from
+        rebase: called with the published manifest, under the lock, if it
+            is not base, returns the (ids, vectors, restricts) to write
+            instead, e.g. segments.rebased_rows on top of it
+        options: loaders.load_local_index arguments, e.g. approximate or
+            quantization_kind
+    """
+    os.makedirs(root, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=root, prefix=".staging-")
+    try:
+        _stage(staging, ids, vectors, restricts, identity, options)
+        with locked(os.path.join(root, LOCK)):
+            published = current(root)
+            if rebase is not None and published and published.name != base:
+                # another writer published since base, rebuild on top of it
+                logging.info(f"Rebasing snapshot of {base} onto {published.name}")
+                ids, vectors, restricts = rebase(published)
+                _stage(staging, ids, vectors, restricts, identity, options)
+            # claim the next version, including directories still being pruned
+            taken = [
+                int(n[1:])
+                for n in os.listdir(root)
+                if n.startswith("v") and n[1:].isdigit()
+            ]
+            version = max(taken, default=0) + 1
+            name = f"v{version:06d}"
+            manifest = Manifest(
+                name=name,
+                version=version,
+                created=datetime.now(timezone.utc).isoformat(),
+                identity=identity,
+                datapoints=len(ids),
+                quantization=(
+                    ""
+                    if options.get("approximate")
+                    else options.get("quantization_kind", "")
+                ),
+            )
+            with open(os.path.join(staging, MANIFEST), "w") as f:
+                json.dump(manifest.to_json(), f, indent=2)
+            os.rename(staging, os.path.join(root, name))
+            publish(root, name)
+            prune(root, keep)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    logging.info(f"Published snapshot {name} of {len(ids)} datapoints in {root}")
+    return manifest
+
+
+def bootstrap(
+    root: str, read_fn: Callable, identity: Identity, keep: int = 3, **options
+) -> Manifest:
+    """Publish a first snapshot of read_fn() unless one is published.
+
+    Of several processes booting at once, one reads and writes the snapshot,
+    the others wait for it.
+
+    Args:
+        read_fn: returns (ids, vectors, restricts), e.g. loaders.read_datapoints
+        options: see write
+    """
+    published = current(root)
+    if published is not None:
+        return published
+    os.makedirs(root, exist_ok=True)
+    with locked(os.path.join(root, BOOTSTRAP_LOCK)):
+        published = current(root)
+        if published is None:
+            ids, vectors, restricts = read_fn()
+            published = write(
+                root, list(ids), vectors, restricts, identity, keep=keep, **options
+            )
+    return published
+
+
+def load(root: str, identity: Identity, name: Optional[str] = None, **options):
+    """Open a snapshot, the published one unless name is given.
+
+    The datapoints are memory mapped, not read. options are passed to
+    loaders.load_local_index.
+
+    Returns:
+        (manifest, index)
+    """
+    manifest = read_manifest(root, name) if name else current(root)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot published in {root}")
+    check(manifest, identity)
+    path = os.path.join(root, manifest.name, DATAPOINTS)
+    return manifest, loaders.load_local_index(path, **options)
+
+
+class SnapshotIndex:
+    """Serves the published snapshot, swapping when CURRENT changes.
+
+    Snapshots are immutable, upserts and removals raise ReadOnlyIndexError.
+
+    Args:
+        root: snapshot root directory
+        identity: snapshots for other vectors are rejected
+        options: loaders.load_local_index arguments
+        poll_interval: seconds between CURRENT checks by a background
+            thread, 0 to only swap when refresh() is called
+    """
+
+    read_only = True
+
+    def __init__(
+        self,
+        root: str,
+        identity: Identity,
+        options: Optional[dict] = None,
+        poll_interval: float = 5.0,
+    ):
+        self.root = root
+        self.identity = identity
+        self.options = options or {}
+        self._lock = threading.Lock()
+        start = time.perf_counter()
+        self.manifest, self.index = load(root, identity, **self.options)
+        logging.info(
+            f"Loaded snapshot {self.manifest.name} in "
+            f"{time.perf_counter() - start:.3f}s"
+        )
+        self.dimension = self.index.dimension
+        self.swaps = 0
+        self._filter_base = FilterStats(0, 0, 0)  # of swapped out snapshots
+        self._stop = threading.Event()
+        self._thread = None
+        if poll_interval:
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(poll_interval,),
+                name="knn-snapshots",
+                daemon=True,
+            )
+            self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def postings(self):
+        return self.index.postings
+
+    def refresh(self) -> bool:
+        """Swap to the published snapshot if it changed.
+
+        The new snapshot is opened before the swap, a snapshot that fails to
+        load or does not match is logged and the current one kept serving.
+
+        Returns:
+            True if swapped
+        """
+        manifest = current(self.root)
+        if manifest is None or manifest.name == self.manifest.name:
+            return False
+        try:
+            manifest, index = load(
+                self.root, self.identity, manifest.name, **self.options
+            )
+        except (OSError, ValueError) as e:
+            logging.error(f"Not swapping to snapshot {manifest.name}: {e}")
+            return False
+        with self._lock:
+            self._filter_base += filter_stats(self.index)
+            self.manifest, self.index = manifest, index
+            self.swaps += 1
+        logging.info(f"Swapped to snapshot {manifest.name}")
+        return True
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: Optional[list[tuple[str, list[str]]]] = None,
+    ) -> list[list[Neighbor]]:
+        # in flight queries hold the index they started with
+        with self._lock:
+            index = self.index
+        return index.search(queries, k, filters or [])
+
+    def upsert(self, ids, vectors, restricts=None):
+        raise ReadOnlyIndexError(
+            "Snapshots are immutable, enable [vectors] segments for live updates"
+        )
+
+    def remove(self, ids):
+        raise ReadOnlyIndexError(
+            "Snapshots are immutable, enable [vectors] segments for live updates"
+        )
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception("Snapshot refresh failed")
+
+    def filter_stats(self) -> FilterStats:
+        """Filter selectivity of the served snapshots, see local.FilterStats."""
+        with self._lock:
+            return self._filter_base + filter_stats(self.index)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "snapshot": self.manifest.name,
+                "created": self.manifest.created,
+                "datapoints": self.manifest.datapoints,
+                "swaps": self.swaps,
+            }
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class SegmentedSnapshotIndex(segments.SegmentedIndex):
+    """Live updates on top of the published snapshot, see segments.SegmentedIndex.
+
+    Compactions publish a snapshot. One that finds a snapshot published by
+    another writer since its own rebuilds on top of it, datapoints written
+    here replace that writer's copies. Snapshots published elsewhere are
+    swapped in with the deltas and removals made here kept on top.
+
+    Args:
+        root: snapshot root directory
+        identity: snapshots for other vectors are rejected
+        options: loaders.load_local_index arguments
+        keep: snapshots to retain, 0 keeps all
+        poll_interval: seconds between CURRENT checks by a background
+            thread, 0 to only swap when refresh() is called
+        segment_options: segments.SegmentedIndex arguments, e.g. log
+    """
+
+    def __init__(
+        self,
+        root: str,
+        identity: Identity,
+        options: Optional[dict] = None,
+        keep: int = 3,
+        poll_interval: float = 5.0,
+        **segment_options,
+    ):
+        self.root = root
+        self.identity = identity
+        self.options = options or {}
+        self.keep = keep
+        self.manifest, main = load(root, identity, **self.options)
+        self.swaps = 0
+        super().__init__(main, None, **segment_options)
+        self._poll_thread = None
+        if poll_interval:
+            self._poll_thread = threading.Thread(
+                target=self._poll,
+                args=(poll_interval,),
+                name="knn-snapshots",
+                daemon=True,
+            )
+            self._poll_thread.start()
+
+    def _compacted(
+        self, main, tombstones: np.ndarray, frozen: list[tuple], removed: set[str]
+    ):
+        def rebase(published: Manifest):
+            index = load(self.root, self.identity, published.name, **self.options)[1]
+            return segments.rebased_rows(index, main, tombstones, frozen, removed)
+
+        manifest = write(
+            self.root,
+            *segments.live_rows(main, tombstones, frozen),
+            self.identity,
+            keep=self.keep,
+            base=self.manifest.name,
+            rebase=rebase,
+            **self.options,
+        )
+        self.manifest = manifest
+        return load(self.root, self.identity, manifest.name, **self.options)[1]
+
+    def refresh(self) -> bool:
+        """Swap to the published snapshot if another writer changed it.
+
+        A snapshot that fails to load or does not match is logged and the
+        current one kept serving.
+
+        Returns:
+            True if swapped
+        """
+        with self._compact_lock:
+            manifest = current(self.root)
+            if manifest is None or manifest.name == self.manifest.name:
+                return False
+            try:
+                manifest, index = load(
+                    self.root, self.identity, manifest.name, **self.options
+                )
+            except (OSError, ValueError) as e:
+                logging.error(f"Not swapping to snapshot {manifest.name}: {e}")
+                return False
+            self._swap_main(index)
+            self.manifest = manifest
+            self.swaps += 1
+        logging.info(f"Swapped to snapshot {manifest.name}")
+        return True
+
+    def _poll(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception("Snapshot refresh failed")
+
+    def snapshot_stats(self) -> dict:
+        manifest = self.manifest
+        return {
+            "snapshot": manifest.name,
+            "created": manifest.created,
+            "datapoints": manifest.datapoints,
+            "swaps": self.swaps,
+        }
+
+    def close(self):
+        super().close()
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Publish a local index snapshot")
+    parser.add_argument("input", help=f"vector store ({store.SUFFIX}) or JSON lines")
+    parser.add_argument("root", help="snapshot root directory")
+    parser.add_argument(
+        "--quantization",
+        default=Config.value(Config.SECTION_VECTORS, "quantization"),
+    )
+    parser.add_argument(
+        "--approximate", action="store_true", help="save IVF lists for the ivf backend"
+    )
+    parser.add_argument(
+        "--nlist", type=int, default=Config.value(Config.SECTION_VECTORS, "ivf_nlist")
+    )
+    parser.add_argument(
+        "--keep",
+        type=int,
+        default=Config.value(Config.SECTION_VECTORS, "snapshot_keep"),
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    ids, vectors, restricts = loaders.read_datapoints(args.input)
+    write(
+        args.root,
+        list(ids),
+        vectors,
+        restricts,
+        configured_identity(),
+        keep=args.keep,
+        approximate=args.approximate,
+        quantization_kind=args.quantization,
+        nlist=args.nlist,
+    )
+
+
+if __name__ == "__main__":
+    main()
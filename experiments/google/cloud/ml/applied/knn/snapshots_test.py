@@ -0,0 +1,311 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Local Index Snapshots Unit Test."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import (
+    base,
+    ivf,
+    postings,
+    quantization,
+    snapshots,
+    store,
+)
+
+IDENTITY = snapshots.Identity("multimodalembedding", "", 8)
+CATEGORIES = ["Mens", "Womens", "Kids"]
+
+
+def restricts(n: int) -> list[dict]:
+    return [{"L0": frozenset([CATEGORIES[i % 3]])} for i in range(n)]
+
+
+class SnapshotsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "snapshots")
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((60, 8)).astype(np.float32)
+        self.ids = [str(i) for i in range(60)]
+        self.queries = rng.standard_normal((4, 8))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, rows: slice, **kwargs) -> snapshots.Manifest:
+        return snapshots.write(
+            self.root,
+            self.ids[rows],
+            self.vectors[rows],
+            restricts(60)[rows],
+            IDENTITY,
+            **kwargs,
+        )
+
+    def test_write_publishes_versions(self):
+        self.assertIsNone(snapshots.current(self.root))
+        first = self.write(slice(0, 30))
+        second = self.write(slice(0, 60))
+        self.assertEqual((first.name, second.name), ("v000001", "v000002"))
+        self.assertEqual(snapshots.current(self.root), second)
+        self.assertEqual(snapshots.versions(self.root), ["v000001", "v000002"])
+        # no staging directories or pointer temp files left behind
+        self.assertEqual(
+            sorted(os.listdir(self.root)), ["CURRENT", "v000001", "v000002"]
+        )
+        manifest, index = snapshots.load(self.root, IDENTITY)
+        self.assertEqual((manifest.datapoints, len(index)), (60, 60))
+        _, index = snapshots.load(self.root, IDENTITY, "v000001")
+        self.assertEqual(len(index), 30)
+
+    def test_write_quantized(self):
+        manifest = self.write(slice(0, 60), quantization_kind="int8")
+        path = os.path.join(self.root, manifest.name, snapshots.DATAPOINTS)
+        self.assertTrue(os.path.exists(f"{path}.int8"))
+        _, index = snapshots.load(self.root, IDENTITY, quantization_kind="int8")
+        self.assertEqual(index.search(self.vectors[:1], 1)[0][0].id, "0")
+
+    def test_load_maps_saved_indexes(self):
+        for options in (
+            {},
+            {"approximate": True, "nlist": 4},
+            {"quantization_kind": "pq"},
+        ):
+            self.write(slice(0, 60), **options)
+            expected = snapshots.load(self.root, IDENTITY, **options)[1]
+            # nothing is trained, decoded or rebuilt on load
+            with mock.patch.object(
+                ivf, "kmeans", side_effect=AssertionError
+            ), mock.patch.object(
+                quantization.QuantizedIndex, "build", side_effect=AssertionError
+            ), mock.patch.object(
+                postings.PostingLists, "from_store", side_effect=AssertionError
+            ), mock.patch.object(
+                store.VectorStore, "ids", side_effect=AssertionError
+            ):
+                _, index = snapshots.load(self.root, IDENTITY, **options)
+                filters = base.filter_namespaces(["Kids"])
+                self.assertEqual(
+                    index.search(self.queries, 5, filters),
+                    expected.search(self.queries, 5, filters),
+                )
+
+    def test_prune(self):
+        for _ in range(4):
+            self.write(slice(0, 10), keep=2)
+        self.assertEqual(snapshots.versions(self.root), ["v000003", "v000004"])
+        # the published snapshot survives even when it is not among the newest
+        snapshots.publish(self.root, "v000003")
+        self.write(slice(0, 10), keep=0)
+        snapshots.publish(self.root, "v000003")
+        snapshots.prune(self.root, 1)
+        self.assertEqual(snapshots.versions(self.root), ["v000003", "v000005"])
+
+    def test_concurrent_writers(self):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            manifests = list(
+                pool.map(lambda n: self.write(slice(0, n), keep=0), [10, 20, 30, 40])
+            )
+        self.assertEqual(sorted(m.version for m in manifests), [1, 2, 3, 4], manifests)
+        # published in version order, CURRENT ends on the newest
+        self.assertEqual(snapshots.current(self.root).name, "v000004")
+        self.assertNotIn(snapshots.LOCK, os.listdir(self.root))
+
+    def test_bootstrap_once(self):
+        reads = []
+        barrier = threading.Barrier(4)
+
+        def read():
+            reads.append(1)
+            time.sleep(0.05)
+            return self.ids, self.vectors, restricts(60)
+
+        def boot(_):
+            barrier.wait()
+            return snapshots.bootstrap(self.root, read, IDENTITY)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            manifests = list(pool.map(boot, range(4)))
+        self.assertEqual(len(reads), 1)
+        self.assertEqual({m.name for m in manifests}, {"v000001"})
+        self.assertEqual(snapshots.bootstrap(self.root, read, IDENTITY).name, "v000001")
+        self.assertEqual(len(reads), 1)
+
+    def test_stale_lock(self):
+        os.makedirs(self.root)
+        path = os.path.join(self.root, snapshots.LOCK)
+        open(path, "w").close()
+        os.utime(path, (time.time() - 60, time.time() - 60))
+        with snapshots.locked(path, stale=30):
+            pass
+        self.assertFalse(os.path.exists(path))
+        open(path, "w").close()
+        with self.assertRaises(TimeoutError):
+            with snapshots.locked(path, timeout=0.05):
+                pass
+
+    def test_identity_mismatch(self):
+        self.write(slice(0, 10))
+        for other in (
+            IDENTITY._replace(model="textembedding-gecko"),
+            IDENTITY._replace(projection="pca-256-abc"),
+        ):
+            with self.assertRaisesRegex(ValueError, "does not match"):
+                snapshots.load(self.root, other)
+        with self.assertRaisesRegex(ValueError, "expected 8"):
+            snapshots.write(self.root, ["a"], np.ones((1, 4)), [{}], IDENTITY)
+
+    def test_refresh_swaps(self):
+        self.write(slice(0, 30))
+        index = snapshots.SnapshotIndex(self.root, IDENTITY, poll_interval=0)
+        self.addCleanup(index.close)
+        old = index.index
+        self.assertFalse(index.refresh())
+        filters = base.filter_namespaces(["Kids"])
+        index.search(self.queries, 5, filters)
+
+        self.write(slice(30, 60))
+        self.assertTrue(index.refresh())
+        index.search(self.queries, 5, filters)
+        # filter stats carry over the swap
+        self.assertEqual(index.filter_stats().queries, 8)
+        self.assertAlmostEqual(index.filter_stats().selectivity, 1 / 3)
+        self.assertEqual(index.stats()["snapshot"], "v000002")
+        self.assertEqual(index.stats()["swaps"], 1)
+        found = {n.id for row in index.search(self.queries, 5) for n in row}
+        self.assertTrue(all(int(i) >= 30 for i in found))
+        # a query that grabbed the old index before the swap still completes
+        self.assertEqual(len(old.search(self.queries, 5)), 4)
+
+        with self.assertRaises(base.ReadOnlyIndexError):
+            index.upsert(["x"], np.ones(8))
+
+    def test_refresh_rejects_mismatch(self):
+        self.write(slice(0, 30))
+        index = snapshots.SnapshotIndex(self.root, IDENTITY, poll_interval=0)
+        self.addCleanup(index.close)
+        snapshots.write(
+            self.root,
+            self.ids,
+            self.vectors,
+            restricts(60),
+            IDENTITY._replace(model="textembedding-gecko"),
+        )
+        self.assertFalse(index.refresh())
+        self.assertEqual(index.stats()["snapshot"], "v000001")
+        self.assertEqual(len(index), 30)
+
+    def segmented(self, log: str) -> snapshots.SegmentedSnapshotIndex:
+        index = snapshots.SegmentedSnapshotIndex(
+            self.root,
+            IDENTITY,
+            keep=0,
+            poll_interval=0,
+            segment_rows=8,
+            compact_interval=0,
+            log=os.path.join(self.tmp.name, log),
+        )
+        self.addCleanup(index.close)
+        return index
+
+    def served(self, index) -> set[str]:
+        """Ids of the datapoints served, checking none is served twice."""
+        (row,) = index.search(self.vectors[:1], 60)
+        ids = [n.id for n in row]
+        self.assertEqual(len(ids), len(set(ids)))
+        return set(ids)
+
+    def test_compaction_snapshots(self):
+        self.write(slice(0, 30))
+        index = self.segmented("segments.log")
+        index.upsert(self.ids[30:40], self.vectors[30:40], restricts(60)[30:40])
+        index.remove(["0", "1"])
+        self.assertTrue(index.compact())
+        self.assertEqual(snapshots.current(self.root).name, "v000002")
+        self.assertEqual(index.snapshot_stats()["snapshot"], "v000002")
+
+        # a restarted process serves the compacted datapoints
+        manifest, reloaded = snapshots.load(self.root, IDENTITY)
+        self.assertEqual(manifest.datapoints, 38)
+        self.assertEqual(set(reloaded.store.ids()), set(self.ids[2:40]))
+
+    def test_two_writers(self):
+        self.write(slice(0, 30))
+        first, second = self.segmented("first.log"), self.segmented("second.log")
+        first.upsert(self.ids[30:35], self.vectors[30:35], restricts(60)[30:35])
+        first.remove(["0"])
+        # the second writer moves "1" onto the vector of "40"
+        second.upsert(self.ids[35:40], self.vectors[35:40], restricts(60)[35:40])
+        second.upsert(["1"], self.vectors[40:41])
+        second.remove(["2", "31"])  # "31" is not published yet
+        self.assertTrue(first.compact())
+        # published on top of the first writer's snapshot, not its own base
+        self.assertTrue(second.compact())
+        manifest, reloaded = snapshots.load(self.root, IDENTITY)
+        self.assertEqual(manifest.name, "v000003")
+        expected = {"1"} | set(self.ids[3:40]) - {"31"}
+        self.assertEqual(set(reloaded.store.ids()), expected)
+        self.assertEqual(manifest.datapoints, len(expected))
+        self.assertEqual(reloaded.search(self.vectors[40:41], 1)[0][0].id, "1")
+
+        self.assertFalse(second.refresh())
+        self.assertTrue(first.refresh())
+        self.assertEqual(first.snapshot_stats()["swaps"], 1)
+        for index in (first, second):
+            self.assertEqual(len(index), len(expected))
+            self.assertEqual(self.served(index), expected)
+
+    def test_refresh_keeps_local_writes(self):
+        self.write(slice(0, 30))
+        first, second = self.segmented("first.log"), self.segmented("second.log")
+        second.upsert(self.ids[30:40], self.vectors[30:40], restricts(60)[30:40])
+        self.assertTrue(second.compact())
+        # not compacted yet, the first writer's updates stay on top
+        first.upsert(["5", "35"], self.vectors[[40, 41]])
+        first.remove(["6", "36"])
+        self.assertTrue(first.refresh())
+        expected = set(self.ids[:40]) - {"6", "36"}
+        self.assertEqual(len(first), len(expected))
+        self.assertEqual(self.served(first), expected)
+        found = first.search(self.vectors[[40, 41]], 1)
+        self.assertEqual([row[0].id for row in found], ["5", "35"])
+        self.assertTrue(first.compact())
+        self.assertEqual(
+            set(snapshots.load(self.root, IDENTITY)[1].store.ids()), expected
+        )
+
+    def test_main(self):
+        identity = snapshots.configured_identity()
+        vectors = np.random.default_rng(1).standard_normal((60, identity.dimension))
+        path = os.path.join(self.tmp.name, "catalog" + store.SUFFIX)
+        store.VectorStore.write(path, self.ids, vectors, restricts(60))
+        snapshots.main([path, self.root, "--quantization", "", "--keep", "1"])
+        manifest = snapshots.current(self.root)
+        self.assertEqual(manifest.datapoints, 60)
+        self.assertEqual(manifest.identity, identity)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,286 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Memory mapped on-disk vector store.
+
+A single file holding a header, a float32 or float16 vector matrix, an id
+table and one restrict column per namespace. Opening a store maps the file,
+so it takes constant time, and every process that opens the same file
+shares the same pages in the OS page cache. Layout, each section aligned to
+64 bytes:
+
+    header      magic, version, flags, count, dimension and section offsets
+    matrix      count x dimension, float32 or float16
+    id offsets  count + 1 uint64 offsets into the id blob
+    id blob     utf-8 encoded ids
+    codes       count x namespaces uint32, 0 = no restrict, else token + 1
+    meta        JSON namespaces and token vocabularies
+
+Indexes derived from a store, such as posting lists, IVF partitions and
+quantized codes, are saved next to it with knn.arrays and memory mapped
+back, so they are not rebuilt on every load.
+
+Convert a Vertex JSON lines datapoint file with:
+
+    python -m google.cloud.ml.applied.knn.store datapoints.json catalog.vec [--float16]
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+from typing import Optional
+
+import numpy as np
+
+from google.cloud.ml.applied.knn.local import Restricts, normalize, read_jsonl
+
+MAGIC = b"GVSTORE1"
+VERSION = 1
+FLAG_FLOAT16 = 1
+FLAG_NORMALIZED = 2
+ALIGN = 64
+SUFFIX = ".vec"
+
+# magic, version, flags, count, dimension, namespaces,
+# matrix, id offsets, id blob, codes, meta offsets and meta length
+_HEADER = struct.Struct("<8sHHQIIQQQQQQ")
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+class VectorStore:
+    """Read only view of a store file, see the module docstring for the layout."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+            stat = os.fstat(f.fileno())
+        # identifies this version of the file, stat fields change on rewrite
+        self.fingerprint = hashlib.sha256(
+            header + struct.pack("<QQQ", stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        ).hexdigest()[:16]
+        (
+            magic,
+            version,
+            self.flags,
+            self.count,
+            self.dimension,
+            n_namespaces,
+            matrix_at,
+            offsets_at,
+            blob_at,
+            codes_at,
+            meta_at,
+            meta_len,
+        ) = _HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} vector store")
+        dtype = np.float16 if self.flags & FLAG_FLOAT16 else np.float32
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r")
+        self.vectors = np.ndarray(
+            (self.count, self.dimension), dtype, self._mmap, matrix_at
+        )
+        self._offsets = np.ndarray((self.count + 1,), np.uint64, self._mmap, offsets_at)
+        self._blob_at = blob_at
+        self.codes = np.ndarray(
+            (self.count, n_namespaces), np.uint32, self._mmap, codes_at
+        )
+        meta = json.loads(bytes(self._mmap[meta_at : meta_at + meta_len]))
+        self.namespaces: list[str] = meta["namespaces"]
+        self.tokens: dict[str, list[str]] = meta["tokens"]
+        self._token_codes = {
+            ns: {t: i + 1 for i, t in enumerate(tokens)}
+            for ns, tokens in self.tokens.items()
+        }
+        self._rows: Optional[dict[str, int]] = None
+
+    @classmethod
+    def open(cls, path: str) -> "VectorStore":
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def normalized(self) -> bool:
+        return bool(self.flags & FLAG_NORMALIZED)
+
+    def id(self, row: int) -> str:
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return bytes(self._mmap[self._blob_at + start : self._blob_at + end]).decode()
+
+    def lazy_ids(self) -> "IdTable":
+        """Ids decoded on access, for indexes that only look up their results."""
+        return IdTable(self)
+
+    def ids(self) -> np.ndarray:
+        """Every id as an object array, decodes the whole id table."""
+        blob = bytes(self._mmap[self._blob_at : self._blob_at + self._offsets[-1]])
+        offsets = self._offsets.tolist()
+        return np.array(
+            [blob[offsets[i] : offsets[i + 1]].decode() for i in range(self.count)],
+            dtype=object,
+        )
+
+    def row(self, dp_id: str) -> Optional[int]:
+        """Row of an id, builds an id -> row map on first use."""
+        if self._rows is None:
+            self._rows = {dp_id: i for i, dp_id in enumerate(self.ids())}
+        return self._rows.get(dp_id)
+
+    def restricts(self, row: int) -> Restricts:
+        return {
+            ns: frozenset([self.tokens[ns][code - 1]])
+            for ns, code in zip(self.namespaces, self.codes[row].tolist())
+            if code
+        }
+
+    def allowed(self, filters: list[tuple[str, list[str]]]) -> Optional[np.ndarray]:
+        """Boolean mask of rows matching filters, None if unfiltered."""
+        if not filters:
+            return None
+        mask = np.ones(self.count, dtype=bool)
+        for ns, tokens in filters:
+            if ns not in self._token_codes:
+                return np.zeros(self.count, dtype=bool)
+            codes = [
+                self._token_codes[ns][t] for t in tokens if t in self._token_codes[ns]
+            ]
+            mask &= np.isin(self.codes[:, self.namespaces.index(ns)], codes)
+        return mask
+
+    @staticmethod
+    def write(
+        path: str,
+        ids: list[str],
+        vectors: np.ndarray,
+        restricts: Optional[list[Restricts]] = None,
+        float16: bool = False,
+        normalized: bool = True,
+    ):
+        """Write a store atomically, replacing any existing file at path.
+
+        Args:
+            path: destination file
+            ids: datapoint ids
+            vectors: (len(ids), dimension) matrix
+            restricts: per datapoint namespace -> tokens, at most one token
+                per namespace
+            float16: store the matrix at half precision
+            normalized: L2 normalize vectors before storing, as the local
+                indexes expect
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if normalized:
+            vectors = normalize(vectors)
+        count, dimension = vectors.shape
+        if len(ids) != count:
+            raise ValueError(f"{len(ids)} ids for {count} vectors")
+        restricts = restricts or [{}] * count
+
+        namespaces = sorted({ns for r in restricts for ns in r})
+        tokens = {ns: [] for ns in namespaces}
+        token_codes = {ns: {} for ns in namespaces}
+        codes = np.zeros((count, len(namespaces)), dtype=np.uint32)
+        for row, r in enumerate(restricts):
+            for ns, allowed in r.items():
+                if len(allowed) != 1:
+                    raise ValueError(
+                        f"Datapoint {ids[row]} has {len(allowed)} tokens in "
+                        f"namespace {ns}, the store holds exactly one"
+                    )
+                (token,) = allowed
+                if token not in token_codes[ns]:
+                    tokens[ns].append(token)
+                    token_codes[ns][token] = len(tokens[ns])
+                codes[row, namespaces.index(ns)] = token_codes[ns][token]
+
+        encoded = [i.encode() for i in ids]
+        offsets = np.zeros(count + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        blob = b"".join(encoded)
+        meta = json.dumps({"namespaces": namespaces, "tokens": tokens}).encode()
+        matrix = vectors.astype(np.float16 if float16 else np.float32)
+
+        sections = [matrix.tobytes(), offsets.tobytes(), blob, codes.tobytes(), meta]
+        starts, at = [], _align(_HEADER.size)
+        for section in sections:
+            starts.append(at)
+            at = _align(at + len(section))
+        flags = (FLAG_FLOAT16 if float16 else 0) | (
+            FLAG_NORMALIZED if normalized else 0
+        )
+        header = _HEADER.pack(
+            MAGIC,
+            VERSION,
+            flags,
+            count,
+            dimension,
+            len(namespaces),
+            *starts,
+            len(meta),
+        )
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            for start, section in zip(starts, sections):
+                f.seek(start)
+                f.write(section)
+        os.replace(tmp, path)
+
+
+class IdTable:
+    """Read only sequence of the ids of a store, decoded on access.
+
+    Indexing with a row returns its id, with an array of rows or a slice an
+    object array of their ids.
+    """
+
+    def __init__(self, store: VectorStore):
+        self._store = store
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def __iter__(self):
+        return iter(self._store.ids())
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            return self._store.id(int(rows))
+        rows = np.arange(len(self))[rows] if isinstance(rows, slice) else rows
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return np.array([self._store.id(int(r)) for r in rows], dtype=object)
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description="Convert datapoints to a store")
+    parser.add_argument("input", help="Vertex index JSON lines datapoints")
+    parser.add_argument("output", help=f"vector store file, e.g. catalog{SUFFIX}")
+    parser.add_argument("--float16", action="store_true")
+    args = parser.parse_args(argv)
+    ids, vectors, restricts = read_jsonl(args.input)
+    VectorStore.write(args.output, ids, vectors, restricts, float16=args.float16)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""Vector Store Unit Test."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from google.cloud.ml.applied.knn import base, ivf, local, store
+
+
+def _restricts(*levels):
+    return local.parse_restricts(base.category_restricts(list(levels)))
+
+
+class VectorStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "catalog" + store.SUFFIX)
+        self.ids = ["1_T", "2_T", "3_Ü"]
+        self.vectors = np.array([[2, 0, 0], [0.9, 0.1, 0], [0, 1, 0]])
+        self.restricts = [
+            _restricts("Mens", "Pants"),
+            _restricts("Mens"),
+            _restricts("Womens", "Pants"),
+        ]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_roundtrip(self):
+        store.VectorStore.write(self.path, self.ids, self.vectors, self.restricts)
+        s = store.VectorStore.open(self.path)
+        self.assertEqual((len(s), s.dimension), (3, 3))
+        self.assertIsInstance(s.vectors, np.ndarray)
+        self.assertEqual(s.vectors.dtype, np.float32)
+        np.testing.assert_allclose(s.vectors[0], [1, 0, 0])
+        self.assertEqual(list(s.ids()), self.ids)
+        self.assertEqual(s.id(2), "3_Ü")
+        self.assertEqual(s.row("2_T"), 1)
+        self.assertEqual(s.restricts(0), self.restricts[0])
+        self.assertEqual(s.restricts(1), self.restricts[1])
+
+    def test_allowed(self):
+        store.VectorStore.write(self.path, self.ids, self.vectors, self.restricts)
+        s = store.VectorStore.open(self.path)
+        self.assertIsNone(s.allowed([]))
+        mask = s.allowed(base.filter_namespaces(["Mens"]))
+        self.assertEqual(mask.tolist(), [True, True, False])
+        mask = s.allowed(base.filter_namespaces(["Mens", "Pants"]))
+        self.assertEqual(mask.tolist(), [True, False, False])
+        mask = s.allowed([("L3", ["x"])])
+        self.assertEqual(mask.tolist(), [False, False, False])
+
+    def test_float16(self):
+        store.VectorStore.write(self.path, self.ids, self.vectors, float16=True)
+        s = store.VectorStore.open(self.path)
+        self.assertEqual(s.vectors.dtype, np.float16)
+        index = local.BruteForceIndex.from_store(s)
+        self.assertEqual(index.vectors.dtype, np.float32)
+
+    def test_indexes_from_store(self):
+        store.VectorStore.write(self.path, self.ids, self.vectors, self.restricts)
+        s = store.VectorStore.open(self.path)
+        index = local.BruteForceIndex.from_store(s)
+        self.assertIs(index.vectors, s.vectors)
+        filters = base.filter_namespaces(["Mens"])
+        res = index.search(np.array([0, 1, 0]), 3, filters)
+        self.assertEqual([n.id for n in res[0]], ["2_T", "1_T"])
+
+        index.remove(["2_T"])
+        self.assertIsNone(index.store)
+        res = index.search(np.array([0, 1, 0]), 3, filters)
+        self.assertEqual([n.id for n in res[0]], ["1_T"])
+
+        index = ivf.IVFIndex.from_store(s, nlist=2)
+        res = index.search(np.array([0, 1, 0]), 1, nprobe=2)
+        self.assertEqual(res[0][0].id, "3_Ü")
+
+    def test_lazy_ids(self):
+        store.VectorStore.write(self.path, self.ids, self.vectors, self.restricts)
+        ids = store.VectorStore.open(self.path).lazy_ids()
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[2], "3_Ü")
+        self.assertEqual(ids[np.array([2, 0])].tolist(), ["3_Ü", "1_T"])
+        self.assertEqual(ids[1:].tolist(), ["2_T", "3_Ü"])
+        self.assertEqual(ids[np.array([True, False, True])].tolist(), ["1_T", "3_Ü"])
+        self.assertEqual(list(ids), self.ids)
+
+    def test_fingerprint(self):
+        store.VectorStore.write(self.path, self.ids, self.vectors, self.restricts)
+        before = store.VectorStore.open(self.path).fingerprint
+        self.assertEqual(store.VectorStore.open(self.path).fingerprint, before)
+        store.VectorStore.write(self.path, self.ids, self.vectors[::-1], self.restricts)
+        self.assertNotEqual(store.VectorStore.open(self.path).fingerprint, before)
+
+    def test_multiple_tokens_rejected(self):
+        with self.assertRaises(ValueError):
+            store.VectorStore.write(
+                self.path, ["1_T"], np.ones((1, 3)), [{"L0": frozenset(["a", "b"])}]
+            )
+
+    def test_not_a_store(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 128)
+        with self.assertRaises(ValueError):
+            store.VectorStore.open(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
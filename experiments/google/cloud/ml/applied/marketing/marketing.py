@@ -17,8 +17,6 @@
 from google.cloud.ml.applied.model import domain_model as m
 from google.cloud.ml.applied.utils import utils
 
-llm = utils.get_llm()
-
 
 def generate_marketing_copy(model: m.MarketingRequest) -> m.TextValue:
     """Given list of product IDs, join category names.
@@ -43,5 +41,5 @@ def generate_marketing_copy(model: m.MarketingRequest) -> m.TextValue:
         "max_output_tokens": 1024,
         "temperature": 0.5,
     }
-    response = llm.predict(prompt, **llm_parameters)
+    response = utils.llm_predict(utils.get_llm(), prompt, **llm_parameters)
     return m.TextValue(text=response.text)
@@ -0,0 +1,199 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Quota aware rate limiting and retries for Vertex API calls."""
+import asyncio
+import logging
+import random
+import threading
+import time
+from functools import cache
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from google.api_core import exceptions
+
+from google.cloud.ml.applied.config import Config
+
+# ResourceExhausted (gRPC) is a subclass of TooManyRequests (HTTP 429)
+RETRYABLE_ERRORS = (exceptions.TooManyRequests, exceptions.ServiceUnavailable)
+
+
+class LimiterStats(NamedTuple):
+    calls: int
+    throttled: int  # calls that had to wait for a token
+    throttle_seconds: float
+    retries: int
+    budget_exhausted: int  # retryable errors raised because the budget ran out
+    failures: int
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding up to capacity.
+
+    Callers reserve a token and are told how long to wait for it, so sleeping
+    happens outside the lock and waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Take tokens, returning the number of seconds to wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class RetryBudget:
+    """Caps retries at ratio of the calls made, plus a small reserve.
+
+    Every call deposits ratio tokens, every retry withdraws one. This keeps a
+    burst of throttling errors from turning into a retry storm.
+    """
+
+    def __init__(self, ratio: float, reserve: float = 10):
+        self.ratio = ratio
+        self.capacity = reserve
+        self._tokens = reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RateLimiter:
+    """Token bucket rate limit with jittered exponential backoff.
+
+    Calls wait for a token before being sent. Calls failing with 429 or 503
+    are retried after a full jitter exponential backoff for up to max_retries
+    attempts, as long as the retry budget allows.
+
+    Args:
+        name: used in log messages
+        qps: sustained calls per second
+        burst: maximum calls sent back to back after an idle period
+        max_retries: maximum retries per call
+        initial_backoff: base backoff in seconds, doubled on every retry
+        max_backoff: upper bound for a single backoff in seconds
+        retry_budget: retries allowed as a fraction of calls made
+    """
+
+    def __init__(
+        self,
+        name: str,
+        qps: float,
+        burst: float,
+        max_retries: int = 5,
+        initial_backoff: float = 0.5,
+        max_backoff: float = 30,
+        retry_budget: float = 0.2,
+    ):
+        self.name = name
+        self.bucket = TokenBucket(qps, burst)
+        self.budget = RetryBudget(retry_budget)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(LimiterStats._fields, 0)
+
+    def _count(self, field: str, value: float = 1):
+        with self._lock:
+            self._counts[field] += value
+
+    def _throttle(self) -> float:
+        wait = self.bucket.reserve()
+        self._count("calls")
+        self.budget.deposit()
+        if wait > 0:
+            self._count("throttled")
+            self._count("throttle_seconds", wait)
+        return wait
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Seconds to sleep before retrying, re-raises error if out of retries."""
+        if attempt >= self.max_retries:
+            self._count("failures")
+            raise error
+        if not self.budget.withdraw():
+            self._count("budget_exhausted")
+            self._count("failures")
+            logging.warning(f"{self.name}: retry budget exhausted")
+            raise error
+        self._count("retries")
+        delay = random.uniform(
+            0, min(self.max_backoff, self.initial_backoff * 2**attempt)
+        )
+        logging.warning(
+            f"{self.name}: {error.__class__.__name__}, retry {attempt + 1} "
+            f"in {delay:.2f}s"
+        )
+        return delay
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Call fn(*args, **kwargs) within the rate limit, retrying throttling."""
+        attempt = 0
+        while True:
+            time.sleep(self._throttle())
+            try:
+                return fn(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                time.sleep(self._backoff(attempt, e))
+                attempt += 1
+
+    async def acall(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Asyncio version of call(), fn must return an awaitable."""
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._throttle())
+            try:
+                return await fn(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(self._backoff(attempt, e))
+                attempt += 1
+
+    def stats(self) -> LimiterStats:
+        with self._lock:
+            return LimiterStats(**self._counts)
+
+
+@cache
+def get_limiter(name: str) -> RateLimiter:
+    """Shared limiter configured by [rate_limits.<name>] in app.toml.
+
+    Names without their own table use [rate_limits.default].
+    """
+    limits = Config.value(Config.SECTION_RATE_LIMITS, "default")
+    try:
+        limits = limits | Config.value(Config.SECTION_RATE_LIMITS, name)
+    except KeyError:
+        pass
+    return RateLimiter(name, **limits)
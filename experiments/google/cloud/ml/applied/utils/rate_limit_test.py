@@ -0,0 +1,100 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Rate Limiter Unit Test."""
+import asyncio
+import unittest
+
+from google.api_core import exceptions
+
+from google.cloud.ml.applied.utils import rate_limit
+
+
+class Flaky:
+    """Fails with the given error the first n calls."""
+
+    def __init__(self, n: int, error=exceptions.TooManyRequests):
+        self.n = n
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        if self.calls <= self.n:
+            raise self.error("quota")
+        return value
+
+
+class RateLimiterTest(unittest.TestCase):
+    def limiter(self, **kwargs):
+        args = dict(qps=1000, burst=1000, initial_backoff=0.001, max_backoff=0.01)
+        return rate_limit.RateLimiter("test", **(args | kwargs))
+
+    def test_token_bucket(self):
+        bucket = rate_limit.TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+
+    def test_retries_throttling(self):
+        limiter = self.limiter()
+        fn = Flaky(2, exceptions.ServiceUnavailable)
+        self.assertEqual(limiter.call(fn, "ok"), "ok")
+        stats = limiter.stats()
+        self.assertEqual((stats.calls, stats.retries, stats.failures), (3, 2, 0))
+
+    def test_max_retries(self):
+        limiter = self.limiter(max_retries=1)
+        with self.assertRaises(exceptions.ResourceExhausted):
+            limiter.call(Flaky(5, exceptions.ResourceExhausted), "ok")
+        self.assertEqual(limiter.stats().failures, 1)
+
+    def test_non_retryable(self):
+        limiter = self.limiter()
+        fn = Flaky(1, exceptions.InvalidArgument)
+        with self.assertRaises(exceptions.InvalidArgument):
+            limiter.call(fn, "ok")
+        self.assertEqual(fn.calls, 1)
+
+    def test_retry_budget(self):
+        limiter = self.limiter(retry_budget=0)
+        limiter.budget = rate_limit.RetryBudget(ratio=0, reserve=1)
+        with self.assertRaises(exceptions.TooManyRequests):
+            limiter.call(Flaky(5), "ok")
+        self.assertEqual(limiter.stats().budget_exhausted, 1)
+        self.assertEqual(limiter.stats().retries, 1)
+
+    def test_throttled_calls_counted(self):
+        limiter = self.limiter(qps=100, burst=1)
+        for _ in range(3):
+            limiter.call(lambda: None)
+        self.assertEqual(limiter.stats().throttled, 2)
+
+    def test_async(self):
+        limiter = self.limiter()
+        flaky = Flaky(1)
+
+        async def fn(value):
+            return flaky(value)
+
+        self.assertEqual(asyncio.run(limiter.acall(fn, "ok")), "ok")
+        self.assertEqual(limiter.stats().retries, 1)
+
+    def test_get_limiter_uses_defaults(self):
+        limiter = rate_limit.get_limiter("not_configured")
+        self.assertEqual(limiter.name, "not_configured")
+
+
+if __name__ == "__main__":
+    unittest.main()
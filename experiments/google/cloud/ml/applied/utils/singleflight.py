@@ -0,0 +1,120 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Single-flight de-duplication of identical in-flight calls."""
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable hash of JSON serializable call arguments."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# result of a leader that was cancelled or interrupted, followers call again
+_ABANDONED = object()
+
+
+class SingleFlight:
+    """Shares one execution among concurrent callers using the same key.
+
+    The first caller for a key runs the function, callers arriving while it
+    is in flight wait for and receive the same result (or exception). Nothing
+    is remembered once the call completes, this is not a cache. If the
+    leader is cancelled or interrupted (an exception that is not an
+    Exception), one of the waiting callers runs the function again.
+
+    do() is for threads, ado() for coroutines. They use separate key spaces:
+    a thread blocking on a call led by a coroutine would deadlock if it ran
+    on the event loop of that coroutine.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future] = {}
+        self._async_calls: dict[str, Future] = {}
+
+    def _join(self, calls: dict[str, Future], key: str) -> tuple[Future, bool]:
+        with self._lock:
+            future = calls.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            calls[key] = future
+            return future, True
+
+    def _finish(
+        self,
+        calls: dict[str, Future],
+        key: str,
+        future: Future,
+        result=None,
+        error=None,
+    ):
+        with self._lock:
+            del calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """Run fn() unless a call with the same key is in flight."""
+        while True:
+            future, leader = self._join(self._calls, key)
+            if leader:
+                break
+            result = future.result()
+            if result is not _ABANDONED:
+                return result
+        try:
+            result = fn()
+        except Exception as e:
+            self._finish(self._calls, key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(self._calls, key, future, result=_ABANDONED)
+            raise
+        self._finish(self._calls, key, future, result=result)
+        return result
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await fn() unless a call with the same key is in flight."""
+        while True:
+            future, leader = self._join(self._async_calls, key)
+            if leader:
+                break
+            # shielded, a cancelled follower must not cancel the shared call
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            if result is not _ABANDONED:
+                return result
+        try:
+            result = await fn()
+        except Exception as e:
+            self._finish(self._async_calls, key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(self._async_calls, key, future, result=_ABANDONED)
+            raise
+        self._finish(self._async_calls, key, future, result=result)
+        return result
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls) + len(self._async_calls)
@@ -0,0 +1,135 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Single-flight Unit Test."""
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud.ml.applied.utils import singleflight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_threads_share_call(self):
+        flights = singleflight.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = [pool.submit(flights.do, "key", fn) for _ in range(4)]
+            while flights.in_flight() == 0:
+                pass
+            release.set()
+            results = [f.result() for f in futures]
+
+        self.assertEqual(results, ["result"] * 4)
+        self.assertLessEqual(len(calls), 4)
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_coroutines_share_call(self):
+        flights = singleflight.SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        async def main():
+            return await asyncio.gather(*[flights.ado("key", fn) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(main()), ["result"] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_exception_shared(self):
+        flights = singleflight.SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def main():
+            return await asyncio.gather(
+                *[flights.ado("key", fn) for _ in range(3)], return_exceptions=True
+            )
+
+        results = asyncio.run(main())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_cancelled_leader(self):
+        flights = singleflight.SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def main():
+            leader = asyncio.create_task(flights.ado("key", fn))
+            await asyncio.sleep(0)
+            followers = [asyncio.create_task(flights.ado("key", fn)) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await asyncio.gather(*followers)
+
+        # a follower runs fn again, the others share its result
+        self.assertEqual(asyncio.run(main()), ["result"] * 3)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_cancelled_follower(self):
+        flights = singleflight.SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def main():
+            leader = asyncio.create_task(flights.ado("key", fn))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(flights.ado("key", fn))
+            await asyncio.sleep(0.01)
+            follower.cancel()
+            return await leader
+
+        self.assertEqual(asyncio.run(main()), "result")
+
+    def test_sync_call_on_loop_thread(self):
+        flights = singleflight.SingleFlight()
+
+        async def fn():
+            # a blocking call on the loop thread with the key of this coroutine
+            return flights.do("key", lambda: "sync")
+
+        async def main():
+            return await flights.ado("key", fn)
+
+        self.assertEqual(asyncio.run(asyncio.wait_for(main(), 5)), "sync")
+
+    def test_fingerprint(self):
+        a = singleflight.fingerprint("prompt", {"temperature": 0.0, "top_k": 1})
+        b = singleflight.fingerprint("prompt", {"top_k": 1, "temperature": 0.0})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, singleflight.fingerprint("other", {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
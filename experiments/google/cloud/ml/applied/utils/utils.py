@@ -22,8 +22,10 @@ from google.cloud import aiplatform_v1
 from google.cloud import bigquery
 from vertexai.preview.generative_models import GenerativeModel
 from google.cloud.ml.applied.config import Config
+from google.cloud.ml.applied.utils import rate_limit, singleflight
 
 conf = Config()
+llm_flights = singleflight.SingleFlight()
 
 
 @cache
@@ -43,6 +45,20 @@ def get_llm():
     )
 
 
+def llm_predict(llm: Any, prompt: str, **parameters) -> Any:
+    """Call llm.predict, sharing the RPC between identical concurrent calls.
+
+    Only deterministic (temperature 0) calls are de-duplicated, sampled calls
+    are always sent so that each caller gets an independent answer. Calls go
+    through the "llm" rate limiter.
+    """
+    limiter = rate_limit.get_limiter("llm")
+    if parameters.get("temperature") != 0:
+        return limiter.call(llm.predict, prompt, **parameters)
+    key = singleflight.fingerprint(id(llm), prompt, parameters)
+    return llm_flights.do(key, lambda: limiter.call(llm.predict, prompt, **parameters))
+
+
 @cache
 def get_gemini_pro_vision() -> Any:
     multimodal_model = GenerativeModel(conf.value(Config.SECTION_MODELS, "gemini"))
@@ -54,6 +54,7 @@ dependencies = [
     "numpy>=1.26.3",
     "mediapipe>==0.10.9",
     "pandas>=2.1.4",
+    "pillow>=10.2.0",
     "en_core_web_sm@https://github.com/explosion/spacy-models/releases/download/en_core_web_sm-3.4.0/en_core_web_sm-3.4.0-py3-none-any.whl"
     "spacy>=3.4.4",
     "spacy-cleaner>=3.1.0",